@@ -0,0 +1,147 @@
+# Benchmark for the conversion of Adaptive immunoSEQ gene calls to AIRR gene
+# calls done by the Adaptive loader. Generates a synthetic immunoSEQ file and
+# compares the original row by row conversion (Adaptive.mapAdaptiveGene applied
+# across the resolved/ties columns followed by Adaptive.convertGeneCall) with
+# the cached conversion used by the loader (getAdaptiveGeneCallColumn).
+#
+# Usage: python3 adaptive_gene_benchmark.py /app/config/AIRR-iReceptorMapping.txt --rows 200000
+
+import sys
+import os
+import time
+import random
+import argparse
+import tempfile
+import pandas as pd
+
+# The data loader modules use flat imports from the dataload directory.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "dataload"))
+from airr_map import AIRRMap
+from adaptive import Adaptive
+
+# The resolved and tie values for a gene, in the style of an immunoSEQ export.
+def generateGene(gene_type, num_genes):
+    family = random.randint(1, num_genes)
+    gene = random.randint(1, 3)
+    resolved = "TCRB%s%02d-%02d"%(gene_type, family, gene)
+    choice = random.random()
+    if choice < 0.5:
+        # Resolved to an allele
+        return (resolved + "*01", "no data", "no data", "no data")
+    elif choice < 0.7:
+        # Resolved to a gene with allele ties
+        return (resolved, "01,02", "no data", "no data")
+    elif choice < 0.85:
+        # Resolved to a family with gene ties
+        return ("TCRB%s%02d"%(gene_type, family),
+                "no data",
+                "TCRB%s%02d-%02d/%02d-%02d,TCRB%s%02d-%02d"%
+                (gene_type, family, gene, family, gene + 1, gene_type, family, gene + 1),
+                "no data")
+    elif choice < 0.95:
+        # Unresolved with gene ties
+        return ("unknown", "no data",
+                "TCRB%s%02d-%02d,TCRB%s%02d-%02d"%
+                (gene_type, family, gene, gene_type, family + 1, gene),
+                "TCRB%s%02d,TCRB%s%02d"%(gene_type, family, gene_type, family + 1))
+    else:
+        # A / in the resolved value
+        return ("TCRB%s%02d-%02d/%02d-%02d*01"%(gene_type, family, gene, family, gene + 1),
+                "no data", "no data", "no data")
+
+# Write a synthetic immunoSEQ file with num_rows rows. Only the gene columns
+# used by the conversion (and a junction) are generated.
+def writeAdaptiveFile(filename, num_rows, seed):
+    random.seed(seed)
+    columns = ["amino_acid"]
+    for gene_type in ["v", "d", "j"]:
+        columns = columns + ["%s_resolved"%(gene_type), "%s_allele_ties"%(gene_type),
+                             "%s_gene_ties"%(gene_type), "%s_family_ties"%(gene_type)]
+    with open(filename, "w") as file_handle:
+        file_handle.write("\t".join(columns) + "\n")
+        for row in range(num_rows):
+            values = ["CASSL%dYEQYF"%(random.randrange(100000))]
+            values = values + list(generateGene("V", 30))
+            values = values + list(generateGene("D", 2))
+            values = values + list(generateGene("J", 2))
+            file_handle.write("\t".join(values) + "\n")
+
+# The original conversion, row by row.
+def rowConversion(df, gene_fields):
+    gene_call = df[gene_fields].apply(
+                    lambda x : Adaptive.mapAdaptiveGene(
+                                   x.iloc[0], x.iloc[1], x.iloc[2], x.iloc[3]), axis=1)
+    return gene_call.apply(Adaptive.convertGeneCall)
+
+def getArguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Adaptive gene call conversion."
+    )
+    parser.add_argument("mapfile", help="The AIRR Mapping file to use.")
+    parser.add_argument(
+        "--rows",
+        dest="rows",
+        type=int,
+        default=200000,
+        help="Number of rows in the synthetic file. Defaults to 200000."
+    )
+    parser.add_argument(
+        "--chunk",
+        dest="chunk",
+        type=int,
+        default=100000,
+        help="Number of rows per chunk, as in --database_chunk. Defaults to 100000."
+    )
+    parser.add_argument(
+        "--seed",
+        dest="seed",
+        type=int,
+        default=1,
+        help="Random seed for the synthetic data. Defaults to 1."
+    )
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    options = getArguments()
+
+    airr_map = AIRRMap(False)
+    airr_map.readMapFile(options.mapfile)
+    parser = Adaptive(False, "ir_repository", options.chunk, airr_map, None)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, "adaptive.tsv")
+        t_start = time.perf_counter()
+        writeAdaptiveFile(filename, options.rows, options.seed)
+        t_end = time.perf_counter()
+        print("Info: Wrote %d rows in %f s"%(options.rows, t_end - t_start))
+
+        t_row = 0.0
+        t_cached = 0.0
+        mismatches = 0
+        df_reader = pd.read_csv(filename, sep='\t', chunksize=options.chunk,
+                                na_filter=False)
+        for df_chunk in df_reader:
+            # As in the loader, unmapped columns are prefixed with ad_
+            df_chunk.columns = ["ad_" + column for column in df_chunk.columns]
+            for gene_type in ["v", "d", "j"]:
+                gene_fields = ["ad_%s_resolved"%(gene_type),
+                               "ad_%s_allele_ties"%(gene_type),
+                               "ad_%s_gene_ties"%(gene_type),
+                               "ad_%s_family_ties"%(gene_type)]
+                t_start = time.perf_counter()
+                row_calls = rowConversion(df_chunk, gene_fields)
+                t_row = t_row + (time.perf_counter() - t_start)
+                t_start = time.perf_counter()
+                cached_calls = parser.getAdaptiveGeneCallColumn(df_chunk, gene_fields)
+                t_cached = t_cached + (time.perf_counter() - t_start)
+                mismatches = mismatches + int((row_calls != cached_calls).sum())
+
+        if mismatches > 0:
+            print("Warning: %d gene calls differ between the conversions"%(mismatches))
+        print("Info: %d distinct gene value combinations"%
+              (len(parser.adaptive_gene_cache)))
+        print("Info: row conversion = %f s (%.1f rows/s)"%
+              (t_row, options.rows/t_row))
+        print("Info: cached conversion = %f s (%.1f rows/s), speedup = %.1fx"%
+              (t_cached, options.rows/t_cached, t_row/t_cached))
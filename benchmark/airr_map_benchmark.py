@@ -0,0 +1,109 @@
+# Micro-benchmark for AIRRMap.getMapping lookups. Compares the hash index
+# lookup used by getMapping with the original approach of scanning the mapping
+# with a pandas isin boolean mask for each lookup.
+#
+# Usage: python3 airr_map_benchmark.py /app/config/AIRR-iReceptorMapping.txt
+
+import sys
+import os
+import time
+import argparse
+import pandas as pd
+
+# The data loader modules use flat imports from the dataload directory.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "dataload"))
+from airr_map import AIRRMap
+
+# The original getMapping lookup, scanning the class mapping for the field
+# using a boolean mask.
+def scanMapping(airr_map, field, from_column, to_column, map_class):
+    mapping = airr_map.getClassMappings()[map_class]
+    if not from_column in mapping:
+        return None
+    from_row = mapping.loc[mapping[from_column].isin([field])]
+    if not to_column in from_row:
+        return None
+    value = from_row[to_column]
+    if len(value.values) >= 1 and pd.notnull(value.values[0]):
+        return value.values[0]
+    return None
+
+# Time a lookup function over the set of lookups given, repeating the set of
+# lookups until at least min_time seconds have passed. Returns lookups/s.
+def timeLookups(lookup_function, airr_map, lookups, min_time):
+    count = 0
+    t_start = time.perf_counter()
+    t_elapsed = 0.0
+    while t_elapsed < min_time:
+        for field, from_column, to_column, map_class in lookups:
+            lookup_function(airr_map, field, from_column, to_column, map_class)
+        count = count + len(lookups)
+        t_elapsed = time.perf_counter() - t_start
+    return count/t_elapsed
+
+def getArguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark AIRRMap field lookups."
+    )
+    parser.add_argument("mapfile", help="The AIRR Mapping file to use.")
+    parser.add_argument(
+        "--from_column",
+        dest="from_column",
+        default="ir_id",
+        help="The mapping column to look fields up in. Defaults to ir_id."
+    )
+    parser.add_argument(
+        "--to_column",
+        dest="to_column",
+        default="ir_turnkey",
+        help="The mapping column to map fields to. Defaults to ir_turnkey."
+    )
+    parser.add_argument(
+        "--min_time",
+        dest="min_time",
+        type=float,
+        default=2.0,
+        help="Minimum number of seconds to run each benchmark for. Defaults to 2."
+    )
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    options = getArguments()
+
+    t_start = time.perf_counter()
+    airr_map = AIRRMap(False)
+    if not airr_map.readMapFile(options.mapfile):
+        sys.exit(1)
+    t_end = time.perf_counter()
+    print("Info: Read mapping and built index in %f s (%d keys)"%
+          (t_end - t_start, len(airr_map.mapping_index)))
+
+    if not options.from_column in airr_map.airr_mappings:
+        print("ERROR: Mapping does not have a %s column"%(options.from_column))
+        sys.exit(1)
+
+    # Build a list of lookups, every field for every class. We also look up
+    # one field that does not exist per class to cover the miss path.
+    lookups = []
+    for map_class, mapping in airr_map.getClassMappings().items():
+        for field in mapping[options.from_column].dropna():
+            lookups.append((field, options.from_column, options.to_column, map_class))
+        lookups.append(("no_such_field", options.from_column,
+                        options.to_column, map_class))
+
+    # Check that the index returns the same values as the scan.
+    mismatch = 0
+    for field, from_column, to_column, map_class in lookups:
+        if (scanMapping(airr_map, field, from_column, to_column, map_class) !=
+            airr_map.getMapping(field, from_column, to_column, map_class)):
+            mismatch = mismatch + 1
+    if mismatch > 0:
+        print("Warning: %d lookups differ between scan and index"%(mismatch))
+
+    scan_rate = timeLookups(scanMapping, airr_map, lookups, options.min_time)
+    index_rate = timeLookups(AIRRMap.getMapping, airr_map, lookups, options.min_time)
+    print("Info: %d distinct lookups"%(len(lookups)))
+    print("Info: scan  = %12.1f lookups/s"%(scan_rate))
+    print("Info: index = %12.1f lookups/s"%(index_rate))
+    print("Info: speedup = %.1fx"%(index_rate/scan_rate))
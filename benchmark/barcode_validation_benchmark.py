@@ -0,0 +1,148 @@
+# Benchmark for the duplicate barcode check performed when loading AIRR Cell
+# files. Generates a synthetic AIRR Cell JSON file and compares the original
+# list based check with the UniqueFieldValidator used by the data loader.
+#
+# The list based check is O(n^2) in the number of cells, so it is only run on
+# the first --list_cells cells of the file.
+#
+# Usage: python3 barcode_validation_benchmark.py --cells 1000000
+
+import sys
+import os
+import time
+import json
+import random
+import argparse
+import tempfile
+
+# The data loader modules use flat imports from the dataload directory.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "dataload"))
+from json_array_reader import JSONArrayReader
+from json_validation import UniqueFieldValidator
+
+# Write a synthetic AIRR Cell file with num_cells cells, num_duplicates of which
+# reuse the barcode of an earlier cell.
+def writeCellFile(filename, num_cells, num_duplicates, seed):
+    random.seed(seed)
+    duplicate_positions = set(random.sample(range(1, num_cells), num_duplicates))
+    with open(filename, "w") as file_handle:
+        file_handle.write("[\n")
+        for position in range(num_cells):
+            if position in duplicate_positions:
+                barcode = "%016d-1"%(random.randrange(position))
+            else:
+                barcode = "%016d-1"%(position)
+            cell = {"cell_id": barcode,
+                    "rearrangements": ["%s_contig_1"%(barcode), "%s_contig_2"%(barcode)],
+                    "receptors": [],
+                    "repertoire_id": "1",
+                    "data_processing_id": "1",
+                    "expression_study_method": "flow_cytometry",
+                    "virtual_pairing": False}
+            if position > 0:
+                file_handle.write(",\n")
+            file_handle.write(json.dumps(cell))
+        file_handle.write("\n]\n")
+
+# The original check, searching a list of the barcodes seen so far.
+def listCheck(cells, barcode_field):
+    barcode_list = list()
+    duplicates = 0
+    for cell_dict in cells:
+        if barcode_field in cell_dict:
+            if cell_dict[barcode_field] in barcode_list:
+                duplicates = duplicates + 1
+            else:
+                barcode_list.append(cell_dict[barcode_field])
+    return duplicates
+
+# The check used by the data loader.
+def validatorCheck(cells, barcode_field):
+    barcode_validator = UniqueFieldValidator(barcode_field)
+    duplicates = 0
+    for position, cell_dict in enumerate(cells):
+        if not barcode_validator.check(cell_dict, position):
+            duplicates = duplicates + 1
+    return duplicates
+
+def getArguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the duplicate barcode check for AIRR Cell files."
+    )
+    parser.add_argument(
+        "--cells",
+        dest="cells",
+        type=int,
+        default=1000000,
+        help="Number of cells in the synthetic file. Defaults to 1000000."
+    )
+    parser.add_argument(
+        "--duplicates",
+        dest="duplicates",
+        type=int,
+        default=10,
+        help="Number of cells with a duplicated barcode. Defaults to 10."
+    )
+    parser.add_argument(
+        "--list_cells",
+        dest="list_cells",
+        type=int,
+        default=20000,
+        help="Number of cells to run the list based check on. Defaults to 20000."
+    )
+    parser.add_argument(
+        "--seed",
+        dest="seed",
+        type=int,
+        default=1,
+        help="Random seed for the synthetic data. Defaults to 1."
+    )
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    options = getArguments()
+    barcode_field = "cell_id"
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, "cells.json")
+        t_start = time.perf_counter()
+        writeCellFile(filename, options.cells, options.duplicates, options.seed)
+        t_end = time.perf_counter()
+        print("Info: Wrote %d cells in %f s"%(options.cells, t_end - t_start))
+
+        # Read the cells up front so the comparison only measures the checks.
+        with open(filename, "r") as file_handle:
+            cells = list(JSONArrayReader(file_handle, filename))
+
+        list_cells = cells[:options.list_cells]
+        t_start = time.perf_counter()
+        list_duplicates = listCheck(list_cells, barcode_field)
+        t_list = time.perf_counter() - t_start
+        t_start = time.perf_counter()
+        validator_duplicates = validatorCheck(list_cells, barcode_field)
+        t_validator = time.perf_counter() - t_start
+        if list_duplicates != validator_duplicates:
+            print("Warning: list found %d duplicates, validator found %d"%
+                  (list_duplicates, validator_duplicates))
+        print("Info: %d cells, list = %f s, validator = %f s, speedup = %.1fx"%
+              (len(list_cells), t_list, t_validator, t_list/t_validator))
+
+        # Time the validator on all of the cells, and the full streaming pass
+        # over the file as performed by the data loader.
+        t_start = time.perf_counter()
+        validator_duplicates = validatorCheck(cells, barcode_field)
+        t_validator = time.perf_counter() - t_start
+        print("Info: %d cells, validator = %f s (%d duplicates)"%
+              (len(cells), t_validator, validator_duplicates))
+        del cells
+
+        t_start = time.perf_counter()
+        with open(filename, "r") as file_handle:
+            barcode_validator = UniqueFieldValidator(barcode_field)
+            for position, cell_dict in enumerate(JSONArrayReader(file_handle, filename)):
+                barcode_validator.check(cell_dict, position)
+        t_stream = time.perf_counter() - t_start
+        print("Info: %d cells, streaming read and validate = %f s"%
+              (options.cells, t_stream))
+        barcode_validator.reportDuplicates(filename, "Info")
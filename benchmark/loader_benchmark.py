@@ -0,0 +1,819 @@
+# End to end throughput benchmark for the data loader parsers in the dataload
+# directory. Generates synthetic AIRR TSV, MiXCR, Adaptive, IMGT V-Quest archive,
+# AIRR Cell JSON and AIRR Expression JSON files, with the columns of each file
+# taken from the AIRR Mapping file so that the files match the mappings the
+# loader uses. Each file is then loaded by its parser, either into a scratch
+# database on a Mongo server or into an in-process sink that stands in for
+# Mongo (so that the parsing can be measured without a server), and the
+# records per second, the time spent in each stage of the load and the peak
+# memory (RSS) of the load are reported.
+#
+# Each load is run in its own process so that the peak RSS is for that load
+# alone. The results are written to a JSON file (with the git commit of the
+# loader) so that the throughput can be compared across commits, and a
+# results file from an earlier run can be given with --baseline to report the
+# change in throughput.
+#
+# Note: with --sink mongo the benchmark drops and recreates the collections in
+# the database given, it should not be run against a production database.
+#
+# Usage: python3 loader_benchmark.py /app/config/AIRR-iReceptorMapping.txt --records 100000
+
+import sys
+import os
+import io
+import json
+import time
+import random
+import argparse
+import tarfile
+import platform
+import threading
+import subprocess
+import contextlib
+import multiprocessing
+import pandas as pd
+from bson.objectid import ObjectId
+from airr.schema import RearrangementSchema
+
+# The data loader modules use flat imports from the dataload directory.
+DATALOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dataload")
+sys.path.append(DATALOAD_DIR)
+from airr_map import AIRRMap
+from repository import Repository
+from parser import Parser
+from imgt import IMGT
+from mixcr import MiXCR
+from airr_tsv import AIRR_TSV
+from adaptive import Adaptive
+from airr_cell import AIRR_Cell
+from airr_expression import AIRR_Expression
+
+# The formats that can be benchmarked: the parser class, the column of the AIRR
+# Mapping that gives the field names in the file, and the synthetic file name.
+FORMATS = {
+    "airr": (AIRR_TSV, "airr", "benchmark_airr.tsv"),
+    "mixcr": (MiXCR, "mixcr", "benchmark_mixcr.txt"),
+    "adaptive": (Adaptive, "adaptive", "benchmark_adaptive.tsv"),
+    "imgt": (IMGT, "vquest", "benchmark_imgt.txz"),
+    "cell": (AIRR_Cell, "airr", "benchmark_cell.json"),
+    "expression": (AIRR_Expression, "airr", "benchmark_expression.json"),
+}
+
+# The Repository methods that are timed as stages of the load.
+REPOSITORY_STAGES = {
+    "setRecordIDs": "id_assignment",
+    "insertRearrangements": "insert",
+    "insertCells": "insert",
+    "insertExpression": "insert",
+    "incrementField": "count_update",
+    "incrementStats": "stats_write",
+}
+
+REPERTOIRE_LINK_ID = "loader_benchmark_repertoire"
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+NUCLEOTIDES = "acgt"
+# The IMGT regions used to compute np1 and np2.
+IMGT_NP_REGIONS = ["P3'V", "N-REGION", "N1-REGION", "P5'D", "P5'D1", "D1-REGION",
+                   "P3'D", "P3'D1", "N2-REGION", "P5'D2", "P5'J"]
+IMGT_PARAMETERS = [
+    ("Date", "Mon Jan 01 00:00:00 CET 2024"),
+    ("IMGT/V-QUEST programme version", "3.6.0"),
+    ("IMGT/V-QUEST reference directory release", "202405-2"),
+    ("Species", "Homo sapiens (human)"),
+    ("Receptor type or locus", "IG"),
+    ("IMGT/V-QUEST reference directory set", "F+ORF+ in-frame P"),
+    ("Search for insertions and deletions", "yes"),
+    ("Nb of nucleotides to add (or exclude) in 3' of the V-REGION for the evaluation of the alignment score", "0"),
+    ("Nb of nucleotides to exclude in 5' of the V-REGION for the evaluation of the nb of mutations", "0"),
+]
+
+#####################################################################################
+# Synthetic data
+#####################################################################################
+
+# Generates the values of the synthetic records. Each rearrangement is a
+# dictionary keyed on the AIRR field name of the values that need to be
+# consistent across the columns of a file (the genes, the junction, productive),
+# other fields are generated from their type in the AIRR Mapping.
+class RecordGenerator:
+    def __init__(self, seed, clonality):
+        self.random = random.Random(seed)
+        self.clonality = clonality
+        self.junctions = []
+        self.v_genes = ["IGHV%d-%d*%02d"%(family, gene, allele)
+                        for family in range(1, 8) for gene in range(1, 12)
+                        for allele in range(1, 3)]
+        self.d_genes = ["IGHD%d-%d*01"%(family, gene)
+                        for family in range(1, 7) for gene in range(1, 6)]
+        self.j_genes = ["IGHJ%d*%02d"%(gene, allele)
+                        for gene in range(1, 7) for allele in range(1, 3)]
+        self.c_genes = ["IGHM*01", "IGHD*01", "IGHG1*01", "IGHA1*01"]
+
+    def nucleotides(self, length):
+        return "".join(self.random.choices(NUCLEOTIDES, k=length))
+
+    # Pick one gene, or sometimes a list of ties.
+    def genes(self, gene_list):
+        if self.random.random() < 0.15:
+            return self.random.sample(gene_list, 2)
+        return [self.random.choice(gene_list)]
+
+    # A junction, repeating an earlier junction for a fraction of the records
+    # as in a clonal repertoire.
+    def junction(self):
+        if len(self.junctions) > 0 and self.random.random() < self.clonality:
+            return self.random.choice(self.junctions)
+        junction_aa = "CAR" + "".join(self.random.choice(AMINO_ACIDS)
+                                      for _ in range(self.random.randint(6, 18))) + "W"
+        junction = self.nucleotides(3*len(junction_aa))
+        if len(self.junctions) < 10000:
+            self.junctions.append((junction, junction_aa))
+        return (junction, junction_aa)
+
+    def rearrangement(self, index):
+        junction, junction_aa = self.junction()
+        frame = self.random.choice(["In", "In", "In", "Out", "Stop"])
+        return {"sequence_id": "seq%d"%(index),
+                "sequence": self.nucleotides(300),
+                "v_call": self.genes(self.v_genes),
+                "d_call": self.genes(self.d_genes),
+                "j_call": self.genes(self.j_genes),
+                "c_call": self.genes(self.c_genes),
+                "junction": junction,
+                "junction_aa": junction_aa,
+                "junction_length": len(junction),
+                "productive": frame == "In",
+                "frame": frame,
+                "rev_comp": self.random.random() < 0.1,
+                "locus": "IGH",
+                "duplicate_count": self.random.randint(1, 20),
+                "consensus_count": self.random.randint(1, 20),
+                "cell_id": "cell%d"%(index//2),
+                "clone_id": "clone%d"%(index//5)}
+
+    # A value for a field that isn't in the rearrangement, from its AIRR type.
+    def typedValue(self, airr_type, json_value):
+        if airr_type == "integer":
+            return self.random.randint(1, 300)
+        if airr_type == "number":
+            return round(self.random.random()*100, 2)
+        if airr_type == "boolean":
+            value = self.random.random() < 0.5
+            if json_value:
+                return value
+            return "T" if value else "F"
+        return self.nucleotides(3*self.random.randint(2, 10))
+
+# Format a list of genes as written by each annotation tool.
+def formatGenes(genes, file_format):
+    if file_format == "mixcr":
+        return ",".join("%s(%d)"%(gene.split("*")[0] + "*00", 1000 - 10*index)
+                        for index, gene in enumerate(genes))
+    if file_format == "imgt":
+        return " or ".join("Homsap %s F"%(gene) for gene in genes)
+    return ",".join(genes)
+
+# Format a value of a rearrangement for a column of a file. The field is the
+# AIRR (or iReceptor) name of the column.
+def formatValue(generator, rearrangement, field, airr_type, file_format):
+    if field in ["v_call", "d_call", "j_call", "c_call"]:
+        return formatGenes(rearrangement[field], file_format)
+    if field == "productive":
+        if file_format == "imgt":
+            return "productive" if rearrangement["productive"] else "unproductive"
+        if file_format == "adaptive":
+            return rearrangement["frame"]
+        return "T" if rearrangement["productive"] else "F"
+    if field == "rev_comp":
+        if file_format == "imgt":
+            return "-" if rearrangement["rev_comp"] else "+"
+        return "T" if rearrangement["rev_comp"] else "F"
+    if field == "vj_in_frame" and file_format == "imgt":
+        return "in-frame" if rearrangement["frame"] == "In" else "out-of-frame"
+    if field in rearrangement:
+        return rearrangement[field]
+    return generator.typedValue(airr_type, False)
+
+# Get the rows of the AIRR Mapping for the fields of a class that are in the
+# file format, with the name of the field in the file and the AIRR (or
+# iReceptor) name and AIRR type of the field.
+def getFileFields(mapping, map_classes, map_column, ireceptor_tag):
+    rows = mapping.loc[mapping["ir_class"].isin(map_classes)]
+    fields = []
+    for index, row in rows.iterrows():
+        if not map_column in row or pd.isnull(row[map_column]):
+            continue
+        field = row["airr"] if "airr" in row and not pd.isnull(row["airr"]) else row[ireceptor_tag]
+        airr_type = row["airr_type"] if "airr_type" in row else "string"
+        is_array = str(row.get("airr_is_array", "")).upper() == "TRUE"
+        fields.append((str(row[map_column]), field, airr_type, is_array))
+    return fields
+
+# Write a tab separated file of rearrangements with the given columns, each
+# column a (file column, field, type, is_array) tuple.
+def writeTSV(file_handle, generator, columns, num_records, file_format, extra_columns=None):
+    names = [column[0] for column in columns]
+    if not extra_columns is None:
+        names = names + list(extra_columns(None))
+    file_handle.write("\t".join(names) + "\n")
+    for index in range(num_records):
+        rearrangement = generator.rearrangement(index)
+        values = [str(formatValue(generator, rearrangement, field, airr_type, file_format))
+                  for (name, field, airr_type, is_array) in columns]
+        if not extra_columns is None:
+            values = values + [str(value) for value in
+                               extra_columns(rearrangement).values()]
+        file_handle.write("\t".join(values) + "\n")
+
+# The AIRR TSV loader validates the header of the file against the AIRR
+# schema, so the fields that are required by the schema are always included.
+def generateAIRR(mapping, options, path):
+    columns = getFileFields(mapping, ["Rearrangement"], "airr", options.ireceptor_tag)
+    names = [column[0] for column in columns]
+    for field in RearrangementSchema.required:
+        if not field in names:
+            columns.append((field, field, RearrangementSchema.type(field), False))
+    generator = RecordGenerator(options.seed, options.clonality)
+    with open(path, "w") as file_handle:
+        writeTSV(file_handle, generator, columns, options.records, "airr")
+
+def generateMiXCR(mapping, options, path):
+    columns = getFileFields(mapping, ["Rearrangement", "IR_Rearrangement"], "mixcr",
+                            options.ireceptor_tag)
+    generator = RecordGenerator(options.seed, options.clonality)
+    with open(path, "w") as file_handle:
+        writeTSV(file_handle, generator, columns, options.records, "mixcr")
+
+# Adaptive gene calls are computed from the resolved and ties columns, which
+# are not in the mapping, so they are added to the mapped columns.
+def adaptiveGeneColumns(rearrangement):
+    columns = dict()
+    for gene_type in ["v", "d", "j"]:
+        for suffix in ["resolved", "allele_ties", "gene_ties", "family_ties"]:
+            columns["%s_%s"%(gene_type, suffix)] = "no data"
+        if rearrangement is None:
+            continue
+        gene = rearrangement[gene_type + "_call"][0]
+        name, allele = gene.split("*")
+        # TCRB style names, as used by immunoSEQ.
+        family, member = name[4:].split("-") if "-" in name else (name[4:], "1")
+        columns["%s_resolved"%(gene_type)] = "TCRB%s%02d-%02d*%s"%(
+            gene_type.upper(), int(family), int(member), allele)
+    return columns
+
+def generateAdaptive(mapping, options, path):
+    columns = getFileFields(mapping, ["Rearrangement", "IR_Rearrangement"], "adaptive",
+                            options.ireceptor_tag)
+    columns = [column for column in columns
+               if not column[0] in adaptiveGeneColumns(None)]
+    generator = RecordGenerator(options.seed, options.clonality)
+    with open(path, "w") as file_handle:
+        writeTSV(file_handle, generator, columns, options.records, "adaptive",
+                 adaptiveGeneColumns)
+
+# An IMGT archive has a file for each of the vquest files in the mapping, with
+# one row per sequence, and the parameter file.
+def generateIMGT(mapping, options, path):
+    rows = mapping.loc[mapping["ir_class"].isin(["Rearrangement"])]
+    files = dict()
+    for index, row in rows.iterrows():
+        if (pd.isnull(row.get("vquest")) or pd.isnull(row.get("vquest_file"))):
+            continue
+        field = row["airr"] if not pd.isnull(row.get("airr")) else row[options.ireceptor_tag]
+        airr_type = row.get("airr_type", "string")
+        columns = files.setdefault(row["vquest_file"],
+                                   [("Sequence number", "sequence_number", "integer")])
+        # Calculated fields can be made up of alternate columns (A or B), the
+        # first has the value and the second is empty.
+        for position, column in enumerate(str(row["vquest"]).split(" or ")):
+            columns.append((column, field if position == 0 else None, airr_type))
+        if field in ["np1", "np2"]:
+            columns.extend([(region, None, "string") for region in IMGT_NP_REGIONS])
+
+    generator = RecordGenerator(options.seed, options.clonality)
+    buffers = {vquest_file: io.StringIO() for vquest_file in files}
+    for vquest_file, columns in files.items():
+        names = list(dict.fromkeys([column[0] for column in columns]))
+        buffers[vquest_file].write("\t".join(names) + "\n")
+    for index in range(options.records):
+        rearrangement = generator.rearrangement(index)
+        for vquest_file, columns in files.items():
+            values = dict()
+            for (column, field, airr_type) in columns:
+                if column in values:
+                    continue
+                if field == "sequence_number":
+                    values[column] = str(index + 1)
+                elif field is None:
+                    values[column] = generator.nucleotides(3) if column in IMGT_NP_REGIONS else ""
+                else:
+                    values[column] = str(formatValue(generator, rearrangement, field,
+                                                     airr_type, "imgt"))
+            buffers[vquest_file].write("\t".join(values.values()) + "\n")
+
+    with tarfile.open(path, "w:xz") as tar:
+        def addFile(name, text):
+            data = text.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        for vquest_file, buffer in buffers.items():
+            addFile(vquest_file, buffer.getvalue())
+        addFile("11_Parameters.txt", "".join("%s\t%s\n"%(key, value)
+                                             for (key, value) in IMGT_PARAMETERS))
+
+# Write a JSON array of objects, one object per record, with the fields of the
+# given classes.
+def writeJSON(path, fields, num_records, record_function):
+    with open(path, "w") as file_handle:
+        file_handle.write("[\n")
+        for index in range(num_records):
+            if index > 0:
+                file_handle.write(",\n")
+            file_handle.write(json.dumps(record_function(index, fields)))
+        file_handle.write("\n]\n")
+
+def generateCell(mapping, options, path):
+    fields = getFileFields(mapping, ["Cell", "IR_Cell"], "airr", options.ireceptor_tag)
+    generator = RecordGenerator(options.seed, options.clonality)
+    def cell(index, fields):
+        record = dict()
+        for (name, field, airr_type, is_array) in fields:
+            if field == "cell_id":
+                value = "cell%d"%(index)
+            elif field in ["rearrangements", "receptors"]:
+                value = ["%s%d"%(field, 2*index), "%s%d"%(field, 2*index + 1)]
+            else:
+                value = generator.typedValue(airr_type, True)
+            if is_array and not isinstance(value, list):
+                value = [value]
+            record[name] = value
+        return record
+    writeJSON(path, fields, options.records, cell)
+
+# Each cell has expression values for a set of genes.
+def generateExpression(mapping, options, path):
+    fields = getFileFields(mapping, ["CellExpression", "IR_Expression"], "airr",
+                           options.ireceptor_tag)
+    generator = RecordGenerator(options.seed, options.clonality)
+    genes_per_cell = 20
+    def expression(index, fields):
+        record = dict()
+        for (name, field, airr_type, is_array) in fields:
+            if field == "expression_id":
+                value = "expression%d"%(index)
+            elif field == "cell_id":
+                value = "cell%d"%(index//genes_per_cell)
+            elif field == "property":
+                gene = generator.random.randrange(2000)
+                value = {"id": "ENSG%011d"%(gene), "label": "GENE%d"%(gene)}
+            elif field == "value":
+                value = round(generator.random.random()*10, 3)
+            else:
+                value = generator.typedValue(airr_type, True)
+            record[name] = value
+        return record
+    writeJSON(path, fields, options.records, expression)
+
+GENERATORS = {
+    "airr": generateAIRR,
+    "mixcr": generateMiXCR,
+    "adaptive": generateAdaptive,
+    "imgt": generateIMGT,
+    "cell": generateCell,
+    "expression": generateExpression,
+}
+
+#####################################################################################
+# In-process sink
+#####################################################################################
+
+# A stand in for a Mongo collection that implements the small part of the
+# pymongo Collection interface used by the Repository during a load. The
+# repertoire collection keeps its documents so that the repertoire can be
+# found and updated, annotation collections only count the records written so
+# that the memory of the sink doesn't grow with the size of the load.
+class SinkCollection:
+    def __init__(self, name, keep_documents):
+        self.name = name
+        self.keep_documents = keep_documents
+        self.documents = []
+        self.count = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def matches(document, query):
+        for field, condition in query.items():
+            if isinstance(condition, dict) and "$eq" in condition:
+                condition = condition["$eq"]
+            value = document.get(field)
+            if isinstance(value, list) and not isinstance(condition, list):
+                if not condition in value:
+                    return False
+            elif value != condition:
+                return False
+        return True
+
+    def find(self, query=None, projection=None, **kwargs):
+        query = query or dict()
+        return SinkCursor([document for document in self.documents
+                           if SinkCollection.matches(document, query)])
+
+    def find_one(self, query=None, projection=None, **kwargs):
+        return next(iter(self.find(query)), None)
+
+    def count_documents(self, query, **kwargs):
+        if not self.keep_documents and len(query) == 0:
+            return self.count
+        return len(self.find(query).documents)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        documents = list(documents)
+        for document in documents:
+            if not "_id" in document:
+                document["_id"] = ObjectId()
+        with self.lock:
+            self.count = self.count + len(documents)
+            if self.keep_documents:
+                self.documents.extend(documents)
+        return SinkResult(inserted_ids=[document["_id"] for document in documents])
+
+    def insert(self, documents, **kwargs):
+        if isinstance(documents, dict):
+            return self.insert_many([documents]).inserted_ids[0]
+        return self.insert_many(documents).inserted_ids
+
+    def insert_one(self, document, **kwargs):
+        return SinkResult(inserted_id=self.insert_many([document]).inserted_ids[0])
+
+    @staticmethod
+    def apply(document, update):
+        for field, value in update.get("$set", {}).items():
+            document[field] = value
+        for field, value in update.get("$inc", {}).items():
+            document[field] = document.get(field, 0) + value
+
+    def update_one(self, query, update, upsert=False, **kwargs):
+        for document in self.find(query):
+            SinkCollection.apply(document, update)
+            return SinkResult(matched_count=1, upserted_count=0)
+        if upsert and self.keep_documents:
+            document = dict(query)
+            SinkCollection.apply(document, update)
+            self.insert_many([document])
+        return SinkResult(matched_count=0, upserted_count=1 if upsert else 0)
+
+    def update(self, query, update, **kwargs):
+        return self.update_one(query, update, **kwargs)
+
+    def find_one_and_update(self, query, update, projection=None, **kwargs):
+        for document in self.find(query):
+            SinkCollection.apply(document, update)
+            return document
+        return None
+
+    # Bulk writes (e.g. of stats) are counted but not stored.
+    def bulk_write(self, operations, ordered=True, **kwargs):
+        with self.lock:
+            self.count = self.count + len(operations)
+        return SinkResult(matched_count=0, upserted_count=len(operations))
+
+    def index_information(self):
+        return {"_id_": {"key": [("_id", 1)]}}
+
+# A stand in for a pymongo cursor over a list of documents.
+class SinkCursor:
+    def __init__(self, documents):
+        self.documents = documents
+        self.iterator = iter(documents)
+
+    def sort(self, *args, **kwargs):
+        return self
+
+    def limit(self, limit):
+        if limit > 0:
+            self.documents = self.documents[:limit]
+            self.iterator = iter(self.documents)
+        return self
+
+    def count(self):
+        return len(self.documents)
+
+    def __iter__(self):
+        return self.iterator
+
+    def __next__(self):
+        return next(self.iterator)
+
+    def next(self):
+        return next(self.iterator)
+
+# The result of a sink write, with the attributes of the pymongo results used
+# by the Repository.
+class SinkResult:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+# A stand in for a pymongo Database and MongoClient.
+class SinkDatabase:
+    def __init__(self, repertoire_collection):
+        self.repertoire_collection = repertoire_collection
+        self.collections = dict()
+
+    def __getitem__(self, name):
+        if not name in self.collections:
+            self.collections[name] = SinkCollection(name,
+                                                    name == self.repertoire_collection)
+        return self.collections[name]
+
+class SinkClient:
+    def __init__(self, repertoire_collection):
+        self.database = SinkDatabase(repertoire_collection)
+
+    def __getitem__(self, name):
+        return self.database
+
+    def get_database(self, name, **kwargs):
+        return self.database
+
+#####################################################################################
+# Running a load
+#####################################################################################
+
+# Wrap a Repository method so that the time spent in it is added to a stage.
+def timeMethod(method, stage, stage_times, lock):
+    def timed(*args, **kwargs):
+        t_start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            with lock:
+                stage_times[stage] = stage_times.get(stage, 0.0) + (time.perf_counter() - t_start)
+    return timed
+
+# The current and peak resident set size of this process in MB, or None if
+# they can't be determined.
+def getRSS():
+    try:
+        with open("/proc/self/statm") as file_handle:
+            pages = int(file_handle.read().split()[1])
+        return pages*os.sysconf("SC_PAGE_SIZE")/1e6
+    except (OSError, ValueError, IndexError):
+        return None
+
+def getPeakRSS():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes.
+    if sys.platform == "darwin":
+        return peak/1e6
+    return peak*1024/1e6
+
+def createRepository(options, mongo_client):
+    return Repository(options.user, options.password, options.host, options.port,
+                      options.database, options.repertoire_collection,
+                      options.rearrangement_collection, options.clone_collection,
+                      options.cell_collection, options.expression_collection,
+                      options.receptor_collection, options.reactivity_collection,
+                      False, False, False,
+                      write_concurrency=options.write_concurrency,
+                      mongo_client=mongo_client)
+
+# Load a single file in this process, returning the result dictionary. This
+# is run in its own process by runCase().
+def loadFile(options, file_format, path):
+    result = {"format": file_format, "file": os.path.basename(path),
+              "file_size": os.path.getsize(path), "status": "failed"}
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        airr_map = AIRRMap(False)
+        if airr_map.readMapFile(options.mapfile) is False:
+            result["error"] = "Could not read the AIRR Mapping file"
+            return result
+
+        mongo_client = None
+        if options.sink == "memory":
+            mongo_client = SinkClient(options.repertoire_collection)
+        repository = createRepository(options, mongo_client)
+        if getattr(repository, "rearrangement", None) is None:
+            result["error"] = "Could not connect to the repository"
+            return result
+
+        parser_class = FORMATS[file_format][0]
+        parser = parser_class(False, options.database_map, options.database_chunk,
+                              airr_map, repository)
+        if options.pipeline_depth > 0 and hasattr(parser, "setInsertPipeline"):
+            parser.setInsertPipeline(options.pipeline_depth, options.pipeline_writers)
+        if options.stats and hasattr(parser, "setLoadStats"):
+            parser.setLoadStats(True)
+
+        # Start with empty collections and a repertoire for the file.
+        if options.sink == "mongo":
+            for collection in [repository.repertoire, repository.rearrangement,
+                               repository.cell, repository.expression, repository.stat]:
+                collection.delete_many({})
+        ireceptor_tag = parser.getiReceptorTag()
+        repository_tag = parser.getRepositoryTag()
+        repertoire = {
+            airr_map.getMapping(parser.getRepertoireLinkIDField(),
+                                ireceptor_tag, repository_tag): REPERTOIRE_LINK_ID,
+            airr_map.getMapping(parser.getRepertoireFileField(),
+                                ireceptor_tag, repository_tag): [os.path.basename(path)]}
+        for field in ["repertoire_id", "data_processing_id", "sample_processing_id"]:
+            repository_field = airr_map.getMapping(field, ireceptor_tag, repository_tag,
+                                                   airr_map.getRepertoireClass())
+            if not repository_field is None:
+                repertoire[repository_field] = field + "_benchmark"
+        repository.repertoire.insert_one(repertoire)
+
+        # Time the Repository calls that make up the stages of the load.
+        stage_times = dict()
+        stage_lock = threading.Lock()
+        for method_name, stage in REPOSITORY_STAGES.items():
+            setattr(repository, method_name,
+                    timeMethod(getattr(repository, method_name), stage,
+                               stage_times, stage_lock))
+
+        baseline_rss = getRSS()
+        t_start = time.perf_counter()
+        try:
+            success = parser.process(path)
+        except Exception as err:
+            print("ERROR: Load failed with %s: %s"%(type(err).__name__, err))
+            success = False
+        load_time = time.perf_counter() - t_start
+        peak_rss = getPeakRSS()
+
+    if not success:
+        result["error"] = " ".join([line for line in log.getvalue().splitlines()
+                                    if line.startswith("ERROR")][-3:])
+        return result
+
+    records = repository.getInsertCount()
+    # The time not spent in the repository is the time to read and transform
+    # the records. With an insert pipeline the writes overlap the parsing, so
+    # the stages add up to more than the load time.
+    stage_times = {stage: round(value, 6) for stage, value in stage_times.items()}
+    repository_time = sum(stage_times.values())
+    if options.pipeline_depth == 0:
+        stage_times["parse"] = round(max(0.0, load_time - repository_time), 6)
+    result.update({"status": "loaded",
+                   "records": records,
+                   "load_time": round(load_time, 6),
+                   "records_per_second": round(records/load_time, 1) if load_time > 0 else 0.0,
+                   "stages": stage_times,
+                   "baseline_rss_mb": None if baseline_rss is None else round(baseline_rss, 1),
+                   "peak_rss_mb": None if peak_rss is None else round(peak_rss, 1)})
+    return result
+
+# Run the load of a file in a new process, so that the peak RSS is for the
+# load alone.
+def runCase(options, file_format, path):
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes=1, maxtasksperchild=1) as pool:
+        return pool.apply(loadFile, (options, file_format, path))
+
+# Get the git commit of the loader being benchmarked, if it is in a git tree.
+def getCommit():
+    try:
+        output = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                cwd=DATALOAD_DIR, capture_output=True, text=True)
+    except OSError:
+        return ""
+    return output.stdout.strip() if output.returncode == 0 else ""
+
+def getArguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the throughput of the data loader parsers."
+    )
+    parser.add_argument("mapfile",
+                        help="The AIRR Mapping file used by the loader (e.g. /app/config/AIRR-iReceptorMapping.txt).")
+    parser.add_argument("--formats", dest="formats", nargs="+", default=list(FORMATS),
+                        choices=list(FORMATS),
+                        help="The formats to benchmark. Defaults to all of them.")
+    parser.add_argument("--records", dest="records", type=int, default=100000,
+                        help="Number of records in each synthetic file. Defaults to 100000.")
+    parser.add_argument("--clonality", dest="clonality", type=float, default=0.3,
+                        help="Fraction of rearrangements that repeat an earlier junction. Defaults to 0.3.")
+    parser.add_argument("--seed", dest="seed", type=int, default=1,
+                        help="Random seed for the synthetic data. Defaults to 1.")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=1,
+                        help="Number of times to load each file, the best run is reported. Defaults to 1.")
+    parser.add_argument("--workdir", dest="workdir", default="loader_benchmark_data",
+                        help="Directory for the synthetic files. Existing files are reused unless --regenerate is given. Defaults to 'loader_benchmark_data'.")
+    parser.add_argument("--regenerate", dest="regenerate", action="store_true",
+                        help="Generate the synthetic files even if they exist.")
+    parser.add_argument("--output", dest="output", default="loader_benchmark.json",
+                        help="The JSON file the results are written to. Defaults to 'loader_benchmark.json'.")
+    parser.add_argument("--baseline", dest="baseline", default="",
+                        help="A results file from an earlier run to compare the throughput with.")
+    parser.add_argument("--sink", dest="sink", default="memory", choices=["memory", "mongo"],
+                        help="Where the records are written, an in-process sink (memory) or a Mongo server (mongo). Defaults to memory.")
+    parser.add_argument("--ireceptor_tag", dest="ireceptor_tag", default="ir_id",
+                        help="The iReceptor field name column of the AIRR Mapping. Defaults to 'ir_id'.")
+    parser.add_argument("--database_map", dest="database_map", default="ir_repository",
+                        help="The repository column of the AIRR Mapping. Defaults to 'ir_repository'.")
+    parser.add_argument("--database_chunk", dest="database_chunk", type=int, default=100000,
+                        help="Number of records to process in a chunk. Defaults to 100000.")
+    parser.add_argument("--pipeline_depth", dest="pipeline_depth", type=int, default=0,
+                        help="The insert pipeline queue depth for rearrangement files (see dataloader.py). Defaults to 0.")
+    parser.add_argument("--pipeline_writers", dest="pipeline_writers", type=int, default=1,
+                        help="The number of insert pipeline writers. Defaults to 1.")
+    parser.add_argument("--write_concurrency", dest="write_concurrency", type=int, default=1,
+                        help="The number of concurrent insert batches (see dataloader.py). Defaults to 1.")
+    parser.add_argument("--stats", dest="stats", action="store_true",
+                        help="Compute the repertoire stats during the load of rearrangement files.")
+    parser.add_argument("--host", dest="host", default="localhost",
+                        help="MongoDb server hostname for --sink mongo. Defaults to 'localhost'.")
+    parser.add_argument("--port", dest="port", default=27017, type=int,
+                        help="MongoDb server port number. Defaults to 27017.")
+    parser.add_argument("-u", "--user", dest="user",
+                        default=os.environ.get("MONGODB_SERVICE_USER", ""),
+                        help="MongoDb user name. Defaults to the MONGODB_SERVICE_USER environment variable.")
+    parser.add_argument("-p", "--password", dest="password",
+                        default=os.environ.get("MONGODB_SERVICE_SECRET", ""),
+                        help="MongoDb password. Defaults to the MONGODB_SERVICE_SECRET environment variable.")
+    parser.add_argument("-d", "--database", dest="database", default="loader_benchmark",
+                        help="Scratch database to use for --sink mongo. Defaults to 'loader_benchmark'.")
+    options = parser.parse_args()
+    # The benchmark uses the standard collection names.
+    options.repertoire_collection = "sample"
+    options.rearrangement_collection = "sequence"
+    options.clone_collection = "clone"
+    options.cell_collection = "cell"
+    options.expression_collection = "expression"
+    options.receptor_collection = "receptor"
+    options.reactivity_collection = "reactivity"
+    return options
+
+if __name__ == "__main__":
+    options = getArguments()
+
+    mapping = pd.read_csv(options.mapfile, sep="\t")
+    os.makedirs(options.workdir, exist_ok=True)
+
+    baseline = dict()
+    if not options.baseline == "":
+        with open(options.baseline, "r") as file_handle:
+            baseline = {result["format"]: result
+                        for result in json.load(file_handle)["results"]}
+
+    results = []
+    for file_format in options.formats:
+        path = os.path.join(options.workdir, FORMATS[file_format][2])
+        generate_time = None
+        if options.regenerate or not os.path.isfile(path):
+            t_start = time.perf_counter()
+            GENERATORS[file_format](mapping, options, path)
+            generate_time = round(time.perf_counter() - t_start, 6)
+            print("Info: Generated %s file %s (%d records), %f s"%
+                  (file_format, path, options.records, generate_time), flush=True)
+
+        # Keep the fastest of the runs.
+        result = None
+        for run in range(options.repeat):
+            run_result = runCase(options, file_format, path)
+            if (result is None or not run_result["status"] == "loaded" or
+                run_result["load_time"] < result["load_time"]):
+                result = run_result
+            if not result["status"] == "loaded":
+                break
+        result["generate_time"] = generate_time
+        results.append(result)
+
+        if not result["status"] == "loaded":
+            print("ERROR: Unable to load %s file, %s"%(file_format, result.get("error", "")))
+            continue
+        stages = ", ".join("%s %.3f s"%(stage, value)
+                           for stage, value in sorted(result["stages"].items()))
+        print("Info: %s: %d records, %.3f s, %.1f records/s, peak RSS %s MB (baseline %s MB)"%
+              (file_format, result["records"], result["load_time"],
+               result["records_per_second"], result["peak_rss_mb"],
+               result["baseline_rss_mb"]))
+        print("Info:     stages: %s"%(stages))
+        if file_format in baseline and baseline[file_format].get("status") == "loaded":
+            previous = baseline[file_format]["records_per_second"]
+            if previous > 0:
+                print("Info:     %.1f%% records/s compared with %s (%.1f records/s)"%
+                      (100.0*(result["records_per_second"] - previous)/previous,
+                       options.baseline, previous))
+        sys.stdout.flush()
+
+    summary = {"benchmark": "loader",
+               "commit": getCommit(),
+               "date": Parser.getDateTimeNowUTC(),
+               "platform": platform.platform(),
+               "python": platform.python_version(),
+               "options": {key: value for key, value in vars(options).items()
+                           if not key in ["user", "password"]},
+               "results": results}
+    with open(options.output, "w") as file_handle:
+        json.dump(summary, file_handle, indent=2)
+    print("Info: Wrote results to %s"%(options.output))
+
+    if not all([result["status"] == "loaded" for result in results]):
+        sys.exit(1)
@@ -0,0 +1,397 @@
+# Query benchmark for an iReceptor repository. This runs the same catalogue of
+# queries as test_performance_explain.js (junction length, junction substring
+# and the V/D/J gene, family and call queries for IGH and TRB) against the
+# rearrangement collection, along with similar queries against the clone, cell
+# and expression collections. Rather than running the queries one at a time
+# through the mongo shell, each query is run for every repertoire in the
+# collection by a number of concurrent clients, which is closer to the load a
+# repository sees from the API.
+#
+# For each query the benchmark reports:
+#   - the p50/p95/p99 latency and the number of queries per second
+#   - the number of documents (and index keys) examined and returned, from
+#     the Mongo explain of each query, along with the query plan stages used
+#   - the number of WiredTiger cache pages read while the query was running
+#     (from serverStatus), and the cache hit ratio
+#
+# The benchmark only reads from the repository. The results are written to a
+# JSON file (--output), with the indexes on each collection at the time the
+# queries were run.
+#
+# Usage: python3 query_benchmark.py --host localhost -d ireceptor --clients 8
+
+import sys
+import os
+import copy
+import json
+import math
+import time
+import argparse
+import datetime
+import platform
+import subprocess
+import urllib.parse
+import concurrent.futures
+import pymongo
+
+# The gene queries, for both B-Cell (IGH) and T-Cell (TRB) genes. These are
+# the gene queries from test_performance_explain.js.
+GENE_QUERIES = {
+    # B-Cell V-Gene
+    "vgene_family_igh": {"ir_vgene_family": "IGHV2"},
+    "vgene_gene_igh": {"ir_vgene_gene": "IGHV2-5"},
+    "v_call_igh": {"v_call": "IGHV2-5*08"},
+    # B-Cell D-Gene
+    "dgene_family_igh": {"ir_dgene_family": "IGHD2"},
+    "dgene_gene_igh": {"ir_dgene_gene": "IGHD2-21"},
+    "d_call_igh": {"d_call": "IGHD2-21*02"},
+    # B-Cell J-Gene
+    "jgene_family_igh": {"ir_jgene_family": "IGHJ4"},
+    "jgene_gene_igh": {"ir_jgene_gene": "IGHJ4"},
+    "j_call_igh": {"j_call": "IGHJ4*02"},
+    # T-Cell V-Gene
+    "vgene_family_trb": {"ir_vgene_family": "TRBV20"},
+    "vgene_gene_trb": {"ir_vgene_gene": "TRBV20-1"},
+    "v_call_trb": {"v_call": "TRBV20-1*01"},
+    # T-Cell D-Gene
+    "dgene_family_trb": {"ir_dgene_family": "TRBD2"},
+    "dgene_gene_trb": {"ir_dgene_gene": "TRBD2"},
+    "d_call_trb": {"d_call": "TRBD2*01"},
+    # T-Cell J-Gene
+    "jgene_family_trb": {"ir_jgene_family": "TRBJ2"},
+    "jgene_gene_trb": {"ir_jgene_gene": "TRBJ2-3"},
+    "j_call_trb": {"j_call": "TRBJ2-3*01"}
+}
+
+# The queries for each type of collection, keyed on the query name. Each query
+# is run once per repertoire, with the repertoire ID added to the query.
+QUERIES = {
+    "rearrangement": dict([
+        ("total", {}),
+        # Junction Length
+        ("equals_9", {"ir_junction_aa_length": 9}),
+        ("equals_15", {"ir_junction_aa_length": 15}),
+        # Junction substring
+        ("junction", {"ir_substring": "CASSQVGTGVY"})] +
+        list(GENE_QUERIES.items())),
+    "clone": dict([
+        ("total", {}),
+        ("junction", {"ir_substring": "CASSQVGTGVY"})] +
+        list(GENE_QUERIES.items())),
+    "cell": {
+        "total": {},
+        "virtual_pairing": {"virtual_pairing": True},
+        "expression_study_method": {"expression_study_method": "flow_cytometry"}
+    },
+    "expression": {
+        "total": {},
+        "property_id": {"property_id": "ENSG00000010610"},
+        "property": {"property": "CD4"},
+        "property_value": {"property": "CD4", "value": {"$gt": 0}}
+    }
+}
+
+# Compute the given percentile (0 to 100) of a list of values, interpolating
+# between the closest ranks. Returns None for an empty list.
+def percentile(values, percent):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * percent / 100.0
+    lower = int(math.floor(rank))
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+# Get the number of pages read into the WiredTiger cache and the number of
+# pages requested from the cache. Returns None if the server does not report
+# them (e.g. it is not using the WiredTiger storage engine or the user does
+# not have permission to run serverStatus).
+def getCacheStats(mongo_db):
+    try:
+        status = mongo_db.command("serverStatus")
+    except pymongo.errors.PyMongoError as err:
+        print("Warning: Unable to get the server status, %s"%(err))
+        return None
+    cache = status.get("wiredTiger", dict()).get("cache", dict())
+    if not "pages read into cache" in cache:
+        return None
+    return {"pages_read": cache["pages read into cache"],
+            "pages_requested": cache.get("pages requested from the cache", 0)}
+
+# Get the difference between two sets of cache stats, with the hit ratio.
+def getCacheDelta(start, end):
+    if start is None or end is None:
+        return None
+    pages_read = end["pages_read"] - start["pages_read"]
+    pages_requested = end["pages_requested"] - start["pages_requested"]
+    hit_ratio = None
+    if pages_requested > 0:
+        hit_ratio = round(1.0 - pages_read/pages_requested, 6)
+    return {"pages_read": pages_read, "pages_requested": pages_requested,
+            "hit_ratio": hit_ratio}
+
+# Get the query plan stages used by the winning plan of an explain, from the
+# top level stage down (e.g. COUNT>COUNT_SCAN).
+def getPlanStages(plan):
+    stages = []
+    while isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        if "inputStage" in plan:
+            plan = plan["inputStage"]
+        elif "inputStages" in plan:
+            stages.append("(" + ",".join([getPlanStages(input_plan)
+                                          for input_plan in plan["inputStages"]]) + ")")
+            break
+        elif "queryPlan" in plan:
+            plan = plan["queryPlan"]
+        else:
+            break
+    return ">".join(stages)
+
+# Run a single query, returning the time it took and the number of documents
+# found. The count operation uses the count command, as the mongo shell count()
+# in test_performance_explain.js does, the find operation retrieves all of the
+# documents found.
+def runQuery(mongo_db, collection_name, query, operation):
+    t_start = time.perf_counter()
+    if operation == "count":
+        count = int(mongo_db.command("count", collection_name, query=query)["n"])
+    else:
+        count = 0
+        for _ in mongo_db[collection_name].find(query):
+            count = count + 1
+    return time.perf_counter() - t_start, count
+
+# Explain a single query, returning the documents and keys examined, the
+# number of documents returned and the query plan stages used.
+def explainQuery(mongo_db, collection_name, query, operation):
+    if operation == "count":
+        command = {"count": collection_name, "query": query}
+    else:
+        command = {"find": collection_name, "filter": query}
+    explanation = mongo_db.command("explain", command, verbosity="executionStats")
+    execution_stats = explanation.get("executionStats", dict())
+    query_planner = explanation.get("queryPlanner", dict())
+    return {"docs_examined": execution_stats.get("totalDocsExamined", 0),
+            "keys_examined": execution_stats.get("totalKeysExamined", 0),
+            "returned": execution_stats.get("nReturned", 0),
+            "plan": getPlanStages(query_planner.get("winningPlan"))}
+
+# Run a query for all of the repertoires with the given number of concurrent
+# clients, repeat times for each repertoire. Returns the results for the query.
+def benchmarkQuery(mongo_db, executor, collection_name, repertoire_field,
+                   repertoire_ids, query, options):
+    queries = []
+    for repertoire_id in repertoire_ids:
+        repertoire_query = copy.deepcopy(query)
+        repertoire_query[repertoire_field] = repertoire_id
+        queries.append(repertoire_query)
+
+    if options.warmup:
+        list(executor.map(lambda repertoire_query:
+                          runQuery(mongo_db, collection_name, repertoire_query,
+                                   options.operation), queries))
+
+    # Time the queries, tracking the cache pages read while they run.
+    cache_start = getCacheStats(mongo_db)
+    t_start = time.perf_counter()
+    timings = list(executor.map(lambda repertoire_query:
+                                runQuery(mongo_db, collection_name, repertoire_query,
+                                         options.operation),
+                                queries * options.repeat))
+    wall_time = time.perf_counter() - t_start
+    cache = getCacheDelta(cache_start, getCacheStats(mongo_db))
+
+    latencies = [latency for latency, _ in timings]
+    counts = [count for _, count in timings[:len(queries)]]
+    result = {"queries": len(timings),
+              "wall_time": round(wall_time, 6),
+              "queries_per_second": round(len(timings)/wall_time, 3) if wall_time > 0 else None,
+              "p50": percentile(latencies, 50),
+              "p95": percentile(latencies, 95),
+              "p99": percentile(latencies, 99),
+              "max": max(latencies) if len(latencies) > 0 else None,
+              "found": sum(counts),
+              "cache": cache,
+              "repertoires": {str(repertoire_id): count
+                              for repertoire_id, count in zip(repertoire_ids, counts)}}
+
+    # Explain each of the queries, after the timing so that the explains do
+    # not affect the latencies.
+    if not options.skip_explain:
+        explanations = [explainQuery(mongo_db, collection_name, repertoire_query,
+                                     options.operation) for repertoire_query in queries]
+        result["docs_examined"] = sum([explanation["docs_examined"]
+                                       for explanation in explanations])
+        result["keys_examined"] = sum([explanation["keys_examined"]
+                                       for explanation in explanations])
+        # The count command does not return documents, the documents returned
+        # for a count are the documents counted.
+        if options.operation == "count":
+            result["returned"] = result["found"]
+        else:
+            result["returned"] = sum([explanation["returned"]
+                                      for explanation in explanations])
+        result["plans"] = sorted(set([explanation["plan"]
+                                      for explanation in explanations]))
+    return result
+
+# Get the git commit of the benchmark, so the results can be tracked across
+# repository changes.
+def getCommit():
+    try:
+        output = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True)
+    except OSError:
+        return ""
+    return output.stdout.strip() if output.returncode == 0 else ""
+
+def getArguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the queries on an iReceptor repository with concurrent clients."
+    )
+    parser.add_argument("--host", dest="host", default="localhost",
+                        help="MongoDb server hostname. Defaults to 'localhost'.")
+    parser.add_argument("--port", dest="port", default=27017, type=int,
+                        help="MongoDb server port number. Defaults to 27017.")
+    parser.add_argument("-u", "--user", dest="user",
+                        default=os.environ.get("MONGODB_SERVICE_USER", ""),
+                        help="MongoDb user name. Defaults to the MONGODB_SERVICE_USER environment variable.")
+    parser.add_argument("-p", "--password", dest="password",
+                        default=os.environ.get("MONGODB_SERVICE_SECRET", ""),
+                        help="MongoDb password. Defaults to the MONGODB_SERVICE_SECRET environment variable.")
+    parser.add_argument("-d", "--database", dest="database", default="ireceptor",
+                        help="The database to query. Defaults to 'ireceptor'.")
+    parser.add_argument("--collections", dest="collections", nargs="+",
+                        default=list(QUERIES.keys()), choices=list(QUERIES.keys()),
+                        help="The types of collection to query. Defaults to all of them.")
+    parser.add_argument("--query_names", dest="query_names", nargs="+", default=[],
+                        help="Only run the queries with these names (e.g. v_call_igh junction). Defaults to all of the queries.")
+    parser.add_argument("--rearrangement_collection", dest="rearrangement_collection",
+                        default="sequence",
+                        help="The rearrangement collection. Defaults to 'sequence'.")
+    parser.add_argument("--clone_collection", dest="clone_collection", default="clone",
+                        help="The clone collection. Defaults to 'clone'.")
+    parser.add_argument("--cell_collection", dest="cell_collection", default="cell",
+                        help="The cell collection. Defaults to 'cell'.")
+    parser.add_argument("--expression_collection", dest="expression_collection",
+                        default="expression",
+                        help="The expression collection. Defaults to 'expression'.")
+    parser.add_argument("--repertoire_field", dest="repertoire_field",
+                        default="ir_annotation_set_metadata_id",
+                        help="The field that links the annotations to their repertoire. Defaults to 'ir_annotation_set_metadata_id' (older repositories use 'ir_project_sample_id').")
+    parser.add_argument("--repertoires", dest="repertoires", type=int, default=0,
+                        help="The maximum number of repertoires to query in each collection. Defaults to 0 (all of them).")
+    parser.add_argument("--clients", dest="clients", type=int, default=4,
+                        help="The number of concurrent clients. Defaults to 4.")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=1,
+                        help="The number of times to run each query for each repertoire. Defaults to 1.")
+    parser.add_argument("--operation", dest="operation", default="count",
+                        choices=["count", "find"],
+                        help="Count the documents found by each query (as test_performance_explain.js does) or retrieve them. Defaults to count.")
+    parser.add_argument("--warmup", dest="warmup", action="store_true",
+                        help="Run each query once before it is timed, so that the timings are for a warm cache.")
+    parser.add_argument("--skip_explain", dest="skip_explain", action="store_true",
+                        help="Do not explain the queries.")
+    parser.add_argument("--output", dest="output", default="query_benchmark.json",
+                        help="The JSON file the results are written to. Defaults to 'query_benchmark.json'.")
+    options = parser.parse_args()
+    if options.clients < 1 or options.repeat < 1:
+        parser.error("--clients and --repeat must be at least 1")
+    return options
+
+if __name__ == "__main__":
+    options = getArguments()
+    collection_names = {"rearrangement": options.rearrangement_collection,
+                        "clone": options.clone_collection,
+                        "cell": options.cell_collection,
+                        "expression": options.expression_collection}
+
+    user = urllib.parse.quote_plus(options.user)
+    password = urllib.parse.quote_plus(options.password)
+    if len(user) == 0 and len(password) == 0:
+        uri = 'mongodb://%s:%s' % (options.host, options.port)
+    else:
+        uri = 'mongodb://%s:%s@%s:%s' % (user, password, options.host, options.port)
+    # The clients share the connection pool, which needs a connection for each.
+    mongo_client = pymongo.MongoClient(uri, maxPoolSize=max(100, options.clients))
+    mongo_db = mongo_client[options.database]
+    try:
+        server_version = mongo_client.server_info()["version"]
+    except pymongo.errors.PyMongoError as err:
+        print("ERROR: Unable to connect to %s:%s, %s"%(options.host, options.port, err))
+        sys.exit(1)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=options.clients)
+    cache_start = getCacheStats(mongo_db)
+    if cache_start is None:
+        print("Warning: WiredTiger cache stats not available, cache pages will not be reported")
+    t_start = time.perf_counter()
+    results = []
+    collections = dict()
+    for collection_type in options.collections:
+        collection_name = collection_names[collection_type]
+        collection = mongo_db[collection_name]
+        repertoire_ids = sorted(collection.distinct(options.repertoire_field), key=str)
+        if options.repertoires > 0:
+            repertoire_ids = repertoire_ids[:options.repertoires]
+        if len(repertoire_ids) == 0:
+            print("Warning: No repertoires found in collection %s (%s), skipping"%
+                  (collection_name, options.repertoire_field))
+            continue
+        indexes = [index["key"] for index in collection.index_information().values()]
+        collections[collection_name] = {"repertoires": len(repertoire_ids),
+                                        "indexes": [json.dumps(index) for index in indexes]}
+        print("Info: Collection %s, %d repertoires, %d indexes"%
+              (collection_name, len(repertoire_ids), len(indexes)))
+
+        for query_name, query in QUERIES[collection_type].items():
+            if len(options.query_names) > 0 and not query_name in options.query_names:
+                continue
+            result = benchmarkQuery(mongo_db, executor, collection_name,
+                                    options.repertoire_field, repertoire_ids,
+                                    query, options)
+            result.update({"collection_type": collection_type,
+                           "collection": collection_name,
+                           "query_name": query_name,
+                           "query": json.dumps(query)})
+            results.append(result)
+
+            print("Info:     %s: %d queries, p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, %.1f queries/s, %d found"%
+                  (query_name, result["queries"], 1000*result["p50"],
+                   1000*result["p95"], 1000*result["p99"],
+                   result["queries_per_second"] or 0, result["found"]))
+            if "plans" in result:
+                print("Info:         %d docs examined, %d keys examined, %d returned, plans %s"%
+                      (result["docs_examined"], result["keys_examined"],
+                       result["returned"], " ".join(result["plans"])))
+            if not result["cache"] is None:
+                print("Info:         %d cache pages read, %d requested"%
+                      (result["cache"]["pages_read"], result["cache"]["pages_requested"]))
+            sys.stdout.flush()
+    executor.shutdown()
+    total_time = time.perf_counter() - t_start
+    cache = getCacheDelta(cache_start, getCacheStats(mongo_db))
+
+    print("Info: Total query time = %f s"%(total_time))
+    if not cache is None:
+        print("Info: Cache pages read = %d, cache pages requested = %d, cache hit ratio = %s"%
+              (cache["pages_read"], cache["pages_requested"], cache["hit_ratio"]))
+
+    summary = {"benchmark": "query",
+               "commit": getCommit(),
+               "date": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+               "platform": platform.platform(),
+               "python": platform.python_version(),
+               "server_version": server_version,
+               "options": {key: value for key, value in vars(options).items()
+                           if not key in ["user", "password"]},
+               "total_time": round(total_time, 6),
+               "cache": cache,
+               "collections": collections,
+               "results": results}
+    with open(options.output, "w") as file_handle:
+        json.dump(summary, file_handle, indent=2)
+    print("Info: Wrote results to %s"%(options.output))
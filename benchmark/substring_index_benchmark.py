@@ -0,0 +1,188 @@
+# Benchmark for the junction_aa substring search field layouts used by the
+# data loader (see --substring_layout in dataload/dataloader.py). Generates a
+# set of synthetic rearrangements, loads them into a scratch collection of a
+# Mongo database with each layout, and compares the index size, load time and
+# substring query latency of the layouts.
+#
+# Note: the benchmark drops and recreates the scratch collections in the
+# database given, it should not be run against a production database.
+#
+# Usage: python3 substring_index_benchmark.py --host localhost --records 100000
+
+import sys
+import os
+import time
+import random
+import argparse
+import statistics
+import urllib.parse
+import pymongo
+
+# The data loader modules use flat imports from the dataload directory.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "dataload"))
+from annotation import Annotation
+
+# Fields used in the scratch collections. The kmer layout is stored in its
+# own field, derived from the legacy field.
+SUBSTRING_FIELD = "ir_substring"
+JUNCTION_AA_FIELD = "junction_aa"
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+# Generate num_records CDR3 like junction_aa values. A fraction of the
+# records are repeats of earlier junctions, as in a clonal repertoire.
+def generateJunctions(num_records, clonality, seed):
+    random.seed(seed)
+    junctions = []
+    for i in range(num_records):
+        if i > 0 and random.random() < clonality:
+            junctions.append(junctions[random.randrange(i)])
+        else:
+            middle = "".join(random.choice(AMINO_ACIDS)
+                             for _ in range(random.randint(6, 16)))
+            junctions.append("CASS" + middle + random.choice(["YF", "QYF", "TQYF"]))
+    return junctions
+
+# Get the field the substring search field is stored in for the given layout.
+def getSubstringField(layout):
+    if layout == "kmer":
+        return Annotation.get_kmer_field(SUBSTRING_FIELD)
+    return SUBSTRING_FIELD
+
+# Generate the substring search field for each junction with the given layout.
+def generateSubstrings(junctions, layout, kmer_length):
+    if layout == "kmer":
+        return [Annotation.get_kmers(junction, kmer_length) for junction in junctions]
+    return [Annotation.get_substring(junction) for junction in junctions]
+
+# Load the junctions into the collection using the given layout, returning the
+# time taken to generate the substrings and to insert the records.
+def loadCollection(collection, junctions, layout, kmer_length, chunk_size):
+    substring_field = getSubstringField(layout)
+    collection.drop()
+    collection.create_index(substring_field)
+    t_generate = 0.0
+    t_insert = 0.0
+    for start in range(0, len(junctions), chunk_size):
+        chunk = junctions[start:start + chunk_size]
+        t_start = time.perf_counter()
+        substrings = generateSubstrings(chunk, layout, kmer_length)
+        records = [{JUNCTION_AA_FIELD: junction, substring_field: substring}
+                   for junction, substring in zip(chunk, substrings)]
+        t_generate = t_generate + (time.perf_counter() - t_start)
+        t_start = time.perf_counter()
+        collection.insert_many(records, ordered=False)
+        t_insert = t_insert + (time.perf_counter() - t_start)
+    return t_generate, t_insert
+
+# Run each query repeat times, returning the median time per query and the
+# number of records found.
+def timeQuery(collection, query, repeat):
+    times = []
+    count = 0
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        count = collection.count_documents(query)
+        times.append(time.perf_counter() - t_start)
+    return statistics.median(times), count
+
+def getArguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the junction_aa substring search field layouts."
+    )
+    parser.add_argument("--host", dest="host", default="localhost",
+                        help="MongoDb server hostname. Defaults to 'localhost'.")
+    parser.add_argument("--port", dest="port", default=27017, type=int,
+                        help="MongoDb server port number. Defaults to 27017.")
+    parser.add_argument("-u", "--user", dest="user",
+                        default=os.environ.get("MONGODB_SERVICE_USER", ""),
+                        help="MongoDb user name. Defaults to the MONGODB_SERVICE_USER environment variable.")
+    parser.add_argument("-p", "--password", dest="password",
+                        default=os.environ.get("MONGODB_SERVICE_SECRET", ""),
+                        help="MongoDb password. Defaults to the MONGODB_SERVICE_SECRET environment variable.")
+    parser.add_argument("-d", "--database", dest="database",
+                        default="substring_benchmark",
+                        help="Scratch database to use. Defaults to 'substring_benchmark'.")
+    parser.add_argument("--records", dest="records", type=int, default=100000,
+                        help="Number of synthetic rearrangements. Defaults to 100000.")
+    parser.add_argument("--clonality", dest="clonality", type=float, default=0.3,
+                        help="Fraction of rearrangements that repeat an earlier junction. Defaults to 0.3.")
+    parser.add_argument("--kmer_length", dest="kmer_length", type=int, default=4,
+                        help="The k-mer length for the kmer layout. Defaults to 4.")
+    parser.add_argument("--chunk", dest="chunk", type=int, default=10000,
+                        help="Number of records per insert. Defaults to 10000.")
+    parser.add_argument("--queries", dest="queries", type=int, default=20,
+                        help="Number of random substring queries. Defaults to 20.")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=5,
+                        help="Number of times to run each query. Defaults to 5.")
+    parser.add_argument("--seed", dest="seed", type=int, default=1,
+                        help="Random seed for the synthetic data. Defaults to 1.")
+    parser.add_argument("--keep", dest="keep", action="store_true",
+                        help="Keep the scratch collections rather than dropping them at the end.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    options = getArguments()
+    layouts = ["legacy", "kmer"]
+
+    junctions = generateJunctions(options.records, options.clonality, options.seed)
+
+    # The substrings to search for. We include the query used by
+    # test_performance_explain.js and random substrings of the junctions of
+    # varying lengths.
+    substrings = ["CASSQVGTGVY"]
+    for _ in range(options.queries):
+        junction = random.choice(junctions)
+        length = random.randint(4, min(12, len(junction)))
+        start = random.randint(0, len(junction) - length)
+        substrings.append(junction[start:start + length])
+
+    user = urllib.parse.quote_plus(options.user)
+    password = urllib.parse.quote_plus(options.password)
+    if len(user) == 0 and len(password) == 0:
+        uri = 'mongodb://%s:%s' % (options.host, options.port)
+    else:
+        uri = 'mongodb://%s:%s@%s:%s' % (user, password, options.host, options.port)
+    mongo_client = pymongo.MongoClient(uri)
+    mongo_db = mongo_client[options.database]
+
+    results = dict()
+    for layout in layouts:
+        collection = mongo_db["substring_" + layout]
+        t_generate, t_insert = loadCollection(collection, junctions, layout,
+                                              options.kmer_length, options.chunk)
+        stats = mongo_db.command("collstats", collection.name)
+        index_size = stats["indexSizes"].get(getSubstringField(layout) + "_1", 0)
+        entries = sum([len(substring) for substring in
+                       generateSubstrings(junctions, layout, options.kmer_length)])
+
+        query_times = []
+        counts = []
+        for substring in substrings:
+            query = Annotation.get_substring_query(substring, SUBSTRING_FIELD,
+                                                   JUNCTION_AA_FIELD, layout,
+                                                   options.kmer_length)
+            query_time, count = timeQuery(collection, query, options.repeat)
+            query_times.append(query_time)
+            counts.append(count)
+        results[layout] = counts
+
+        print("Info: %s layout"%(layout))
+        print("Info:     substring entries = %d (%.1f per record)"%
+              (entries, entries/options.records))
+        print("Info:     %s index size = %.1f MB, data size = %.1f MB"%
+              (getSubstringField(layout), index_size/1e6, stats["size"]/1e6))
+        print("Info:     load time = %f s (substrings %f s, insert %f s)"%
+              (t_generate + t_insert, t_generate, t_insert))
+        print("Info:     query latency median = %f s, max = %f s over %d substrings"%
+              (statistics.median(query_times), max(query_times), len(substrings)))
+        if not options.keep:
+            collection.drop()
+
+    # The layouts should find the same records for every substring.
+    for substring, legacy_count, kmer_count in zip(substrings, results["legacy"],
+                                                   results["kmer"]):
+        if legacy_count != kmer_count:
+            print("Warning: %s found %d records with legacy layout, %d with kmer layout"%
+                  (substring, legacy_count, kmer_count))
@@ -5,7 +5,6 @@ import sys
 import os.path
 import pandas as pd
 import numpy as np 
-import json
 import gzip
 import time
 
@@ -13,7 +12,101 @@ from rearrangement import Rearrangement
 from parser import Parser
 
 class Adaptive(Rearrangement):
-    
+
+    # The conversion tables used by convertGeneCall, built once when the class
+    # is loaded rather than on every call.
+    #
+    # The string replacements that convert an Adaptive gene call to the IMGT
+    # nomenclature, applied in order.
+    gene_call_replacements = (
+        # Change the TCR with TR as per IMGT nomenclature
+        ("TCR", "TR"),
+        # Handle the incorrect mapping of orphon gene names
+        ("-or", "/OR"),
+        # Handle the leading 0 in orphon gene names
+        ("/OR0", "/OR"),
+        # Handle the use of _ rather than - in orphon gene names
+        ("_", "-"),
+        # Get rid of the 0 prefix in the gene if necessary. Note this has to
+        # be done after the previous step or we miss the 0s that are with orphons
+        ("-0", "-"),
+        # Get rid of the 0 prefix on the gene family if necessary
+        ("TRBV0", "TRBV"),
+        ("TRAV0", "TRAV"),
+        ("TRBD0", "TRBD"),
+        ("TRAD0", "TRAD"),
+        ("TRBJ0", "TRBJ"),
+        ("TRAJ0", "TRAJ"),
+        ("IGHV0", "IGHV"),
+        ("IGLV0", "IGLV"),
+        ("IGKV0", "IGKV"),
+        ("IGHD0", "IGHD"),
+        ("IGLD0", "IGLD"),
+        ("IGKD0", "IGKD"),
+        ("IGHJ0", "IGHJ"),
+        ("IGLJ0", "IGLJ"),
+        ("IGKJ0", "IGKJ"),
+    )
+    # Adaptive uses incorrect gene names when the correct IMGT/HUGO names do not
+    # have sub-families (e.g. TRBV1 there is no TRBV1-1). We need a mapping to
+    # do this for TRBV since it is non-trivial.
+    # TODO add mappings for other loci to make applicable to all chains
+    # TODO transfer to supplementary file to make it easier to change?
+    adaptive_v_convert = {
+        'TRBV1-1': 'TRBV1',
+        'TRBV2-1': 'TRBV2',
+        'TRBV9-1': 'TRBV9',
+        'TRBV13-1': 'TRBV13',
+        'TRBV14-1': 'TRBV14',
+        'TRBV15-1': 'TRBV15',
+        'TRBV16-1': 'TRBV16',
+        'TRBV17-1': 'TRBV17',
+        'TRBV18-1': 'TRBV18',
+        'TRBV19-1': 'TRBV19',
+        'TRBV26-1': 'TRBV26',
+        'TRBV27-1': 'TRBV27',
+        'TRBV28-1': 'TRBV28',
+        'TRBV30-1': 'TRBV30',
+        'TRAV14-1': 'TRAV14/DV4',
+        'TRAV23-1': 'TRAV23/DV6',
+        'TRAV29-1': 'TRAV29/DV5',
+        'TRAV36-1': 'TRAV36/DV7',
+        'TRAV10-1': 'TRAV10',
+        'TRAV11-1': 'TRAV11',
+        'TRAV15-1': 'TRAV15',
+        'TRAV16-1': 'TRAV16',
+        'TRAV17-1': 'TRAV17',
+        'TRAV18-1': 'TRAV18',
+        'TRAV19-1': 'TRAV19',
+        'TRAV2-1': 'TRAV2',
+        'TRAV20-1': 'TRAV20',
+        'TRAV21-1': 'TRAV21',
+        'TRAV22-1': 'TRAV22',
+        'TRAV24-1': 'TRAV24',
+        'TRAV25-1': 'TRAV25',
+        'TRAV27-1': 'TRAV27',
+        'TRAV28-1': 'TRAV28',
+        'TRAV3-1': 'TRAV3',
+        'TRAV30-1': 'TRAV30',
+        'TRAV31-1': 'TRAV31',
+        'TRAV32-1': 'TRAV32',
+        'TRAV33-1': 'TRAV33',
+        'TRAV34-1': 'TRAV34',
+        'TRAV35-1': 'TRAV35',
+        'TRAV37-1': 'TRAV37',
+        'TRAV39-1': 'TRAV39',
+        'TRAV4-1': 'TRAV4',
+        'TRAV40-1': 'TRAV40',
+        'TRAV41-1': 'TRAV41',
+        'TRAV46-1': 'TRAV46',
+        'TRAV5-1': 'TRAV5',
+        'TRAV6-1': 'TRAV6',
+        'TRAV7-1': 'TRAV7',
+        'TRDV1-1': 'TRDV1',
+        'TRDV2-1': 'TRDV2',
+        'TRDV3-1': 'TRDV3'
+    }
+
     # Static method do map Adaptive missing data values to AIRR 
     # null values.
     @staticmethod
@@ -146,34 +239,10 @@ class Adaptive(Rearrangement):
     # consistent with IMGT nomenclature. Sheesh, this is UGLY!!!
     @staticmethod
     def convertGeneCall(gene_call):
-        # Change the TCR with TR as per IMGT nomenclature
-        gene_call = gene_call.replace("TCR", "TR")
-        # Handle the incorrect mapping of orphon gene names
-        gene_call = gene_call.replace("-or", "/OR")
-        # Handle the leading 0 in orphon gene names
-        gene_call = gene_call.replace("/OR0", "/OR")
-        # Handle the use of _ rather than - in orphon gene names
-        gene_call = gene_call.replace("_", "-")
-        # Get rid of the 0 prefix in the gene if necessary. Note this has to 
-        # be done after the previous step or we miss the 0s that are with orphons
-        gene_call = gene_call.replace("-0", "-")
-        # Get rid of the 0 prefix on the gene family if necessary
-        gene_call = gene_call.replace("TRBV0", "TRBV")
-        gene_call = gene_call.replace("TRAV0", "TRAV")
-        gene_call = gene_call.replace("TRBD0", "TRBD")
-        gene_call = gene_call.replace("TRAD0", "TRAD")
-        gene_call = gene_call.replace("TRBJ0", "TRBJ")
-        gene_call = gene_call.replace("TRAJ0", "TRAJ")
-
-        gene_call = gene_call.replace("IGHV0", "IGHV")
-        gene_call = gene_call.replace("IGLV0", "IGLV")
-        gene_call = gene_call.replace("IGKV0", "IGKV")
-        gene_call = gene_call.replace("IGHD0", "IGHD")
-        gene_call = gene_call.replace("IGLD0", "IGLD")
-        gene_call = gene_call.replace("IGKD0", "IGKD")
-        gene_call = gene_call.replace("IGHJ0", "IGHJ")
-        gene_call = gene_call.replace("IGLJ0", "IGLJ")
-        gene_call = gene_call.replace("IGKJ0", "IGKJ")
+        # Apply the replacements in order, as the later replacements depend on
+        # the earlier ones.
+        for (old_string, new_string) in Adaptive.gene_call_replacements:
+            gene_call = gene_call.replace(old_string, new_string)
 
         # Adaptive uses incorrect gene names when the correct IMGT/HUGO
         # names do not have sub-families (e.g. TRAJ1 there is no TRAJ1-1)
@@ -182,65 +251,9 @@ class Adaptive(Rearrangement):
         # Reused from: https://github.com/JamieHeather/immunoseq2airr/blob/master/immunoseq2airr.py
         if 'TRAJ' in gene_call or 'TRBD' in gene_call:
             gene_call = gene_call.replace('-1', '')
-        # We need a mapping to do this for TRBV since it is non-trivial.
-        # TODO add mappings for other loci to make applicable to all chains
-        # TODO transfer to supplementary file to make it easier to change?
+        # We need a mapping (adaptive_v_convert) to do this for TRBV since it
+        # is non-trivial.
         elif 'TRBV' in gene_call or 'TRAV' in gene_call or 'TRDV' in gene_call:
-
-            adaptive_v_convert = {
-                      'TRBV1-1': 'TRBV1',
-                      'TRBV2-1': 'TRBV2',
-                      'TRBV9-1': 'TRBV9',
-                      'TRBV13-1': 'TRBV13',
-                      'TRBV14-1': 'TRBV14',
-                      'TRBV15-1': 'TRBV15',
-                      'TRBV16-1': 'TRBV16',
-                      'TRBV17-1': 'TRBV17',
-                      'TRBV18-1': 'TRBV18',
-                      'TRBV19-1': 'TRBV19',
-                      'TRBV26-1': 'TRBV26',
-                      'TRBV27-1': 'TRBV27',
-                      'TRBV28-1': 'TRBV28',
-                      'TRBV30-1': 'TRBV30',
-                      'TRAV14-1': 'TRAV14/DV4',
-                      'TRAV23-1': 'TRAV23/DV6',
-                      'TRAV29-1': 'TRAV29/DV5',
-                      'TRAV36-1': 'TRAV36/DV7',
-                      'TRAV10-1': 'TRAV10',
-                      'TRAV11-1': 'TRAV11',
-                      'TRAV15-1': 'TRAV15',
-                      'TRAV16-1': 'TRAV16',
-                      'TRAV17-1': 'TRAV17',
-                      'TRAV18-1': 'TRAV18',
-                      'TRAV19-1': 'TRAV19',
-                      'TRAV2-1': 'TRAV2',
-                      'TRAV20-1': 'TRAV20',
-                      'TRAV21-1': 'TRAV21',
-                      'TRAV22-1': 'TRAV22',
-                      'TRAV24-1': 'TRAV24',
-                      'TRAV25-1': 'TRAV25',
-                      'TRAV27-1': 'TRAV27',
-                      'TRAV28-1': 'TRAV28',
-                      'TRAV3-1': 'TRAV3',
-                      'TRAV30-1': 'TRAV30',
-                      'TRAV31-1': 'TRAV31',
-                      'TRAV32-1': 'TRAV32',
-                      'TRAV33-1': 'TRAV33',
-                      'TRAV34-1': 'TRAV34',
-                      'TRAV35-1': 'TRAV35',
-                      'TRAV37-1': 'TRAV37',
-                      'TRAV39-1': 'TRAV39',
-                      'TRAV4-1': 'TRAV4',
-                      'TRAV40-1': 'TRAV40',
-                      'TRAV41-1': 'TRAV41',
-                      'TRAV46-1': 'TRAV46',
-                      'TRAV5-1': 'TRAV5',
-                      'TRAV6-1': 'TRAV6',
-                      'TRAV7-1': 'TRAV7',
-                      'TRDV1-1': 'TRDV1',
-                      'TRDV2-1': 'TRDV2',
-                      'TRDV3-1': 'TRDV3'
-                      }
             # Now do the conversion. We need to split on , in case we have
             # more than one call.
             gene_list = gene_call.split(',')
@@ -257,15 +270,15 @@ class Adaptive(Rearrangement):
                 if len(gene_bits) == 1:
                     # If we have no allele, check if the gene needs to be fixed and 
                     # fix it if necessary, otherwise keep the original
-                    if gene in adaptive_v_convert:
-                        converted_list = converted_list + [adaptive_v_convert[gene]]
+                    if gene in Adaptive.adaptive_v_convert:
+                        converted_list = converted_list + [Adaptive.adaptive_v_convert[gene]]
                     else:
                         converted_list = converted_list + [gene]
                 elif len(gene_bits) == 2:
                     # If we have an allele, check if the gene needs to be fixed and 
                     # fix it if necessary and then add the allele back on 
-                    if gene_bits[0] in adaptive_v_convert:
-                        converted_list = converted_list + [adaptive_v_convert[gene_bits[0]] + '*' + gene_bits[1]]
+                    if gene_bits[0] in Adaptive.adaptive_v_convert:
+                        converted_list = converted_list + [Adaptive.adaptive_v_convert[gene_bits[0]] + '*' + gene_bits[1]]
                     else:
                         converted_list = converted_list + [gene]
             # After we are done, join the list of genes back together.
@@ -274,7 +287,28 @@ class Adaptive(Rearrangement):
         # Sigh - after cleaning up the massive Adaptive gene calling mess
         # we return what should have been the correct gene call in the first place!!!
         return gene_call
-        
+
+    # Compute the AIRR compliant gene call from the Adaptive resolved,
+    # allele_ties, gene_ties and family_ties values, using the cache of
+    # previously computed calls. An Adaptive file has millions of rows but
+    # only a small number of distinct combinations of these values.
+    def getAdaptiveGeneCall(self, resolved, allele_ties, gene_ties, family_ties):
+        gene_key = (resolved, allele_ties, gene_ties, family_ties)
+        gene_call = self.adaptive_gene_cache.get(gene_key)
+        if gene_call is None:
+            gene_call = Adaptive.convertGeneCall(Adaptive.mapAdaptiveGene(
+                            resolved, allele_ties, gene_ties, family_ties))
+            self.adaptive_gene_cache[gene_key] = gene_call
+        return gene_call
+
+    # Compute the gene call for each row of a data frame, given the resolved,
+    # allele_ties, gene_ties and family_ties columns for the gene.
+    def getAdaptiveGeneCallColumn(self, df, gene_fields):
+        gene_calls = [self.getAdaptiveGeneCall(resolved, allele_ties,
+                                               gene_ties, family_ties)
+                      for (resolved, allele_ties, gene_ties, family_ties)
+                      in zip(*[df[field] for field in gene_fields])]
+        return pd.Series(gene_calls, index=df.index, dtype=object)
 
     def __init__( self, verbose, repository_tag, repository_chunk, airr_map, repository):
         Rearrangement.__init__(self, verbose, repository_tag, repository_chunk, airr_map, repository)
@@ -284,6 +318,9 @@ class Adaptive(Rearrangement):
         # overrideen by the user should they choose to use a differnt set of 
         # columns from the file.
         self.setFileMapping("adaptive")
+        # Cache of the gene calls computed from the Adaptive gene fields, kept
+        # for the whole file.
+        self.adaptive_gene_cache = dict()
 
     def process(self, filewithpath):
 
@@ -316,6 +353,8 @@ class Adaptive(Rearrangement):
             file_handle = open(filewithpath, "r")
             success = self.processAdaptiveFile(file_handle, filename)
 
+        # Clean up the insert pipeline if the file failed part way through.
+        self.stopInsertPipeline()
         return success
 
     def processAdaptiveFile( self, file_handle, filename ):
@@ -353,6 +392,9 @@ class Adaptive(Rearrangement):
             print("ERROR: Could not link file %s to a valid repertoire"%(filename))
             return False
 
+        # Start the stats for the repertoire, if they are computed during the load.
+        self.startLoadStats()
+
         # Get the column of values from the AIRR tag. We only want the
         # Rearrangement related fields.
         map_column = self.getAIRRMap().getIRRearrangementMapColumn(airr_tag)
@@ -406,10 +448,14 @@ class Adaptive(Rearrangement):
 
         # Iterate over the file a chunk at a time. Each chunk is a data frame.
         total_records = 0
-        for df_chunk in df_reader:
+        # Start the insert pipeline, if it is turned on, so that the chunks
+        # are written while the next chunk is being parsed.
+        self.startInsertPipeline()
+        for df_chunk in self.meteredChunks(df_reader):
 
             if self.verbose():
                 print("Info: Processing raw data frame...", flush=True)
+            t_stage = self.startStage()
             # Remap the column names. We need to remap because the columns may be in 
             # a different order in the file than in the column mapping. We leave any
             # non-mapped columns in the data frame as we don't want to discard data.
@@ -438,13 +484,15 @@ class Adaptive(Rearrangement):
                     if self.verbose():
                         print("Info: Missing data in input %s file for %s"
                               %(self.getAnnotationTool(), file_column))
-            
+            self.endStage("rename", t_stage, len(df_chunk))
+
+            t_stage = self.startStage()
             # Build the substring array that allows index for fast searching of
             # Junction AA substrings. Also calculate junction AA length
             junction_aa = airr_map.getMapping("junction_aa",
                                               ireceptor_tag, repository_tag)
-            ir_substring = airr_map.getMapping("ir_substring",
-                                               ireceptor_tag, repository_tag)
+            ir_substring = self.getSubstringField(airr_map.getMapping(
+                               "ir_substring", ireceptor_tag, repository_tag))
             ir_junc_aa_len = airr_map.getMapping("ir_junction_aa_length",
                                                ireceptor_tag, repository_tag)
             if junction_aa in df_chunk:
@@ -454,8 +502,8 @@ class Adaptive(Rearrangement):
                 # We want to process the junction to get rid of missing data. Adaptive
                 # uses na in its junction column to indicate no junction we want this
                 # to be an empty string.
-                df_chunk[ir_substring] = df_chunk[junction_aa].apply(
-                                                 Rearrangement.get_substring)
+                df_chunk[ir_substring] = self.getJunctionSubstringsColumn(
+                                                 df_chunk[junction_aa])
                 if self.verbose():
                     print("Info: Computing junction amino acids length...", flush=True)
                 df_chunk[ir_junc_aa_len] = df_chunk[junction_aa].apply(
@@ -489,21 +537,22 @@ class Adaptive(Rearrangement):
                                                 ireceptor_tag, repository_tag)
             ir_jgene_family = airr_map.getMapping("ir_jgene_family", 
                                                 ireceptor_tag, repository_tag)
+            self.endStage("derive", t_stage, len(df_chunk))
 
+            t_stage = self.startStage()
             # Process the v/d/j_call conversion. Adaptive does not use the IMGT 
             # nomenclature so we need to conver their v/d/j_call values to something
             # that is AIRR compatible.
             # We compute the correct AIRR compliant gene calls from the resolved,
-            # allele_ties, gene_ties, and family_ties fileds for each of V,D,J.
+            # allele_ties, gene_ties, and family_ties fileds for each of V,D,J,
+            # and then convert them to the IMGT nomenclature (convertGeneCall).
             # If these fields doen't exist, we have an error situtation and we 
             # should abort!
             adaptive_vfields = ["ad_v_resolved","ad_v_allele_ties",
                                 "ad_v_gene_ties","ad_v_family_ties"]
             if set(adaptive_vfields).issubset(df_chunk.columns):
-                gene_df_chunk = df_chunk[adaptive_vfields]
-                df_chunk[v_call] = gene_df_chunk.apply(
-                                  lambda x : Adaptive.mapAdaptiveGene(
-                                                 x[0], x[1], x[2], x[3]), axis=1)
+                df_chunk[v_call] = self.getAdaptiveGeneCallColumn(df_chunk,
+                                                                  adaptive_vfields)
             else:
                 print("ERROR: Adaptive fields for computing v_call not present")
                 return False
@@ -511,10 +560,8 @@ class Adaptive(Rearrangement):
             adaptive_dfields = ["ad_d_resolved","ad_d_allele_ties",
                                 "ad_d_gene_ties","ad_d_family_ties"]
             if set(adaptive_dfields).issubset(df_chunk.columns):
-                gene_df_chunk = df_chunk[adaptive_dfields]
-                df_chunk[d_call] = gene_df_chunk.apply(
-                                  lambda x : Adaptive.mapAdaptiveGene(
-                                                 x[0], x[1], x[2], x[3]), axis=1)
+                df_chunk[d_call] = self.getAdaptiveGeneCallColumn(df_chunk,
+                                                                  adaptive_dfields)
             else:
                 print("ERROR: Adaptive fields for computing d_call not present")
                 return False
@@ -522,28 +569,24 @@ class Adaptive(Rearrangement):
             adaptive_jfields = ["ad_j_resolved","ad_j_allele_ties",
                                 "ad_j_gene_ties","ad_j_family_ties"]
             if set(adaptive_jfields).issubset(df_chunk.columns):
-                gene_df_chunk = df_chunk[adaptive_jfields]
-                df_chunk[j_call] = gene_df_chunk.apply(
-                                  lambda x : Adaptive.mapAdaptiveGene(
-                                                 x[0], x[1], x[2], x[3]), axis=1)
+                df_chunk[j_call] = self.getAdaptiveGeneCallColumn(df_chunk,
+                                                                  adaptive_jfields)
             else:
                 print("ERROR: Adaptive fields for computing j_call not present")
                 return False
+            self.endStage("gene", t_stage, len(df_chunk))
 
-            df_chunk[v_call] = df_chunk[v_call].apply(Adaptive.convertGeneCall)
-            df_chunk[d_call] = df_chunk[d_call].apply(Adaptive.convertGeneCall)
-            df_chunk[j_call] = df_chunk[j_call].apply(Adaptive.convertGeneCall)
             # Build the v_call field, as an array if there is more than one gene
             # assignment made by the annotator.
-            self.processGene(df_chunk, v_call, v_call, ir_vgene_gene, ir_vgene_family)
-            self.processGene(df_chunk, j_call, j_call, ir_jgene_gene, ir_jgene_family)
-            self.processGene(df_chunk, d_call, d_call, ir_dgene_gene, ir_dgene_family)
             # If we don't already have a locus (that is the data file didn't provide
             # one) then calculate the locus based on the v_call array.
             locus = airr_map.getMapping("locus", ireceptor_tag, repository_tag)
-            if not locus in df_chunk and v_call in df_chunk:
-                df_chunk[locus] = df_chunk[v_call].apply(Rearrangement.getLocus)
+            self.processGene(df_chunk, v_call, v_call, ir_vgene_gene, ir_vgene_family,
+                             locus)
+            self.processGene(df_chunk, j_call, j_call, ir_jgene_gene, ir_jgene_family)
+            self.processGene(df_chunk, d_call, d_call, ir_dgene_gene, ir_dgene_family)
 
+            t_stage = self.startStage()
             # Assign each record the constant fields for all records in the chunk
             # For Adaptive productive, stop_codon, and vj_in_frame can be calculated
             # from the "frame_type" field which is mapped to productive in the mapping.
@@ -586,6 +629,8 @@ class Adaptive(Rearrangement):
                                                 ireceptor_tag, repository_tag)
             df_chunk[ir_created_at] = now_str
             df_chunk[ir_updated_at] = now_str
+            # The rows were counted in the first derive segment.
+            self.endStage("derive", t_stage)
 
             # Transform the data frame so that it meets the repository type requirements
             if not self.mapToRepositoryType(df_chunk,
@@ -597,28 +642,40 @@ class Adaptive(Rearrangement):
             # Insert the chunk of records into Mongo.
             num_records = len(df_chunk)
             print("Info: Inserting", num_records, "records into Mongo...", flush=True)
-            t_start = time.perf_counter()
-            records = json.loads(df_chunk.T.to_json()).values()
-            self.repositoryInsertRecords(records)
+            t_start = self.startStage()
+            records = self.dataFrameToRecords(df_chunk)
+            self.endStage("serialize", t_start, num_records)
+            if not self.insertRecordChunk(records):
+                return False
             t_end = time.perf_counter()
-            print("Info: Inserted records, time =", (t_end - t_start),
-                  "seconds", flush=True)
+            print("Info: %s records, time ="%(self.getChunkInsertAction()),
+                  (t_end - t_start), "seconds", flush=True)
 
             # Keep track of the total number of records processed.
             total_records = total_records + num_records
             print("Info: Total records so far =", total_records, flush=True)
 
-        # Get the number of annotations for this repertoire 
+        # Wait for any queued chunks to be written before counting.
+        if not self.finishInsertPipeline():
+            return False
+
+        # Increment the cached count field for the repertoire by the number of
+        # annotations inserted for it, rather than counting all of the
+        # annotations that belong to the repertoire. The cached counts can be
+        # reconciled with the annotations in the repository using recount.py.
         if self.verbose():
-            print("Info: Getting the number of annotations for this repertoire")
-        annotation_count = self.repositoryCountRecords(repertoire_link_id)
+            print("Info: Updating the number of annotations for repertoire %s"%
+                  (str(repertoire_link_id)), flush=True)
+        annotation_count = self.repositoryIncrementCount(repertoire_link_id)
         if annotation_count == -1:
-            print("ERROR: invalid annotation count (%d), write failed." %
-                  (annotation_count))
+            print("ERROR: Unable to write annotation count to repository.")
             return False
 
-        # Set the cached ir_sequeunce_count field for the repertoire/sample.
-        self.repositoryUpdateCount(repertoire_link_id, annotation_count)
+        # Write the stats for the rearrangements loaded from the file, if they
+        # were computed during the load.
+        if self.repositoryWriteStats(repertoire_link_id) == -1:
+            print("ERROR: Unable to write repertoire stats to repository.")
+            return False
 
         # Inform on what we added and the total count for the this record.
         t_end_full = time.perf_counter()
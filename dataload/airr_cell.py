@@ -5,13 +5,14 @@ import sys
 import os.path
 import pandas as pd
 import numpy as np 
-import json
 import gzip
 import time
 
 from cell import Cell
 from annotation import Annotation
 from parser import Parser
+from json_array_reader import JSONArrayReader
+from json_validation import UniqueFieldValidator
 
 class AIRR_Cell(Cell):
     
@@ -165,43 +166,48 @@ class AIRR_Cell(Cell):
                     print("Info:    Repository does not support " +
                           str(row[filemap_tag]) + ", not inserting into repository")
 
-        # Load in the JSON file. The file should be an array of Cell objects as
-        # per the AIRR spec.
+        # Stream the JSON file. The file should be an array of Cell objects as
+        # per the AIRR spec. We read the Cell objects one at a time so we never
+        # have to hold the entire file in memory.
         if self.verbose():
-            print("Info: Reading the Cell JSON array", flush=True)
-        try:
-            cell_array = json.load(file_handle)
-        except json.JSONDecodeError as error:
-            print("ERROR: %s"%(error))
-            print("ERROR: Invalid JSON in file %s"%(filename))
-            return False
-        except Exception as error:
-            print("ERROR: %s"%(error))
-            return False
-
-            
-        if self.verbose():
-            print("Info: Read %d Cell objects"%(len(cell_array)), flush=True)
+            print("Info: Checking the Cell JSON array", flush=True)
+        cell_reader = JSONArrayReader(file_handle, filename)
 
         # Check for duplicate barcodes in the file, fail if we find them. We
         # need the barcode to be unique for mapping cells and rearrangements.
-        barcode_list = list()
+        # This is done as a separate pass over the file so that we don't load
+        # any cells from a file with duplicate barcodes.
+        # All duplicates are reported, with their positions in the file.
         barcode_field = airr_map.getMapping('ir_cell_id_cell',
                                              ireceptor_tag, airr_tag)
+        barcode_validator = UniqueFieldValidator(barcode_field)
         # Loop over the cells
-        for cell_dict in cell_array:
-            # If the barcode field is in the dict
-            if barcode_field in cell_dict:
-                # Check to see if we have see it already (is it in barcode_list)
-                if cell_dict[barcode_field] in barcode_list:
-                    print("ERROR: Can't load cells with duplicate barcodes (%s)"%(cell_dict[barcode_field]))
-                    return False
-                else:
-                    barcode_list.append(cell_dict[barcode_field])
+        for position, cell_dict in enumerate(cell_reader):
+            barcode_validator.check(cell_dict, position)
+        if cell_reader.error:
+            return False
+        if barcode_validator.hasDuplicates():
+            barcode_validator.reportDuplicates(filename)
+            print("ERROR: Can't load cells with duplicate barcodes")
+            return False
+        if self.verbose():
+            print("Info: Read %d Cell objects"%(cell_reader.getCount()), flush=True)
 
-        # Iterate over each element in the array 
+        # Rewind the file and iterate over the records, inserting them into the
+        # repository in blocks of chunk_size records.
         total_records = 0
-        for cell_dict in cell_array:
+        block_count = 0
+        block_array = []
+        # The time spent in each stage, accumulated over the records of a block.
+        t_rename = 0.0
+        t_derive = 0.0
+        # Timing stuff
+        t_start = time.perf_counter()
+        t_check = 0.0
+        file_handle.seek(0)
+        cell_reader = JSONArrayReader(file_handle, filename)
+        for cell_dict in self.meteredRecords(cell_reader, chunk_size):
+            t_record = time.perf_counter()
             # Remap the column names. We need to remap because the columns may be in 
             # a different order in the file than in the column mapping. We leave any
             # non-mapped columns in the data frame as we don't want to discard data.
@@ -238,6 +244,9 @@ class AIRR_Cell(Cell):
                               %(self.getAnnotationTool(), cell_column))
             
 
+            t_renamed = time.perf_counter()
+            t_rename = t_rename + (t_renamed - t_record)
+
             rep_cell_link_field = airr_map.getMapping(
                                              cell_link_field,
                                              ireceptor_tag, repository_tag)
@@ -261,6 +270,7 @@ class AIRR_Cell(Cell):
             # Set the relevant IDs for the record being inserted. It updates the dictionary
             # (passed by reference) and returns False if it fails. If it fails, don't
             # load any data.
+            t_local_start = time.perf_counter()
             if (not self.checkIDFieldsJSON(cell_dict,
                                            repertoire_link_field, repertoire_link_id,
                                            repertoire_id_value,
@@ -268,6 +278,8 @@ class AIRR_Cell(Cell):
                                            sample_processing_id_value)):
 
                 return False
+            t_local_end = time.perf_counter()
+            t_check = t_check + (t_local_end - t_local_start)
 
             # Create the created and update values for this block of records. Note that
             # this means that each block of inserts will have the same date.
@@ -281,28 +293,61 @@ class AIRR_Cell(Cell):
             cell_dict[ir_created_at] = now_str
             cell_dict[ir_updated_at] = now_str
 
-            # Insert the chunk of records into Mongo.
-            t_start = time.perf_counter()
-            self.repositoryInsertRecords(cell_dict)
-            t_end = time.perf_counter()
+            t_derive = t_derive + (time.perf_counter() - t_renamed)
+
+            # Insert a chunk of records into the repository if we have a chunk ready.
+            block_array.append(cell_dict)
+            block_count = block_count + 1
+            if block_count == chunk_size:
+                self.addStageTime("rename", t_rename, block_count)
+                self.addStageTime("derive", t_derive, block_count)
+                t_rename = 0.0
+                t_derive = 0.0
+                t_insert_start = time.perf_counter()
+                if not self.repositoryInsertRecords(block_array):
+                    print("ERROR: Unable to write cell records to repository.")
+                    return False
+                t_insert_end = time.perf_counter()
+                t_end = time.perf_counter()
+
+                print("Info: insert time = %f"% (t_insert_end-t_insert_start),flush=True)
+                print("Info: check time = %f"% (t_check),flush=True)
+                print("Info: Inserted %d records, time = %f (%f records/s, %d records so far)"%
+                        (chunk_size, t_end-t_start, chunk_size/(t_end-t_start),
+                        total_records + 1),flush=True)
+                t_check = 0
+                block_count = 0
+                block_array = []
+                t_start = time.perf_counter()
 
             # Keep track of the total number of records processed.
             total_records = total_records + 1
-            if total_records % 1000 == 0:
-                print("Info: Total records so far =", total_records, flush=True)
+        if cell_reader.error:
+            return False
 
-        # Get the number of annotations for this repertoire 
+        # Done the main loop, insert any remaining records that didn't get inserted
+        # as a block.
+        if block_count > 0:
+            self.addStageTime("rename", t_rename, block_count)
+            self.addStageTime("derive", t_derive, block_count)
+            if not self.repositoryInsertRecords(block_array):
+                print("ERROR: Unable to write cell records to repository.")
+                return False
+            t_end = time.perf_counter()
+            print("Info: Inserted %d records, time = %f (%f records/s)"%
+                    (block_count, t_end-t_start, block_count/(t_end-t_start)),flush=True)
+        self.endMetricsChunk()
+
+        # Increment the cached count field for the repertoire by the number of
+        # annotations inserted for it, rather than counting all of the
+        # annotations that belong to the repertoire. The cached counts can be
+        # reconciled with the annotations in the repository using recount.py.
         if self.verbose():
-            print("Info: Getting the number of annotations for this repertoire")
-        annotation_count = self.repositoryCountRecords(repertoire_link_id)
+            print("Info: Updating the number of annotations for repertoire %s"%
+                  (str(repertoire_link_id)), flush=True)
+        annotation_count = self.repositoryIncrementCount(repertoire_link_id)
         if annotation_count == -1:
-            print("ERROR: invalid annotation count (%d), write failed." %
-                  (annotation_count))
-            return False
-
-        # Set the cached cell count field for the repertoire/sample.
-        if not self.repositoryUpdateCount(repertoire_link_id, annotation_count):
-            print("ERROR: Unable to write cell count to repository.")
+            print("ERROR: Unable to write annotation count to repository.")
             return False
 
         # Inform on what we added and the total count for the this record.
@@ -5,13 +5,14 @@ import sys
 import os.path
 import pandas as pd
 import numpy as np 
-import json
 import gzip
 import time
 
 from clone import Clone
 from annotation import Annotation
 from parser import Parser
+from json_array_reader import JSONArrayReader
+from json_validation import UniqueFieldValidator
 
 class AIRR_Clone(Clone):
     
@@ -165,26 +166,35 @@ class AIRR_Clone(Clone):
                     print("Info:    Repository does not support " +
                           str(row[filemap_tag]) + ", not inserting into repository")
 
-        # Load in the JSON file. The file should be an array of Clone objects as
-        # per the AIRR spec.
+        # Stream the JSON file. The file should be an array of Clone objects as
+        # per the AIRR spec. We read the objects one at a time so we never have to
+        # hold the entire file in memory.
         if self.verbose():
             print("Info: Reading the Clone JSON array", flush=True)
-        try:
-            clone_array = json.load(file_handle)
-        except json.JSONDecodeError as error:
-            print("ERROR: %s"%(error))
-            print("ERROR: Invalid JSON in file %s"%(filename))
-            return False
-        except Exception as error:
-            print("ERROR: %s"%(error))
-            return False
+        clone_reader = JSONArrayReader(file_handle, filename)
 
-        if self.verbose():
-            print("Info: Read %d Clone objects"%(len(clone_array)), flush=True)
+        # Track the clone IDs in the file. Rearrangements are linked to clones
+        # through the clone ID, so duplicates within a file are reported.
+        clone_id_field = airr_map.getMapping('clone_id_clone',
+                                             ireceptor_tag, airr_tag)
+        clone_id_validator = UniqueFieldValidator(clone_id_field)
 
-        # Iterate over each element in the array 
+        # Iterate over the records, inserting them into the repository in blocks
+        # of chunk_size records.
         total_records = 0
-        for clone_dict in clone_array:
+        block_count = 0
+        block_array = []
+        # The time spent in each stage, accumulated over the records of a block.
+        t_rename = 0.0
+        t_gene = 0.0
+        t_derive = 0.0
+        # Timing stuff
+        t_start = time.perf_counter()
+        t_check = 0.0
+        for clone_dict in self.meteredRecords(clone_reader, chunk_size):
+            t_record = time.perf_counter()
+            clone_id_validator.check(clone_dict, total_records)
+
             # Remap the column names. We need to remap because the columns may be in 
             # a different order in the file than in the column mapping. We leave any
             # non-mapped columns in the data frame as we don't want to discard data.
@@ -224,6 +234,9 @@ class AIRR_Clone(Clone):
                         print("Info: Missing data in input %s file for %s"
                               %(self.getAnnotationTool(), clone_column))
             
+            t_renamed = time.perf_counter()
+            t_rename = t_rename + (t_renamed - t_record)
+
             # We need to look up the field from an iReceptor perspective. We want the
             # field name in the iReceptor column mapping and map that to the correct
             # field name for the repository we are writing to.
@@ -281,13 +294,16 @@ class AIRR_Clone(Clone):
                 else:
                     print("ERROR: Ambiguous d_call, not storing clone family information.")
 
+            t_genes = time.perf_counter()
+            t_gene = t_gene + (t_genes - t_renamed)
+
             # Process the junction_aa to generate our substring optimization
             junction_aa = airr_map.getMapping("junction_aa",
                                               ireceptor_tag, repository_tag)
-            ir_substring = airr_map.getMapping("ir_substring_clone",
-                                               ireceptor_tag, repository_tag)
+            ir_substring = self.getSubstringField(airr_map.getMapping(
+                               "ir_substring_clone", ireceptor_tag, repository_tag))
             if junction_aa in clone_dict:
-                clone_dict[ir_substring] = Annotation.get_substring(clone_dict[junction_aa])
+                clone_dict[ir_substring] = self.getJunctionSubstrings(clone_dict[junction_aa])
 
             # Get the all important link field that maps repertoires to clones.
             rep_clone_link_field = airr_map.getMapping(
@@ -314,6 +330,7 @@ class AIRR_Clone(Clone):
             # Set the relevant IDs for the record being inserted. It updates the dictionary
             # (passed by reference) and returns False if it fails. If it fails, don't
             # load any data.
+            t_local_start = time.perf_counter()
             if (not self.checkIDFieldsJSON(clone_dict,
                                            repertoire_link_field, repertoire_link_id,
                                            repertoire_id_value,
@@ -321,6 +338,8 @@ class AIRR_Clone(Clone):
                                            sample_processing_id_value)):
 
                 return False
+            t_local_end = time.perf_counter()
+            t_check = t_check + (t_local_end - t_local_start)
 
             # Create the created and update values for this block of records. Note that
             # this means that each block of inserts will have the same date.
@@ -335,29 +354,67 @@ class AIRR_Clone(Clone):
             clone_dict[ir_created_at] = now_str
             clone_dict[ir_updated_at] = now_str
 
-            # Insert the chunk of records into Mongo.
-            t_start = time.perf_counter()
-            self.repositoryInsertRecords(clone_dict)
-            t_end = time.perf_counter()
+            t_derive = t_derive + (time.perf_counter() - t_genes)
+
+            # Insert a chunk of records into the repository if we have a chunk ready.
+            block_array.append(clone_dict)
+            block_count = block_count + 1
+            if block_count == chunk_size:
+                self.addStageTime("rename", t_rename, block_count)
+                self.addStageTime("gene", t_gene, block_count)
+                self.addStageTime("derive", t_derive, block_count)
+                t_rename = 0.0
+                t_gene = 0.0
+                t_derive = 0.0
+                t_insert_start = time.perf_counter()
+                if not self.repositoryInsertRecords(block_array):
+                    print("ERROR: Unable to write clone records to repository.")
+                    return False
+                t_insert_end = time.perf_counter()
+                t_end = time.perf_counter()
+
+                print("Info: insert time = %f"% (t_insert_end-t_insert_start),flush=True)
+                print("Info: check time = %f"% (t_check),flush=True)
+                print("Info: Inserted %d records, time = %f (%f records/s, %d records so far)"%
+                        (chunk_size, t_end-t_start, chunk_size/(t_end-t_start),
+                        total_records + 1),flush=True)
+                t_check = 0
+                block_count = 0
+                block_array = []
+                t_start = time.perf_counter()
 
             # Keep track of the total number of records processed.
-            ####total_records = total_records + num_records
             total_records = total_records + 1
-            if total_records % 1000 == 0:
-                print("Info: Total records so far =", total_records, flush=True)
-
-        # Get the number of annotations for this repertoire 
+        if clone_reader.error:
+            return False
         if self.verbose():
-            print("Info: Getting the number of annotations for this repertoire")
-        annotation_count = self.repositoryCountRecords(repertoire_link_id)
+            print("Info: Read %d Clone objects"%(clone_reader.getCount()), flush=True)
+        clone_id_validator.reportDuplicates(filename, "Warning")
+
+        # Done the main loop, insert any remaining records that didn't get inserted
+        # as a block.
+        if block_count > 0:
+            self.addStageTime("rename", t_rename, block_count)
+            self.addStageTime("gene", t_gene, block_count)
+            self.addStageTime("derive", t_derive, block_count)
+            if not self.repositoryInsertRecords(block_array):
+                print("ERROR: Unable to write clone records to repository.")
+                return False
+            t_end = time.perf_counter()
+            print("Info: Inserted %d records, time = %f (%f records/s)"%
+                    (block_count, t_end-t_start, block_count/(t_end-t_start)),flush=True)
+        self.endMetricsChunk()
+
+        # Increment the cached count field for the repertoire by the number of
+        # annotations inserted for it, rather than counting all of the
+        # annotations that belong to the repertoire. The cached counts can be
+        # reconciled with the annotations in the repository using recount.py.
+        if self.verbose():
+            print("Info: Updating the number of annotations for repertoire %s"%
+                  (str(repertoire_link_id)), flush=True)
+        annotation_count = self.repositoryIncrementCount(repertoire_link_id)
         if annotation_count == -1:
-            print("ERROR: invalid annotation count (%d), write failed." %
-                  (annotation_count))
-            return False
-
-        # Set the cached clone count field for the repertoire/sample.
-        if not self.repositoryUpdateCount(repertoire_link_id, annotation_count):
-            print("ERROR: Unable to write clone count to repository.")
+            print("ERROR: Unable to write annotation count to repository.")
             return False
 
         # Inform on what we added and the total count for the this record.
@@ -5,13 +5,13 @@ import sys
 import os.path
 import pandas as pd
 import numpy as np 
-import json
 import gzip
 import time
 
 from expression import Expression
 from annotation import Annotation
 from parser import Parser
+from json_array_reader import JSONArrayReader
 
 class AIRR_Expression(Expression):
     
@@ -171,23 +171,12 @@ class AIRR_Expression(Expression):
                     print("Info:    Repository does not support " +
                           str(row[filemap_tag]) + ", not inserting into repository")
 
-        # Load in the JSON file. The file should be an array of expression objects as
-        # per the AIRR spec.
+        # Stream the JSON file. The file should be an array of expression objects as
+        # per the AIRR spec. We read the objects one at a time so we never have to
+        # hold the entire file in memory.
         if self.verbose():
             print("Info: Reading the Expression JSON array", flush=True)
-        try:
-            expression_array = json.load(file_handle)
-        except json.JSONDecodeError as error:
-            print("ERROR: %s"%(error))
-            print("ERROR: Invalid JSON in file %s"%(filename))
-            return False
-        except Exception as error:
-            print("ERROR: %s"%(error))
-            return False
-
-        expression_records = len(expression_array)
-        if self.verbose():
-            print("Info: Read %d Expression objects"%(expression_records), flush=True)
+        expression_reader = JSONArrayReader(file_handle, filename)
 
         # Get the fields to use for the created and updated dates
         ir_created_at = airr_map.getMapping("ir_created_at_expression", 
@@ -205,6 +194,9 @@ class AIRR_Expression(Expression):
         total_records = 0
         block_count = 0
         block_array = []
+        # The time spent in each stage, accumulated over the records of a block.
+        t_rename = 0.0
+        t_derive = 0.0
         # Timing stuff
         t_start = time.perf_counter()
         # Left in timing code (commented out) in case we want to go back and optimize.
@@ -232,7 +224,8 @@ class AIRR_Expression(Expression):
         repository_keymap = dict()
 
         # Iterate over the expression records in the array.
-        for airr_expression_dict in expression_array:
+        for airr_expression_dict in self.meteredRecords(expression_reader, chunk_size):
+            t_record = time.perf_counter()
 
             # When we load into an iReceptor repository, we flatten out all AIRR
             # contructs into a simple, flat representation. ir_flatten performs this.
@@ -296,6 +289,9 @@ class AIRR_Expression(Expression):
             #t_local_end = time.perf_counter()
             #t_flatten = t_flatten + (t_local_end - t_local_start)
 
+            t_renamed = time.perf_counter()
+            t_rename = t_rename + (t_renamed - t_record)
+
             # Set the link field to link back to the repertoire object
             airr_expression_dict[rep_expression_link_field] = repertoire_link_id
 
@@ -322,6 +318,8 @@ class AIRR_Expression(Expression):
             airr_expression_dict[ir_created_at] = now_str
             airr_expression_dict[ir_updated_at] = now_str
 
+            t_derive = t_derive + (time.perf_counter() - t_renamed)
+
             # Insert a chunk of records into Mongo if we have a chunk ready.
             #t_local_start = time.perf_counter()
             block_array.append(airr_expression_dict.copy())
@@ -331,6 +329,10 @@ class AIRR_Expression(Expression):
             # We want to insert into mongo in blocks of chunk_size records.
             block_count = block_count + 1
             if block_count == chunk_size:
+                self.addStageTime("rename", t_rename, block_count)
+                self.addStageTime("derive", t_derive, block_count)
+                t_rename = 0.0
+                t_derive = 0.0
                 t_insert_start = time.perf_counter()
                 self.repositoryInsertRecords(block_array)
                 t_insert_end = time.perf_counter()
@@ -341,9 +343,9 @@ class AIRR_Expression(Expression):
                 print("Info: check time = %f"% (t_check),flush=True)
                 #print("Info: append time = %f"% (t_append),flush=True)
                 #print("Info: copy time = %f"% (t_copy),flush=True)
-                print("Info: Inserted %d records, time = %f (%f records/s, %f percent)"%
+                print("Info: Inserted %d records, time = %f (%f records/s, %d records so far)"%
                         (chunk_size, t_end-t_start, chunk_size/(t_end-t_start),
-                        (total_records/expression_records)*100),flush=True)
+                        total_records + 1),flush=True)
                 #t_flatten = 0
                 t_check = 0
                 #t_append = 0
@@ -354,27 +356,32 @@ class AIRR_Expression(Expression):
 
             # Keep track of the total number of records processed.
             total_records = total_records + 1
+        if expression_reader.error:
+            return False
+        if self.verbose():
+            print("Info: Read %d Expression objects"%(expression_reader.getCount()), flush=True)
 
         # Done the main loop, insert any remaining records that didn't get inserted
         # as a block.
         if block_count > 0:
+            self.addStageTime("rename", t_rename, block_count)
+            self.addStageTime("derive", t_derive, block_count)
             self.repositoryInsertRecords(block_array)
             t_end = time.perf_counter()
             print("Info: Inserted %d records, time = %f (%f records/s)"%
                     (block_count, t_end-t_start, block_count/(t_end-t_start)),flush=True)
+        self.endMetricsChunk()
 
-        # Get the number of annotations for this repertoire 
+        # Increment the cached count field for the repertoire by the number of
+        # annotations inserted for it, rather than counting all of the
+        # annotations that belong to the repertoire. The cached counts can be
+        # reconciled with the annotations in the repository using recount.py.
         if self.verbose():
-            print("Info: Getting the number of annotations for this repertoire")
-        annotation_count = self.repositoryCountRecords(repertoire_link_id)
+            print("Info: Updating the number of annotations for repertoire %s"%
+                  (str(repertoire_link_id)), flush=True)
+        annotation_count = self.repositoryIncrementCount(repertoire_link_id)
         if annotation_count == -1:
-            print("ERROR: invalid annotation count (%d), write failed." %
-                  (annotation_count))
-            return False
-
-        # Set the cached expression count field for the repertoire/sample.
-        if not self.repositoryUpdateCount(repertoire_link_id, annotation_count):
-            print("ERROR: Unable to write expression count to repository.")
+            print("ERROR: Unable to write annotation count to repository.")
             return False
 
         # Inform on what we added and the total count for the this record.
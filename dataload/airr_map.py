@@ -22,6 +22,14 @@ class AIRRMap:
         self.ir_expression_class = "IR_Expression"
         self.ir_receptor_class = "IR_Receptor"
         self.ir_reactivity_class = "IR_Reactivity"
+        # The set of valid map classes for getMapping, None is the full mapping.
+        self.map_classes = set([None,
+            self.repertoire_class, self.rearrangement_class, self.clone_class,
+            self.cell_class, self.expression_class, self.receptor_class,
+            self.reactivity_class, self.ir_repertoire_class,
+            self.ir_rearrangement_class, self.ir_clone_class, self.ir_cell_class,
+            self.ir_expression_class, self.ir_receptor_class,
+            self.ir_reactivity_class])
 
         # Keep track of the mapfile being used.
         self.mapfile = ""
@@ -59,6 +67,14 @@ class AIRRMap:
         self.ir_receptor_map = []
         # AIRR and IR reactivity mappings only
         self.ir_reactivity_map = []
+
+        # Hash index used by getMapping, keyed on (map_class, from_column, field)
+        # with the mapping row (as a dictionary) as the value. Built in readMapFile.
+        self.mapping_index = dict()
+        # Keys in the index that have more than one row in the mapping, with
+        # the number of rows for each, and the set of those we have warned about.
+        self.mapping_duplicates = dict()
+        self.mapping_duplicates_reported = set()
         
     # Read in a map file given a file name.
     def readMapFile(self, mapfile):
@@ -185,9 +201,63 @@ class AIRRMap:
         # Get all of the rows that have the AIRR and IR repertoire class labels.
         self.ir_repertoire_map = self.airr_mappings.loc[labels]
 
+        # Build the lookup index for getMapping from the maps above.
+        self.buildMappingIndex()
+
         # Return success if we get here.
         return True
 
+    # Return a dictionary of the mapping to use for each of the map classes that
+    # getMapping accepts. A map_class of None uses the full mapping.
+    def getClassMappings(self):
+        return {None: self.airr_mappings,
+                self.rearrangement_class: self.airr_rearrangement_map,
+                self.clone_class: self.airr_clone_map,
+                self.cell_class: self.airr_cell_map,
+                self.expression_class: self.airr_expression_map,
+                self.receptor_class: self.airr_receptor_map,
+                self.reactivity_class: self.airr_reactivity_map,
+                self.repertoire_class: self.airr_repertoire_map,
+                self.ir_repertoire_class: self.ir_repertoire_map,
+                self.ir_rearrangement_class: self.ir_rearrangement_map,
+                self.ir_clone_class: self.ir_clone_map,
+                self.ir_cell_class: self.ir_cell_map,
+                self.ir_expression_class: self.ir_expression_map,
+                self.ir_receptor_class: self.ir_receptor_map,
+                self.ir_reactivity_class: self.ir_reactivity_map}
+
+    # Build the hash index used by getMapping. For each map class, every value
+    # in every column of the mapping is a key that points to the row it is in,
+    # so a lookup of (map_class, from_column, field) is a single dictionary hit
+    # rather than a scan of the mapping. As with the original scan, if a key
+    # occurs in more than one row the first row is used. Duplicates are counted
+    # here so they only need to be reported once.
+    def buildMappingIndex(self):
+        self.mapping_index = dict()
+        self.mapping_duplicates = dict()
+        self.mapping_duplicates_reported = set()
+
+        # Convert each row of the full mapping to a dictionary once, the class
+        # mappings share rows (and row labels) with the full mapping.
+        rows = self.airr_mappings.to_dict('index')
+        for map_class, mapping in self.getClassMappings().items():
+            for from_column in mapping.columns:
+                for label, value in mapping[from_column].items():
+                    if pd.isnull(value):
+                        continue
+                    key = (map_class, from_column, value)
+                    if key in self.mapping_index:
+                        if key in self.mapping_duplicates:
+                            self.mapping_duplicates[key] += 1
+                        else:
+                            self.mapping_duplicates[key] = 2
+                    else:
+                        self.mapping_index[key] = rows[label]
+
+        if self.verbose:
+            print("Info: Built AIRR mapping index with %d keys (%d duplicate keys)" %
+                  (len(self.mapping_index), len(self.mapping_duplicates)))
+
     # Abstract the class strings for Repertoire and Rearrangements.
     def getRepertoireClass(self):
         return self.repertoire_class
@@ -241,68 +311,34 @@ class AIRRMap:
     # Return the value for the row and column keys provided. If it can't be found
     # None is returned. 
     def getMapping(self, field, from_column, to_column, map_class=None):
-        # Get the mapping to use
-        if map_class is None:
-           mapping = self.airr_mappings
-        elif map_class == self.rearrangement_class: 
-           mapping = self.airr_rearrangement_map
-        elif map_class == self.clone_class: 
-           mapping = self.airr_clone_map
-        elif map_class == self.cell_class: 
-           mapping = self.airr_cell_map
-        elif map_class == self.expression_class: 
-           mapping = self.airr_expression_map
-        elif map_class == self.receptor_class: 
-           mapping = self.airr_receptor_map
-        elif map_class == self.reactivity_class: 
-           mapping = self.airr_reactivity_map
-        elif map_class == self.repertoire_class: 
-           mapping = self.airr_repertoire_map
-        elif map_class == self.ir_repertoire_class: 
-           mapping = self.ir_repertoire_map
-        elif map_class == self.ir_rearrangement_class: 
-           mapping = self.ir_rearrangement_map
-        elif map_class == self.ir_clone_class: 
-           mapping = self.ir_clone_map
-        elif map_class == self.ir_cell_class: 
-           mapping = self.ir_cell_map
-        elif map_class == self.ir_expression_class: 
-           mapping = self.ir_expression_map
-        elif map_class == self.ir_receptor_class: 
-           mapping = self.ir_receptor_map
-        elif map_class == self.ir_reactivity_class: 
-           mapping = self.ir_reactivity_map
-        else:
-            print("Warning: Invalid maping class %s"%(map_class))
+        # Look up the mapping row for the field in the from_column.
+        key = (map_class, from_column, field)
+        try:
+            from_row = self.mapping_index.get(key)
+        except TypeError:
+            # An unhashable field can't be in the mapping.
             return None
 
-        # Check to see if we have a valid from_column, if not return None
-        if not from_column in mapping:
+        # If there is no row, either the class is invalid or we couldn't find it.
+        if from_row is None:
+            if not map_class in self.map_classes:
+                print("Warning: Invalid maping class %s"%(map_class))
             return None
-        # Get the data in the from_column
-        from_column_data = mapping[from_column]
-        # Get a boolean array that is true where we found the field of interest.
-        from_boolean = from_column_data.isin([field])
-        # And extract all rows that have the from key.
-        from_row = mapping.loc[from_boolean]
+
+        # We only return a mapping for unique objects, if there is more than one
+        # row with this field we use the first one. Warn about this once only.
+        if key in self.mapping_duplicates and not key in self.mapping_duplicates_reported:
+            print("Warning: Duplicate AIRR mapping for field %s, using first value - class = %s (%s, %d rows)"%
+                  (field, map_class, from_column, self.mapping_duplicates[key]))
+            self.mapping_duplicates_reported.add(key)
+
         # If we can't find the to_column in the from_row then we couldn't find it
         # because the to_column doesn't exist in our mapping.
         if not to_column in from_row:
             return None
-        # Get the value. This is an object atill so we need to get the values from the
-        # dictionary.
         value = from_row[to_column]
-        # This could be an array. If it is, we only return a mapping for unique objects,
-        # so if there is more than one value return None. If there is one, return it
-        if len(value.values) == 1:
-            if pd.notnull(value.values[0]):
-                return value.values[0]
-            else:
-                return None
-        elif len(value.values) > 1:
-            print("Warning: Duplicate AIRR mapping for field %s, using first value - class = %s (%s -> %s) %s"%
-                  (field, map_class, from_column, to_column, value.values))
-            return value.values[0]
+        if pd.notnull(value):
+            return value
         else:
             return None
 
@@ -5,13 +5,13 @@ import sys
 import os.path
 import pandas as pd
 import numpy as np 
-import json
 import gzip
 import time
 
 from reactivity import Reactivity
 from annotation import Annotation
 from parser import Parser
+from json_array_reader import JSONArrayReader
 
 class AIRR_Reactivity(Reactivity):
     
@@ -166,29 +166,27 @@ class AIRR_Reactivity(Reactivity):
                     print("Info:    Repository does not support " +
                           str(row[filemap_tag]) + ", not inserting into repository")
 
-        # Load in the JSON file. The file should be an array of Reactivity objects as
-        # per the AIRR spec.
+        # Stream the JSON file. The file should be an array of Reactivity objects as
+        # per the AIRR spec. We read the objects one at a time so we never have to
+        # hold the entire file in memory.
         if self.verbose():
             print("Info: Reading the Reactivity JSON array", flush=True)
-        try:
-            reactivity_array = json.load(file_handle)
-        except json.JSONDecodeError as error:
-            print("ERROR: %s"%(error))
-            print("ERROR: Invalid JSON in file %s"%(filename))
-            return False
-        except Exception as error:
-            print("ERROR: %s"%(error))
-            return False
-
-        reactivity_records = len(reactivity_array)
-        if self.verbose():
-            print("Info: Read %d Reactivity objects"%(reactivity_records), flush=True)
-
+        reactivity_reader = JSONArrayReader(file_handle, filename)
 
-        # Iterate over each element in the array 
+        # Iterate over the records, inserting them into the repository in blocks
+        # of chunk_size records.
         total_records = 0
+        block_count = 0
+        block_array = []
+        # The time spent in each stage, accumulated over the records of a block.
+        t_rename = 0.0
+        t_derive = 0.0
+        # Timing stuff
+        t_start = time.perf_counter()
+        t_check = 0.0
         reactivity_class = self.getAIRRMap().getReactivityClass()
-        for reactivity_dict in reactivity_array:
+        for reactivity_dict in self.meteredRecords(reactivity_reader, chunk_size):
+            t_record = time.perf_counter()
             # Remap the column names. We need to remap because the columns may be in 
             # a different order in the file than in the column mapping. We leave any
             # non-mapped columns in the data frame as we don't want to discard data.
@@ -257,6 +255,9 @@ class AIRR_Reactivity(Reactivity):
                         print("Info: Missing data in input %s file for %s"
                               %(self.getAnnotationTool(), reactivity_column))
             
+            t_renamed = time.perf_counter()
+            t_rename = t_rename + (t_renamed - t_record)
+
             # Get the all important link field that maps repertoires to receptors.
             rep_reactivity_link_field = airr_map.getMapping(
                                              reactivity_link_field,
@@ -283,12 +284,15 @@ class AIRR_Reactivity(Reactivity):
             # Set the relevant IDs for the record being inserted. It updates the dictionary
             # (passed by reference) and returns False if it fails. If it fails, don't
             # load any data.
+            t_local_start = time.perf_counter()
             if (not self.checkIDFieldsJSON(reactivity_dict,
                                            repertoire_link_field, repertoire_link_id,
                                            repertoire_id_value,
                                            data_processing_id_value,
                                            sample_processing_id_value)):
                 return False
+            t_local_end = time.perf_counter()
+            t_check = t_check + (t_local_end - t_local_start)
 
             # Create the created and update values for this block of records. Note that
             # this means that each block of inserts will have the same date.
@@ -303,17 +307,54 @@ class AIRR_Reactivity(Reactivity):
             reactivity_dict[ir_created_at] = now_str
             reactivity_dict[ir_updated_at] = now_str
 
-            # Insert the chunk of records into Mongo.
-            t_start = time.perf_counter()
             #print("Info: JSON written =", json.dumps(reactivity_dict), flush=True)
-            self.repositoryInsertRecords(reactivity_dict)
-            t_end = time.perf_counter()
+
+            t_derive = t_derive + (time.perf_counter() - t_renamed)
+
+            # Insert a chunk of records into the repository if we have a chunk ready.
+            block_array.append(reactivity_dict)
+            block_count = block_count + 1
+            if block_count == chunk_size:
+                self.addStageTime("rename", t_rename, block_count)
+                self.addStageTime("derive", t_derive, block_count)
+                t_rename = 0.0
+                t_derive = 0.0
+                t_insert_start = time.perf_counter()
+                if not self.repositoryInsertRecords(block_array):
+                    print("ERROR: Unable to write reactivity records to repository.")
+                    return False
+                t_insert_end = time.perf_counter()
+                t_end = time.perf_counter()
+
+                print("Info: insert time = %f"% (t_insert_end-t_insert_start),flush=True)
+                print("Info: check time = %f"% (t_check),flush=True)
+                print("Info: Inserted %d records, time = %f (%f records/s, %d records so far)"%
+                        (chunk_size, t_end-t_start, chunk_size/(t_end-t_start),
+                        total_records + 1),flush=True)
+                t_check = 0
+                block_count = 0
+                block_array = []
+                t_start = time.perf_counter()
 
             # Keep track of the total number of records processed.
-            ####total_records = total_records + num_records
             total_records = total_records + 1
-            if total_records % 1000 == 0:
-                print("Info: Total records so far =", total_records, flush=True)
+        if reactivity_reader.error:
+            return False
+        if self.verbose():
+            print("Info: Read %d Reactivity objects"%(reactivity_reader.getCount()), flush=True)
+
+        # Done the main loop, insert any remaining records that didn't get inserted
+        # as a block.
+        if block_count > 0:
+            self.addStageTime("rename", t_rename, block_count)
+            self.addStageTime("derive", t_derive, block_count)
+            if not self.repositoryInsertRecords(block_array):
+                print("ERROR: Unable to write reactivity records to repository.")
+                return False
+            t_end = time.perf_counter()
+            print("Info: Inserted %d records, time = %f (%f records/s)"%
+                    (block_count, t_end-t_start, block_count/(t_end-t_start)),flush=True)
+        self.endMetricsChunk()
 
         # Get the number of annotations for this repertoire 
         #if self.verbose():
@@ -12,6 +12,7 @@ import time
 from receptor import Receptor
 from annotation import Annotation
 from parser import Parser
+from json_array_reader import JSONArrayReader
 
 class AIRR_Receptor(Receptor):
     
@@ -166,26 +167,25 @@ class AIRR_Receptor(Receptor):
                     print("Info:    Repository does not support " +
                           str(row[filemap_tag]) + ", not inserting into repository")
 
-        # Load in the JSON file. The file should be an array of Receptor objects as
-        # per the AIRR spec.
+        # Stream the JSON file. The file should be an array of Receptor objects as
+        # per the AIRR spec. We read the objects one at a time so we never have to
+        # hold the entire file in memory.
         if self.verbose():
             print("Info: Reading the Receptor JSON array", flush=True)
-        try:
-            receptor_array = json.load(file_handle)
-        except json.JSONDecodeError as error:
-            print("ERROR: %s"%(error))
-            print("ERROR: Invalid JSON in file %s"%(filename))
-            return False
-        except Exception as error:
-            print("ERROR: %s"%(error))
-            return False
+        receptor_reader = JSONArrayReader(file_handle, filename)
 
-        if self.verbose():
-            print("Info: Read %d Receptor objects"%(len(receptor_array)), flush=True)
-
-        # Iterate over each element in the array 
+        # Iterate over the records, inserting them into the repository in blocks
+        # of chunk_size records.
         total_records = 0
-        for receptor_dict in receptor_array:
+        block_count = 0
+        block_array = []
+        # The time spent in each stage, accumulated over the records of a block.
+        t_rename = 0.0
+        t_derive = 0.0
+        # Timing stuff
+        t_start = time.perf_counter()
+        for receptor_dict in self.meteredRecords(receptor_reader, chunk_size):
+            t_record = time.perf_counter()
             # Remap the column names. We need to remap because the columns may be in 
             # a different order in the file than in the column mapping. We leave any
             # non-mapped columns in the data frame as we don't want to discard data.
@@ -225,6 +225,9 @@ class AIRR_Receptor(Receptor):
                         print("Info: Missing data in input %s file for %s"
                               %(self.getAnnotationTool(), receptor_column))
             
+            t_renamed = time.perf_counter()
+            t_rename = t_rename + (t_renamed - t_record)
+
             # Get the all important link field that maps repertoires to receptors.
             #rep_receptor_link_field = airr_map.getMapping(
             #                                 receptor_link_field,
@@ -270,17 +273,52 @@ class AIRR_Receptor(Receptor):
             receptor_dict[ir_created_at] = now_str
             receptor_dict[ir_updated_at] = now_str
 
-            # Insert the chunk of records into Mongo.
-            t_start = time.perf_counter()
             print("Info: JSON written =", json.dumps(receptor_dict), flush=True)
-            self.repositoryInsertRecords(receptor_dict)
-            t_end = time.perf_counter()
+
+            t_derive = t_derive + (time.perf_counter() - t_renamed)
+
+            # Insert a chunk of records into the repository if we have a chunk ready.
+            block_array.append(receptor_dict)
+            block_count = block_count + 1
+            if block_count == chunk_size:
+                self.addStageTime("rename", t_rename, block_count)
+                self.addStageTime("derive", t_derive, block_count)
+                t_rename = 0.0
+                t_derive = 0.0
+                t_insert_start = time.perf_counter()
+                if not self.repositoryInsertRecords(block_array):
+                    print("ERROR: Unable to write receptor records to repository.")
+                    return False
+                t_insert_end = time.perf_counter()
+                t_end = time.perf_counter()
+
+                print("Info: insert time = %f"% (t_insert_end-t_insert_start),flush=True)
+                print("Info: Inserted %d records, time = %f (%f records/s, %d records so far)"%
+                        (chunk_size, t_end-t_start, chunk_size/(t_end-t_start),
+                        total_records + 1),flush=True)
+                block_count = 0
+                block_array = []
+                t_start = time.perf_counter()
 
             # Keep track of the total number of records processed.
-            ####total_records = total_records + num_records
             total_records = total_records + 1
-            if total_records % 1000 == 0:
-                print("Info: Total records so far =", total_records, flush=True)
+        if receptor_reader.error:
+            return False
+        if self.verbose():
+            print("Info: Read %d Receptor objects"%(receptor_reader.getCount()), flush=True)
+
+        # Done the main loop, insert any remaining records that didn't get inserted
+        # as a block.
+        if block_count > 0:
+            self.addStageTime("rename", t_rename, block_count)
+            self.addStageTime("derive", t_derive, block_count)
+            if not self.repositoryInsertRecords(block_array):
+                print("ERROR: Unable to write receptor records to repository.")
+                return False
+            t_end = time.perf_counter()
+            print("Info: Inserted %d records, time = %f (%f records/s)"%
+                    (block_count, t_end-t_start, block_count/(t_end-t_start)),flush=True)
+        self.endMetricsChunk()
 
         # Get the number of annotations for this repertoire 
         #if self.verbose():
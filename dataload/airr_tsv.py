@@ -9,7 +9,6 @@
 import os.path
 import pandas as pd
 import time
-import json
 import gzip
 import airr
 
@@ -57,6 +56,8 @@ class AIRR_TSV(Rearrangement):
             file_handle = open(filewithpath, "r")
             success = self.processAIRRTSVFile(file_handle, filewithpath)
 
+        # Clean up the insert pipeline if the file failed part way through.
+        self.stopInsertPipeline()
         return success
 
     def processAIRRTSVFile( self, file_handle, path ):
@@ -126,6 +127,9 @@ class AIRR_TSV(Rearrangement):
             print("ERROR: Could not link file %s to a valid repertoire"%(filename))
             return False
 
+        # Start the stats for the repertoire, if they are computed during the load.
+        self.startLoadStats()
+
         # Extract the fields that are of interest for this file. Essentiall all non null
         # fields in the file. This is a boolean array that is T everywhere there is a
         # notnull field in the column of interest.
@@ -179,36 +183,62 @@ class AIRR_TSV(Rearrangement):
                     print("Info: Missing data in input " + self.getAnnotationTool() +
                           " file for " + file_column)
 
-        # Re-create a reader for the data frame with step size "chunk_size"
+        # If checkpoints are turned on, get the number of rows that have already
+        # been written by an earlier load of this file so we can skip them.
+        skip_rows = self.startCheckpoint(path, repertoire_link_id)
+        if skip_rows < 0:
+            print("ERROR: Unable to set up checkpoint for file %s"%(filename))
+            return False
+        if self.checkpointComplete():
+            print("Info: File %s has already been loaded, nothing to resume"%(filename))
+            return True
+
+        # Re-create a reader for the data frame with step size "chunk_size",
+        # skipping any rows that have already been written (but not the header).
         # Handle the case where we have a CSV rather than a TSV.
+        skip_range = range(1, skip_rows + 1)
         if path.endswith(".csv"):
-            airr_df_reader = pd.read_csv(path, chunksize=chunk_size)
+            airr_df_reader = pd.read_csv(path, chunksize=chunk_size,
+                                         skiprows=skip_range)
         else:
-            airr_df_reader = pd.read_csv(path, sep='\t', chunksize=chunk_size)
+            airr_df_reader = pd.read_csv(path, sep='\t', chunksize=chunk_size,
+                                         skiprows=skip_range)
 
         # Iterate over the file with data frames of size "chunk_size"
         if self.verbose():
             print("Info: Processing raw data frame...")
         total_records = 0
-        for airr_df in airr_df_reader:
+        # Start the insert pipeline, if it is turned on, so that the chunks
+        # are written while the next chunk is being parsed.
+        self.startInsertPipeline()
+        for airr_df in self.meteredChunks(airr_df_reader):
+            # A load that is resumed after all of the rows in the file were
+            # written has no rows left to load.
+            if len(airr_df) == 0:
+                continue
+
             # Remap the column names. We need to remap because the columns may be in a 
             # differnt order in the file than in the column mapping.
+            t_stage = self.startStage()
             airr_df.rename(finalMapping, axis='columns', inplace=True)
+            self.endStage("rename", t_stage, len(airr_df))
 
+            # Derive the iReceptor specific fields from the AIRR fields.
+            t_stage = self.startStage()
             # Build the substring array that allows index for fast searching of
             # Junction AA substrings.
             junction_aa = airr_map.getMapping("junction_aa",
                                               ireceptor_tag, repository_tag)
-            ir_substring = airr_map.getMapping("ir_substring",
-                                               ireceptor_tag, repository_tag)
+            ir_substring = self.getSubstringField(airr_map.getMapping(
+                               "ir_substring", ireceptor_tag, repository_tag))
             ir_junc_aa_len = airr_map.getMapping("ir_junction_aa_length",
                                                  ireceptor_tag, repository_tag)
             if junction_aa in airr_df:
                 if self.verbose():
                     print("Info: Retrieving junction AA and building substrings",
                           flush=True)
-                airr_df[ir_substring] = airr_df[junction_aa].apply(
-                                         Rearrangement.get_substring)
+                airr_df[ir_substring] = self.getJunctionSubstringsColumn(
+                                         airr_df[junction_aa])
 
                 # The AIRR TSV format doesn't have AA length, we want it in repository.
                 if not (ir_junc_aa_len in airr_df):
@@ -237,17 +267,19 @@ class AIRR_TSV(Rearrangement):
             ir_jgene_family = airr_map.getMapping("ir_jgene_family",
                                                  ireceptor_tag, repository_tag)
 
+            self.endStage("derive", t_stage, len(airr_df))
+
             # Build the v_call field, as an array if there is more than one gene
             # assignment made by the annotator.
-            self.processGene(airr_df, v_call, v_call, ir_vgene_gene, ir_vgene_family)
+            # If we don't already have a locus (that is the data file didn't provide
+            # one) then calculate the locus based on the v_call array.
+            locus = airr_map.getMapping("locus", ireceptor_tag, repository_tag)
+            self.processGene(airr_df, v_call, v_call, ir_vgene_gene, ir_vgene_family,
+                             locus)
             self.processGene(airr_df, j_call, j_call, ir_jgene_gene, ir_jgene_family)
             self.processGene(airr_df, d_call, d_call, ir_dgene_gene, ir_dgene_family)
-            # If we don't already have a locus (that is the data file didn't provide one) 
-            # then calculate the locus based on the v_call array.
-            locus = airr_map.getMapping("locus", ireceptor_tag, repository_tag)
-            if not locus in airr_df:
-                airr_df[locus] = airr_df[v_call].apply(Rearrangement.getLocus)
 
+            t_stage = self.startStage()
             # Keep track of the reperotire id so can link each rearrangement to
             # a repertoire
             rep_rearrangement_link_field = airr_map.getMapping(rearrangement_link_field,
@@ -302,6 +334,8 @@ class AIRR_TSV(Rearrangement):
                                                  ireceptor_tag, repository_tag)
             airr_df[ir_created_at] = now_str
             airr_df[ir_updated_at] = now_str
+            # The rows were counted in the first derive segment.
+            self.endStage("derive", t_stage)
 
             # Transform the data frame so that it meets the repository type requirements
             if not self.mapToRepositoryType(airr_df,
@@ -313,33 +347,48 @@ class AIRR_TSV(Rearrangement):
             # Insert the chunk of records into Mongo.
             num_records = len(airr_df)
             print("Info: Inserting", num_records, "records into Mongo...", flush=True)
-            t_start = time.perf_counter()
-            records = json.loads(airr_df.T.to_json()).values()
-            self.repositoryInsertRecords(records)
+            t_start = self.startStage()
+            records = self.dataFrameToRecords(airr_df)
+            self.endStage("serialize", t_start, num_records)
+            if not self.insertRecordChunk(records):
+                return False
             t_end = time.perf_counter()
-            print("Info: Inserted records, time =", (t_end - t_start), "seconds",
-                  flush=True)
+            print("Info: %s records, time ="%(self.getChunkInsertAction()),
+                  (t_end - t_start), "seconds", flush=True)
 
             # Keep track of the total number of records processed.
             total_records = total_records + num_records
             print("Info: Total records so far =", total_records, flush=True)
  
-        # Get the number of annotations for this repertoire (as defined by the
-        # repertoire link id
+        # Wait for any queued chunks to be written before counting.
+        if not self.finishInsertPipeline():
+            return False
+
+        # Increment the cached count field for the repertoire by the number of
+        # annotations inserted for it, rather than counting all of the
+        # annotations that belong to the repertoire. The cached counts can be
+        # reconciled with the annotations in the repository using recount.py.
         if self.verbose():
-            print("Info: Getting the number of annotations for repertoire %s"%
-                  (str(repertoire_link_id)))
-        annotation_count = self.repositoryCountRecords(repertoire_link_id)
+            print("Info: Updating the number of annotations for repertoire %s"%
+                  (str(repertoire_link_id)), flush=True)
+        annotation_count = self.repositoryIncrementCount(repertoire_link_id)
         if annotation_count == -1:
-            print("ERROR: invalid annotation count (%d), write failed." %
-                  (annotation_count))
+            print("ERROR: Unable to write annotation count to repository.")
+            return False
+        # Record that the count has been updated, so that if the load fails
+        # from here on a resume doesn't add this load's records to it again.
+        if not self.countCheckpoint():
             return False
 
-        if self.verbose():
-            print("Info: Annotation count = %d" % (annotation_count), flush=True)
+        # Write the stats for the rearrangements loaded from the file, if they
+        # were computed during the load.
+        if self.repositoryWriteStats(repertoire_link_id) == -1:
+            print("ERROR: Unable to write repertoire stats to repository.")
+            return False
 
-        # Set the cached sequence count field for the repertoire.
-        self.repositoryUpdateCount(repertoire_link_id, annotation_count)
+        # Record that the file has been loaded, so a resume doesn't reload it.
+        if not self.finishCheckpoint():
+            return False
 
         # Inform on what we added and the total count for the this record.
         t_end_full = time.perf_counter()
@@ -7,6 +7,9 @@ from datetime import timezone
 import re
 import os
 import time
+import functools
+import threading
+import collections
 import pandas as pd
 import numpy as np
 from parser import Parser
@@ -34,6 +37,30 @@ class Annotation(Parser):
         # key fields, since we access them so often (in particular with JSON records)
         # Cached repo field names cache for specific fields.
         self.repository_field_cache = dict() 
+        # The layout used for the junction_aa substring search field. The legacy
+        # layout stores every substring longer than 3 characters, the kmer
+        # layout stores the unique substrings of length substring_kmer_length
+        # in a separate field (see getSubstringField).
+        self.substring_layout = "legacy"
+        self.substring_kmer_length = 4
+        # Clonal repertoires repeat the same junction_aa many times, so we keep
+        # a bounded least recently used cache of the substrings generated for
+        # each junction_aa across the chunks of a file.
+        self.substring_cache_size = 10000
+        self.substring_cache = functools.lru_cache(
+            maxsize=self.substring_cache_size)(self.computeJunctionSubstrings)
+        # A repertoire has only a few hundred distinct gene call strings, so the
+        # normalized call, gene, family and locus for each raw call string is
+        # computed once and kept for the whole file.
+        self.gene_cache = dict()
+        # The field in the repertoire that caches the number of annotations that
+        # belong to the repertoire. Set by the subclasses.
+        self.annotation_count_field = ""
+        # The number of annotations inserted for each repertoire during this
+        # load. Records can be inserted from more than one thread (see
+        # InsertPipeline) so the counts are updated under a lock.
+        self.inserted_counts = collections.Counter()
+        self.inserted_counts_lock = threading.Lock()
 
         # Get the link field.
         self.repertoire_link_field = self.getRepertoireLinkIDField()
@@ -265,6 +292,66 @@ class Annotation(Parser):
     def getFileMapping(self):
         return self.file_mapping
 
+    # Method to set the layout of the junction_aa substring search field, either
+    # "legacy" or "kmer". Returns False if the layout is not valid.
+    def setSubstringLayout(self, layout, kmer_length=4):
+        if not layout in ["legacy", "kmer"]:
+            print("ERROR: Invalid substring layout %s"%(layout))
+            return False
+        if layout == "kmer" and kmer_length < 1:
+            print("ERROR: Invalid substring k-mer length %d"%(kmer_length))
+            return False
+        self.substring_layout = layout
+        self.substring_kmer_length = kmer_length
+        # Cached substrings for the previous layout are no longer valid.
+        self.substring_cache.cache_clear()
+        return True
+
+    # Method to get the layout of the junction_aa substring search field.
+    def getSubstringLayout(self):
+        return self.substring_layout
+
+    # Method to get the k-mer length used by the kmer substring layout.
+    def getSubstringKmerLength(self):
+        return self.substring_kmer_length
+
+    # Get the repository field to store the junction_aa substring search field
+    # in for the substring layout, given the mapped field of the legacy
+    # layout. The k-mers are stored in their own field so that queries on the
+    # legacy field, which look up whole substrings, never match k-mers.
+    def getSubstringField(self, substring_field):
+        if self.substring_layout == "kmer":
+            return Annotation.get_kmer_field(substring_field)
+        return substring_field
+
+    # Generate the substring search field for a junction_aa value using the
+    # substring layout for this parser.
+    def computeJunctionSubstrings(self, junction_aa):
+        if self.substring_layout == "kmer":
+            return Annotation.get_kmers(junction_aa, self.substring_kmer_length)
+        return Annotation.get_substring(junction_aa)
+
+    # Get the substring search field for a junction_aa value, using the cache
+    # of previously generated values. Note that the lists returned are shared
+    # between calls and should not be modified.
+    def getJunctionSubstrings(self, junction_aa):
+        try:
+            return self.substring_cache(junction_aa)
+        except TypeError:
+            # Unhashable values can't be cached.
+            return self.computeJunctionSubstrings(junction_aa)
+
+    # Get the substring search field for each junction_aa value in a data frame
+    # column. Each unique junction_aa in the column is only processed once, and
+    # null values get an empty list. Returns a column with the same index.
+    def getJunctionSubstringsColumn(self, junction_column):
+        codes, uniques = pd.factorize(junction_column)
+        unique_substrings = [self.getJunctionSubstrings(junction_aa)
+                             for junction_aa in uniques]
+        return pd.Series([unique_substrings[code] if code >= 0 else []
+                          for code in codes],
+                         index=junction_column.index, dtype=object)
+
     @staticmethod
     def get_all_substrings(string):
         if type(string) == float:
@@ -275,13 +362,53 @@ class Annotation(Parser):
                 for j in range(i + 1, length + 1):
                     yield (string[i:j])
 
+    # Return the unique substrings of string that are longer than 3 characters,
+    # in the order they are generated by get_all_substrings.
     @staticmethod
     def get_substring(string):
-        strlist = []
-        for i in Annotation.get_all_substrings(string):
-            if len(i) > 3:
-                strlist.append(i)
-        return strlist
+        if not isinstance(string, str):
+            return []
+        length = len(string)
+        return list(dict.fromkeys([string[i:j] for i in range(length)
+                                   for j in range(i + 4, length + 1)]))
+
+    # Return the field that stores the k-mers of the kmer substring layout,
+    # given the field that stores the substrings of the legacy layout (e.g.
+    # ir_substring_kmer for ir_substring).
+    @staticmethod
+    def get_kmer_field(substring_field):
+        if substring_field is None:
+            return None
+        return substring_field + "_kmer"
+
+    # Return the unique substrings of length kmer_length in string, in the order
+    # they first occur. A string shorter than kmer_length has no k-mers.
+    @staticmethod
+    def get_kmers(string, kmer_length):
+        if not isinstance(string, str):
+            return []
+        return list(dict.fromkeys([string[i:i+kmer_length]
+                                   for i in range(len(string) - kmer_length + 1)]))
+
+    # Build the repository query for the records whose junction_aa_field contains
+    # substring, given the layout and the legacy substring_field. For the legacy
+    # layout this is a lookup of the substring in the substring_field. For the
+    # kmer layout the records with all of the k-mers of the substring in the
+    # k-mer field are the candidates, and these are checked against the
+    # junction_aa_field since having all of the k-mers does not guarantee the
+    # substring is present. A substring shorter than the k-mer length can only
+    # be checked against the junction_aa_field.
+    @staticmethod
+    def get_substring_query(substring, substring_field, junction_aa_field,
+                            layout="legacy", kmer_length=4):
+        if layout == "legacy":
+            return {substring_field: substring}
+        junction_query = {"$regex": re.escape(substring)}
+        if len(substring) < kmer_length:
+            return {junction_aa_field: junction_query}
+        return {Annotation.get_kmer_field(substring_field):
+                    {"$all": Annotation.get_kmers(substring, kmer_length)},
+                junction_aa_field: junction_query}
 
     # Process a gene call to generate the appropriate call, gene, and family
     # fields in teh data frame.
@@ -295,25 +422,84 @@ class Annotation(Parser):
     #                 to be created
     #    - family_tag: a string that represents the column name of the gene tag
     #                 to be created
-    def processGene(self, dataframe, base_tag, call_tag, gene_tag, family_tag):
+    #    - locus_tag: optional, a string that represents the column name of the
+    #                 locus to be created from the gene call. The locus is only
+    #                 created if the data frame doesn't already have this column.
+    def processGene(self, dataframe, base_tag, call_tag, gene_tag, family_tag,
+                    locus_tag=None):
         # Build the gene call field, as an array if there is more than one gene
         # assignment made by the annotator.
             if base_tag in dataframe:
+                t_start = self.startStage()
                 if self.verbose():
-                    print("Info: Constructing %s array from %s"%(call_tag, base_tag), flush=True)
-                dataframe[call_tag] = dataframe[base_tag].apply(Annotation.setGene)
-
-                # Build the vgene_gene field (with no allele)
-                if self.verbose():
-                    print("Info: Constructing %s from %s"%(gene_tag, base_tag), flush=True)
-                dataframe[gene_tag] = dataframe[call_tag].apply(Annotation.setGeneGene)
-
-                # Build the vgene_family field (with no allele and no gene)
-                if self.verbose():
-                    print("Info: Constructing %s from %s"%(family_tag, base_tag), flush=True)
-                dataframe[family_tag] = dataframe[call_tag].apply(Annotation.setGeneFamily)
-
-
+                    print("Info: Constructing %s, %s and %s from %s"%
+                          (call_tag, gene_tag, family_tag, base_tag), flush=True)
+                with_locus = not locus_tag is None and not locus_tag in dataframe
+                normalized = self.getGeneNormalizationColumn(dataframe[base_tag],
+                                                             with_locus)
+                # The call column may be the base column, so only replace the
+                # columns once the normalization is complete.
+                dataframe[call_tag] = pd.Series([gene[0] for gene in normalized],
+                                                index=dataframe.index, dtype=object)
+                dataframe[gene_tag] = pd.Series([gene[1] for gene in normalized],
+                                                index=dataframe.index, dtype=object)
+                dataframe[family_tag] = pd.Series([gene[2] for gene in normalized],
+                                                  index=dataframe.index, dtype=object)
+                if with_locus:
+                    if self.verbose():
+                        print("Info: Constructing %s from %s"%(locus_tag, base_tag),
+                              flush=True)
+                    dataframe[locus_tag] = [gene[3] for gene in normalized]
+                self.endStage("gene", t_start, len(dataframe))
+
+    # Normalize a raw gene call string from an annotation tool, returning a
+    # tuple of the call list (setGene), the gene list (setGeneGene), the family
+    # list (setGeneFamily) and, if with_locus is True, the locus (getLocus).
+    # The result for each call string is cached for the life of the parser.
+    # Note that the lists returned are shared between calls and should not be
+    # modified.
+    def getGeneNormalization(self, gene, with_locus=False):
+        try:
+            normalized = self.gene_cache.get(gene)
+        except TypeError:
+            # Unhashable values can't be cached.
+            return Annotation.normalize_gene(gene, with_locus)
+        if normalized is None:
+            normalized = Annotation.normalize_gene(gene, with_locus)
+            self.gene_cache[gene] = normalized
+        elif with_locus and normalized[3] is None:
+            # Only computed on demand, as the locus only applies to v_calls.
+            normalized = normalized[:3] + (Annotation.getLocus(normalized[0]),)
+            self.gene_cache[gene] = normalized
+        return normalized
+
+    # Normalize each gene call in a data frame column. Each unique call in the
+    # column is only processed once, and null values are treated as empty
+    # calls. Returns a list of normalization tuples, one per row.
+    def getGeneNormalizationColumn(self, gene_column, with_locus=False):
+        try:
+            codes, uniques = pd.factorize(gene_column)
+        except TypeError:
+            # Columns with unhashable values (e.g. lists) can't be factorized.
+            return [self.getGeneNormalization(gene, with_locus)
+                    for gene in gene_column]
+        unique_genes = [self.getGeneNormalization(gene, with_locus)
+                        for gene in uniques]
+        null_gene = None
+        if -1 in codes:
+            null_gene = self.getGeneNormalization(None, with_locus)
+        return [unique_genes[code] if code >= 0 else null_gene for code in codes]
+
+    # Compute the normalization tuple for a raw gene call string, as described
+    # in getGeneNormalization. The locus is None if with_locus is False.
+    @staticmethod
+    def normalize_gene(gene, with_locus=False):
+        call_list = Annotation.setGene(gene)
+        locus = None
+        if with_locus:
+            locus = Annotation.getLocus(call_list)
+        return (call_list, Annotation.setGeneGene(call_list),
+                Annotation.setGeneFamily(call_list), locus)
 
     # A method to take a list of gene assignments from an annotation tool
     # and create an array of strings with just the allele strings without
@@ -421,7 +607,7 @@ class Annotation(Parser):
     # use as this can be used to map both Rearrangement, Clone, and Cell classes.
     def mapToRepositoryType(self, df, map_class, ir_map_class):
         # time this function
-        t_start = time.perf_counter()
+        t_start = self.startStage()
 
         # Get the general information we need to do the mapping
         airr_type_tag = "airr_type"
@@ -448,33 +634,32 @@ class Annotation(Parser):
                 # Get the type of the first element of the column 
                 oldtype = type(column_data.iloc[0])
 
+                # Get the column (vectorized) and scalar converters for the
+                # repository type.
                 if repo_type == "boolean":
-                    # Need to convert to boolean for the repository
-                    df[column]= column_data.apply(Parser.to_boolean)
-                    if self.verbose():
-                        print("Info: Mapped column %s to bool in repository (%s, %s, %s, %s)"%
-                              (column, airr_type, repo_type, oldtype,
-                               type(df[column].iloc[0])))
+                    converters = (Parser.column_to_boolean, Parser.to_boolean, "bool")
                 elif repo_type == "integer":
-                    # Need to convert to integer for the repository
-                    df[column]= column_data.apply(Parser.to_integer)
-                    if self.verbose():
-                        print("Info: Mapped column %s to int in repository (%s, %s, %s, %s)"%
-                              (column, airr_type, repo_type, oldtype,
-                               type(df[column].iloc[0])))
+                    converters = (Parser.column_to_integer, Parser.to_integer, "int")
                 elif repo_type == "number":
-                    # Need to convert to number (float) for the repository
-                    df[column]= column_data.apply(Parser.to_number)
-                    if self.verbose():
-                        print("Info: Mapped column %s to number in repository (%s, %s, %s, %s)"%
-                              (column, airr_type, repo_type, oldtype,
-                               type(df[column].iloc[0])))
+                    converters = (Parser.column_to_number, Parser.to_number, "number")
                 elif repo_type == "string":
-                    # Need to convert to string for the repository
-                    df[column]= column_data.apply(Parser.to_string)
+                    converters = (Parser.column_to_string, Parser.to_string, "string")
+                else:
+                    converters = None
+
+                if not converters is None:
+                    (column_converter, value_converter, type_label) = converters
+                    # Convert the whole column at once if we can, if not fall back
+                    # to converting each value.
+                    converted_data = column_converter(column_data)
+                    if converted_data is None:
+                        if self.verbose():
+                            print("Info: Converting column %s by value" %(column))
+                        converted_data = column_data.apply(value_converter)
+                    df[column] = converted_data
                     if self.verbose():
-                        print("Info: Mapped column %s to string in repository (%s, %s, %s, %s)"%
-                              (column, airr_type, repo_type, oldtype,
+                        print("Info: Mapped column %s to %s in repository (%s, %s, %s, %s)"%
+                              (column, type_label, airr_type, repo_type, oldtype,
                                type(df[column].iloc[0])))
                 else:
                     # No mapping for the repository, which is OK, we don't make any changes
@@ -493,6 +678,7 @@ class Annotation(Parser):
                 return False
 
         t_end = time.perf_counter()
+        self.endStage("type_mapping", t_start, len(df))
         if self.verbose():
             print("Info: Conversion to repository type took %f s"%(t_end - t_start),
                   flush=True)
@@ -521,3 +707,54 @@ class Annotation(Parser):
     def repositoryUpdateCount(self, repertoire_id, count):
         return False
 
+    # Get the field in the repertoire that caches the annotation count.
+    def getAnnotationCountField(self):
+        return self.annotation_count_field
+
+    # Keep track of the number of annotations inserted for each repertoire,
+    # given a set of records that have been written to the repository. The
+    # repertoire is given by the annotation link field of each record.
+    def countInsertedRecords(self, json_records):
+        link_field = self.airr_map.getMapping(self.getAnnotationLinkIDField(),
+                                              self.ireceptor_tag,
+                                              self.repository_tag)
+        counts = collections.Counter([record.get(link_field)
+                                      for record in json_records])
+        with self.inserted_counts_lock:
+            self.inserted_counts.update(counts)
+
+    # Add to the number of annotations inserted for the given repertoire, for
+    # annotations that were inserted by an earlier load.
+    def addInsertedCount(self, repertoire_id, count):
+        with self.inserted_counts_lock:
+            self.inserted_counts[repertoire_id] += count
+
+    # Get the number of annotations inserted for the given repertoire so far.
+    def getInsertedCount(self, repertoire_id):
+        with self.inserted_counts_lock:
+            return self.inserted_counts[repertoire_id]
+
+    # Increment the cached annotation count for the given repertoire by the
+    # number of annotations inserted for it during this load. This is a single
+    # $inc on the repertoire, rather than counting all of the annotations that
+    # belong to the repertoire. Returns the updated count, or -1 on error.
+    def repositoryIncrementCount(self, repertoire_id):
+        repertoire_field = self.airr_map.getMapping(self.getRepertoireLinkIDField(),
+                                                    self.ireceptor_tag,
+                                                    self.repository_tag)
+        count_field = self.airr_map.getMapping(self.getAnnotationCountField(),
+                                               self.ireceptor_tag,
+                                               self.repository_tag)
+        ir_updated_at = self.airr_map.getMapping("ir_updated_at_repertoire",
+                                                 self.ireceptor_tag,
+                                                 self.repository_tag,
+                                                 self.airr_map.getIRRepertoireClass())
+        if count_field is None:
+            print("ERROR: Could not find count field %s in repository"%
+                  (self.getAnnotationCountField()))
+            return -1
+        with self.inserted_counts_lock:
+            count = self.inserted_counts.pop(repertoire_id, 0)
+        return self.repository.incrementField(repertoire_field, repertoire_id,
+                                              count_field, count, ir_updated_at)
+
@@ -25,6 +25,9 @@ class Clone(Annotation):
         # each annotation record. This overrides the Annotation class value for
         # this field.
         self.annotation_linkid_field = "ir_annotation_set_metadata_id_clone"
+        # The field in the repertoire collection that caches the number of
+        # annotations of this type that belong to the repertoire.
+        self.annotation_count_field = self.getCloneCountField()
 
 
     #####################################################################################
@@ -36,31 +39,28 @@ class Clone(Annotation):
     # This is hiding the Mongo implementation. Probably should refactor the 
     # repository implementation completely.
     def repositoryInsertRecords(self, json_records):
-        # Insert the JSON and get a list of IDs back. If no data returned, return an error
-        record_ids = self.repository.insertClones(json_records)
-        if record_ids is None:
-            return False
         # Get the field we want to map for the clone ID for each record.
         clone_id_field =  self.getAIRRMap().getMapping("clone_id_clone",
                                               self.getiReceptorTag(),
                                               self.getRepositoryTag(),
                                               self.getAIRRMap().getCloneClass())
-        ir_updated_at_clone =  self.getAIRRMap().getMapping("ir_updated_at_clone",
-                                              self.getiReceptorTag(),
-                                              self.getRepositoryTag(),
-                                              self.getAIRRMap().getIRCloneClass())
 
-        # If we found a repository record, write a string repersentation of the ID 
-        # returned into the clone_id field.
-        if not clone_id_field is None:
-            # Check to make sure we have a list if a single instance is returned.
-            if not isinstance(record_ids, list):
-                record_ids = [ record_ids ]
-            # Over write the field.
-            for record_id in record_ids:
-                self.repository.updateCloneField("_id", record_id,
-                                                 clone_id_field, str(record_id),
-                                                 ir_updated_at_clone)
+        # Assign the repository ID for each record before we insert, storing a
+        # string repersentation of the ID in the clone_id field. This saves us
+        # from having to update each record after it is inserted.
+        t_start = self.startStage()
+        json_records = self.repository.setRecordIDs(json_records, clone_id_field)
+        self.endStage("id_backfill", t_start, len(json_records))
+
+        # Insert the JSON and get a list of IDs back. If no data returned, return an error
+        t_start = self.startStage()
+        record_ids = self.repository.insertClones(json_records)
+        self.endStage("insert", t_start, len(json_records))
+        if record_ids is None:
+            return False
+
+        # Keep track of the records inserted for each repertoire.
+        self.countInsertedRecords(json_records)
 
         return True
 
@@ -8,11 +8,21 @@ import os
 import argparse
 import time
 import sys
+import glob
+import multiprocessing
 
 # AIRR Mapping class.
 from airr_map import AIRRMap
 # Repository class - hides the DB implementation
 from repository import Repository
+# Annotation base class, parent of the rearrangement, clone, and cell loaders
+from annotation import Annotation
+# Rearrangement base class, parent of the rearrangement loaders
+from rearrangement import Rearrangement
+# Clone base class, parent of the clone loaders
+from clone import Clone
+# Records the time spent in each stage of the load of a file
+from load_metrics import LoadMetrics
 # Repertoire loader classes 
 from ir_repertoire import IRRepertoire
 from airr_repertoire import AIRRRepertoire
@@ -73,6 +83,78 @@ def getArguments():
         help="The annotation tool to be noted for each rearrangment. This defaults to the tool that is chosen (IgBLAST, MiXCR, V-Quest) but can be overridden by the user if desired. This is most useful for AIRR files which can come from a variety of annotation tools (the default being IgBLAST)."
     )
 
+    # Choose the layout of the junction_aa substring search field.
+    config_group.add_argument(
+        "--substring_layout",
+        dest="substring_layout",
+        default="legacy",
+        choices=["legacy", "kmer"],
+        help="The layout of the junction_aa substring search field stored for rearrangements and clones. The legacy layout (the default) stores every substring of junction_aa longer than 3 characters in ir_substring. The kmer layout stores only the unique substrings of length --substring_kmer_length in a separate field (ir_substring_kmer), which is indexed at the start of the load and gives a much smaller index, with substring searches checking the candidate records against junction_aa. Queries on ir_substring do not find the records loaded with the kmer layout, so all of the data in a repository should use the same layout."
+    )
+    config_group.add_argument(
+        "--substring_kmer_length",
+        dest="substring_kmer_length",
+        default=4,
+        type=int,
+        help="The k-mer length used by the kmer substring layout. Defaults to 4."
+    )
+
+    # Overlap the parsing of rearrangement files with the repository writes.
+    config_group.add_argument(
+        "--pipeline_depth",
+        dest="pipeline_depth",
+        default=0,
+        type=int,
+        help="The number of parsed chunks of rearrangements (each of --database_chunk records) that can be queued waiting to be written to the repository. If greater than 0, AIRR TSV, MiXCR and Adaptive files are parsed while the previous chunks are written by --pipeline_writers writer threads, with the queue depth limiting the memory used. Defaults to 0, which writes each chunk as soon as it is parsed."
+    )
+    config_group.add_argument(
+        "--pipeline_writers",
+        dest="pipeline_writers",
+        default=1,
+        type=int,
+        help="The number of writer threads used when --pipeline_depth is greater than 0. Defaults to 1."
+    )
+
+    # Checkpoint the load of large annotation files so they can be resumed.
+    config_group.add_argument(
+        "--checkpoint",
+        action="store_true",
+        help="Write a checkpoint to the repository after each chunk of an AIRR TSV file is written, recording how much of the file has been loaded. Each rearrangement is tagged with the chunk it was written in (ir_load_chunk) so that a chunk that was only partially written can be removed. If the load fails it can be continued with --resume."
+    )
+    config_group.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume the load of AIRR TSV files from their checkpoints (implies --checkpoint). Any records from a chunk that was not completely written are deleted, and the load continues from the first chunk that was not written. Files without a checkpoint are loaded from the start."
+    )
+
+    # Compute the repertoire stats as the rearrangements are loaded.
+    config_group.add_argument(
+        "--stats",
+        action="store_true",
+        help="Compute the rearrangement stats for each repertoire (the stats generated by stats_create.py) as the rearrangements are written, and add them to the stat collection (see --stat_collection) once each file is loaded. This avoids reading the rearrangements back from the repository after the load. Can't be used with --resume, as the stats for the rearrangements written before the load was resumed are not known."
+    )
+
+    # Record the time and memory used by each stage of the load of each file.
+    config_group.add_argument(
+        "--metrics-out",
+        dest="metrics_out",
+        default="",
+        help="Record the time spent in each stage of the load of each file (read, rename, derive, gene, type_mapping, serialize, id_backfill, insert and stats), for the file as a whole and for each chunk of the file, along with the rows processed and the RSS of the loader. A JSON summary for each file is appended to the file given, one summary per line, so the metrics from more than one load (or from more than one worker) can be collected in the same file."
+    )
+    config_group.add_argument(
+        "--metrics-tracemalloc",
+        dest="metrics_tracemalloc",
+        action="store_true",
+        help="Trace the memory allocated by Python (with tracemalloc) when recording the load metrics, so that the peak memory allocated by each stage is reported. This slows the load down considerably."
+    )
+
+    # Defer the secondary index maintenance for bulk loads of rearrangements.
+    config_group.add_argument(
+        "--bulk_load",
+        action="store_true",
+        help="Load rearrangement files in bulk load mode. The rearrangements are written to a staging collection (see --staging_collection) with no secondary indexes, rather than updating every index on the rearrangement collection with each insert. At the end of the load, if the rearrangement collection is empty its indexes are built once on the staging collection which is then renamed into its place, otherwise the staged rearrangements are merged into the rearrangement collection by the server. The index build and merge time is reported separately from the insert time."
+    )
+
     type_group = parser.add_argument_group("data type options", "")
     type_group = type_group.add_mutually_exclusive_group()
 
@@ -312,14 +394,66 @@ def getArguments():
         default="reactivity",
         help="The collection to use for storing and searching reactivity data. This is the collection that data is inserted into when the --airr-reactivity option is used to load files. Defaults to 'reactivity', which is the collection in the iReceptor Turnkey repository."
     )
+    db_group.add_argument(
+        "--write_concurrency",
+        dest="write_concurrency",
+        default=1,
+        type=int,
+        help="The number of unordered insert batches to keep in flight when writing each chunk of annotation records (rearrangements, clones, cells, expression, receptors, reactivity). If greater than 1, each chunk of --database_chunk records is split into batches (see --write_batch_size) that are written concurrently over the connection pool, with the write errors for the chunk reported together. Defaults to 1, which writes each chunk with a single insert."
+    )
+    db_group.add_argument(
+        "--write_batch_size",
+        dest="write_batch_size",
+        default=0,
+        type=int,
+        help="The number of records in each insert batch when --write_concurrency is greater than 1. Defaults to 0, which splits each chunk evenly into --write_concurrency batches."
+    )
+    db_group.add_argument(
+        "--write_concern",
+        dest="write_concern",
+        default="",
+        help="The write concern (w) used for writes to the repository, either the number of nodes that must acknowledge a write (e.g. 1 or 2) or a tag such as 'majority'. Unacknowledged writes (0) are not supported, as the load relies on the results of its writes (e.g. for the repertoire counts, stats and checkpoints). Defaults to the server default."
+    )
+    db_group.add_argument(
+        "--staging_collection",
+        dest="staging_collection",
+        default="",
+        help="The collection that rearrangements are written to when the --bulk_load option is used. The collection must be empty at the start of the load. Defaults to the rearrangement collection name with '_staging' appended."
+    )
+    db_group.add_argument(
+        "--stat_collection",
+        dest="stat_collection",
+        default="stat",
+        help="The collection the repertoire stats are written to when the --stats option is used. Defaults to 'stat', which is the collection in the iReceptor Turnkey repository."
+    )
+    db_group.add_argument(
+        "--checkpoint_collection",
+        dest="checkpoint_collection",
+        default="load_checkpoint",
+        help="The collection used to store the load checkpoints written when the --checkpoint or --resume options are used. Defaults to 'load_checkpoint'."
+    )
 
     path_group = parser.add_argument_group("file options")
     path_group.add_argument(
         "-f",
         "--filename",
         dest="filename",
+        nargs="+",
+        default=[],
+        help="Name of the file(s) to load. More than one file, or a glob pattern (e.g. 'data/*.tsv'), can be given, in which case all of the files are loaded. It is assumed that the files provided are in the appropiate format that matches either the --sample, --imgt, --mixcr, or --airr command line options. An error will be reported if the formats do not match."
+    )
+    path_group.add_argument(
+        "--manifest",
+        dest="manifest",
         default="",
-        help="Name of the file to load. It is assumed that the filename provided is in the appropiate format that matches either the --sample, --imgt, --mixcr, or --airr command line options. An error will be reported if the formats do not match."
+        help="Name of a file that lists the files to load, one per line. Blank lines and lines starting with '#' are ignored. The files are loaded along with any given with --filename."
+    )
+    path_group.add_argument(
+        "--workers",
+        dest="workers",
+        default=1,
+        type=int,
+        help="Number of worker processes to use when loading more than one file. Each worker has its own repository connection and AIRR Mapping. Defaults to 1, which loads the files one after the other. Repertoire metadata files are always loaded one at a time."
     )
 
     options = parser.parse_args()
@@ -334,14 +468,40 @@ def getArguments():
         print('MAPFILE      :', options.mapfile)
         print('DATA_TYPE    :', options.type)
         print('FILE_NAME    :', options.filename)
+        print('MANIFEST     :', options.manifest)
+        print('WORKERS      :', options.workers)
 
     return options
 
-if __name__ == "__main__":
-    # Get the command line arguments.
-    options = getArguments()
-
-    # Create the repository object, which establishes the repository connection.
+# Build the list of files to load from the --filename and --manifest options.
+# Glob patterns are expanded, a pattern or name that doesn't match any files is
+# kept as is so that the missing file is reported when it is loaded.
+def getFileList(options):
+    names = list(options.filename)
+    if not options.manifest == "":
+        try:
+            with open(options.manifest, "r") as manifest_handle:
+                for line in manifest_handle:
+                    line = line.strip()
+                    if len(line) > 0 and not line.startswith("#"):
+                        names.append(line)
+        except Exception as err:
+            print("ERROR: Unable to read manifest file %s, %s"%(options.manifest, err))
+            return None
+
+    file_list = []
+    for name in names:
+        matches = sorted(glob.glob(name))
+        if len(matches) == 0:
+            matches = [name]
+        for filename in matches:
+            if not filename in file_list:
+                file_list.append(filename)
+    return file_list
+
+# Create the repository object, which establishes the repository connection.
+# Returns None if the connection could not be made.
+def createRepository(options):
     repository = Repository(options.user, options.password,
                             options.host, options.port,
                             options.database,
@@ -353,77 +513,115 @@ if __name__ == "__main__":
                             options.receptor_collection,
                             options.reactivity_collection,
                             options.skipload, options.update,
-                            options.verbose)
+                            options.verbose, options.checkpoint_collection,
+                            options.write_concurrency, options.write_batch_size,
+                            options.write_concern, options.stat_collection)
     # Check on the successful creation of the repository
     if repository is None or not repository:
-        sys.exit(1)
-
-    # Create the AIRR mapping object, which has the mapping of fields between
-    # the various components. This is essentially a mapping between the AIRR
-    # standard fields, the fields in the input file being parsed, and the fields
-    # that are stored in the repository.
+        return None
+    return repository
+
+# The data types that are loaded into the rearrangement collection.
+rearrangement_types = ["IMGT V-Quest", "MiXCR", "MiXCR-v3", "MiXCR-v4", "Adaptive",
+                       "AIRR TSV", "10x_contig", "ir_general"]
+
+# The data types that are loaded into the clone collection.
+clone_types = ["MiXCR Clone", "AIRR Clone"]
+
+# Create the index on the field used by the kmer substring layout for the
+# collection the files are loaded into, if it doesn't exist. Returns False on
+# error.
+def createKmerIndex(options, repository, airr_map):
+    if options.type in rearrangement_types:
+        annotation_type = "rearrangement"
+        parser = Rearrangement(options.verbose, options.database_map, 0,
+                               airr_map, repository)
+        substring_term = "ir_substring"
+    elif options.type in clone_types:
+        annotation_type = "clone"
+        parser = Clone(options.verbose, options.database_map, 0,
+                       airr_map, repository)
+        substring_term = "ir_substring_clone"
+    else:
+        return True
+    if not parser.setSubstringLayout("kmer", options.substring_kmer_length):
+        return False
+    substring_field = parser.getSubstringField(
+                          airr_map.getMapping(substring_term, parser.getiReceptorTag(),
+                                              parser.getRepositoryTag()))
+    if substring_field is None:
+        print("Warning: No repository mapping for %s, not creating a k-mer index"%
+              (substring_term))
+        return True
+    return repository.createFieldIndex(annotation_type, substring_field)
+
+# Get the name of the staging collection used for a bulk load.
+def getStagingCollection(options):
+    if options.staging_collection == "":
+        return options.rearrangement_collection + "_staging"
+    return options.staging_collection
+
+# Create the AIRR mapping object, which has the mapping of fields between
+# the various components. This is essentially a mapping between the AIRR
+# standard fields, the fields in the input file being parsed, and the fields
+# that are stored in the repository. Returns None on error.
+def createAIRRMap(options):
     airr_map = AIRRMap(options.verbose)
     airr_map.readMapFile(options.mapfile)
     if airr_map.getRearrangementMapColumn(options.database_map) is None:
         print("ERROR: Could not find repository mapping %s in AIRR Mappings"%
               (options.database_map))
-        sys.exit(1)
-
-    # Start timing the file loading
-    t_start = time.perf_counter()
-
-    # We can only update for Repertoires
-    if (options.update and not 
-           (options.type == "iReceptor Repertoire" or 
-            options.type == "AIRR Repertoire")):
-        print("Error: Update is only possible on Repertoire metadata")
-        sys.exit(1)
+        return None
+    return airr_map
 
+# Create the parser for the data type being loaded. Returns None if the data
+# type is not known or the parser could not be set up correctly.
+def createParser(options, airr_map, repository, filename):
     if options.type == "iReceptor Repertoire":
         # process iReceptor Repertoire metadata 
-        print("Info: Processing iReceptor repertoire metadata file: {}".format(options.filename))
+        print("Info: Processing iReceptor repertoire metadata file: {}".format(filename))
         parser = IRRepertoire(options.verbose, options.database_map, options.database_chunk,
                               airr_map, repository)
     elif options.type == "AIRR Repertoire":
         # process AIRR Repertoire metadata
-        print("Info: Processing AIRR repertoire metadata file: {}".format(options.filename))
+        print("Info: Processing AIRR repertoire metadata file: {}".format(filename))
         parser = AIRRRepertoire(options.verbose, options.database_map, options.database_chunk,
                                 airr_map, repository)
     elif options.type == "IMGT V-Quest":
         # process imgt
-        print("Info: Processing IMGT data file: {}".format(options.filename))
+        print("Info: Processing IMGT data file: {}".format(filename))
         parser = IMGT(options.verbose, options.database_map, options.database_chunk,
                       airr_map, repository)
     elif options.type == "MiXCR":
         # process mixcr
-        print("Info: Processing MiXCR data file: {}".format(options.filename))
+        print("Info: Processing MiXCR data file: {}".format(filename))
         parser = MiXCR(options.verbose, options.database_map, options.database_chunk,
                        airr_map, repository)
     elif options.type == "MiXCR-v3":
         # process mixcr
-        print("Info: Processing MiXCR data file: {}".format(options.filename))
+        print("Info: Processing MiXCR data file: {}".format(filename))
         parser = MiXCR(options.verbose, options.database_map, options.database_chunk,
                        airr_map, repository)
         parser.setFileMapping("mixcr_v3")
     elif options.type == "MiXCR-v4":
         # process mixcr
-        print("Info: Processing MiXCR data file: {}".format(options.filename))
+        print("Info: Processing MiXCR data file: {}".format(filename))
         parser = MiXCR(options.verbose, options.database_map, options.database_chunk,
                        airr_map, repository)
         parser.setFileMapping("mixcr_v4")
     elif options.type == "AIRR TSV":
         # process AIRR TSV
-        print("Info: Processing AIRR TSV annotation data file: ", options.filename)
+        print("Info: Processing AIRR TSV annotation data file: ", filename)
         parser = AIRR_TSV(options.verbose, options.database_map, options.database_chunk,
                           airr_map, repository)
     elif options.type == "Adaptive":
         # process Adaptive
-        print("Info: Processing Adaptive annotation data file: ", options.filename)
+        print("Info: Processing Adaptive annotation data file: ", filename)
         parser = Adaptive(options.verbose, options.database_map, options.database_chunk,
                           airr_map, repository)
     elif options.type == "10x_contig":
         # process a general file (non annotation tool specific)
-        print("Info: Processing a 10X contig annotation file: ", options.filename)
+        print("Info: Processing a 10X contig annotation file: ", filename)
         parser = AIRR_TSV(options.verbose, options.database_map, options.database_chunk,
                           airr_map, repository)
         # Override the default file mapping that the parser subclass sets. We use the AIRR Parser
@@ -433,7 +631,7 @@ if __name__ == "__main__":
         parser.setAnnotationTool(options.type)
     elif options.type == "ir_general":
         # process a general file (non annotation tool specific)
-        print("Info: Processing a general TSV annotation data file: ", options.filename)
+        print("Info: Processing a general TSV annotation data file: ", filename)
         parser = AIRR_TSV(options.verbose, options.database_map, options.database_chunk,
                           airr_map, repository)
         # Override the default file mapping that the parser subclass sets. This allows us
@@ -443,62 +641,295 @@ if __name__ == "__main__":
         parser.setAnnotationTool(options.type)
     elif options.type == "MiXCR Clone":
         # process mixcr clone data
-        print("Info: Processing MiXCR Clone data file: {}".format(options.filename))
+        print("Info: Processing MiXCR Clone data file: {}".format(filename))
         parser = MiXCR_Clone(options.verbose, options.database_map,
                              options.database_chunk, airr_map, repository)
     elif options.type == "AIRR Clone":
         # process AIRR clone data
-        print("Info: Processing AIRR Clone data file: {}".format(options.filename))
+        print("Info: Processing AIRR Clone data file: {}".format(filename))
         parser = AIRR_Clone(options.verbose, options.database_map,
                             options.database_chunk, airr_map, repository)
     elif options.type == "AIRR Cell":
         # process AIRR Cell JSON data
-        print("Info: Processing AIRR JSON Cell data file: {}".format(options.filename))
+        print("Info: Processing AIRR JSON Cell data file: {}".format(filename))
         parser = AIRR_Cell(options.verbose, options.database_map,
                            options.database_chunk, airr_map, repository)
     elif options.type == "AIRR Expression":
         # process AIRR Expression JSON data
-        print("Info: Processing AIRR JSON Gene Expression data file: {}".format(options.filename))
+        print("Info: Processing AIRR JSON Gene Expression data file: {}".format(filename))
         parser = AIRR_Expression(options.verbose, options.database_map,
                                  options.database_chunk, airr_map, repository)
     elif options.type == "AIRR Receptor":
         # process AIRR Receptor JSON data
-        print("Info: Processing AIRR JSON Receptor data file: {}".format(options.filename))
+        print("Info: Processing AIRR JSON Receptor data file: {}".format(filename))
         parser = AIRR_Receptor(options.verbose, options.database_map,
                                options.database_chunk, airr_map, repository)
     elif options.type == "AIRR Reactivity":
         # process AIRR Reactivity JSON data
-        print("Info: Processing AIRR JSON Reactivity data file: {}".format(options.filename))
+        print("Info: Processing AIRR JSON Reactivity data file: {}".format(filename))
         parser = AIRR_Reactivity(options.verbose, options.database_map,
                                 options.database_chunk, airr_map, repository)
     else:
         print("ERROR: unknown data type '{}'".format(options.type))
-        sys.exit(4)
+        return None
 
     # Check for a valid parser.
     if not parser.checkValidity():
         print("ERROR: Parser not contructed correctly, exiting...")
-        sys.exit(4)
+        return None
 
     # Override what the default annotation tool that the Parser subclass set by default.
     if not options.annotation_tool == "":
         parser.setAnnotationTool(options.annotation_tool)
 
-    parse_ok = parser.process(options.filename)
+    # Set the substring layout for annotation data (rearrangements and clones).
+    if isinstance(parser, Annotation):
+        if not parser.setSubstringLayout(options.substring_layout,
+                                         options.substring_kmer_length):
+            return None
+
+    # Set up the insert pipeline for rearrangements.
+    if isinstance(parser, Rearrangement):
+        if not parser.setInsertPipeline(options.pipeline_depth,
+                                        options.pipeline_writers):
+            return None
+
+    # Turn on the computation of the repertoire stats during the load.
+    if options.stats and isinstance(parser, Rearrangement):
+        parser.setLoadStats(True)
+
+    # Turn on checkpoints, which are only supported for AIRR TSV files.
+    if options.checkpoint or options.resume:
+        if isinstance(parser, AIRR_TSV):
+            parser.setCheckpoint(options.resume)
+        else:
+            print("Warning: Checkpoints are not supported for %s files, loading without checkpoints"%
+                  (options.type))
+
+    return parser
+
+# Load a single file, returning a dictionary with the file name, the status of
+# the load ("loaded", "failed" or "invalid" if the parser could not be created),
+# the number of records written to the repository, and the time taken.
+def loadFile(options, airr_map, repository, filename):
+    t_start = time.perf_counter()
+    result = {"filename": filename, "status": "failed", "records": 0, "time": 0.0}
+
+    parser = createParser(options, airr_map, repository, filename)
+    if parser is None:
+        result["status"] = "invalid"
+        return result
+
+    # Record the stages of the load of the file, if requested.
+    metrics = None
+    if not options.metrics_out == "":
+        metrics = LoadMetrics(filename, options.type, options.metrics_tracemalloc)
+        parser.setMetrics(metrics)
+
+    insert_count = repository.getInsertCount()
+    # An exception while processing the file (e.g. a malformed file) fails
+    # the file rather than the run, so that the other files are still loaded
+    # and reported, and a bulk load is still finished.
+    try:
+        parse_ok = parser.process(filename)
+    except Exception as err:
+        print("ERROR: Unable to process %s file %s, %s: %s"%
+              (options.type, filename, type(err).__name__, err))
+        parse_ok = False
+        # Stop the insert pipeline writers if the parser was using them.
+        if isinstance(parser, Rearrangement):
+            parser.stopInsertPipeline()
     operation = "loaded"
     if options.update:
         operation = "updated"
     if parse_ok:
-        print("Info: %s file %s %s successfully"%(options.type,options.filename,operation))
+        print("Info: %s file %s %s successfully"%(options.type,filename,operation))
+        result["status"] = "loaded"
     else:
-        print("ERROR: %s file %s not %s successfully"%(options.type,options.filename,operation))
+        print("ERROR: %s file %s not %s successfully"%(options.type,filename,operation))
+
+    result["records"] = repository.getInsertCount() - insert_count
+    result["time"] = time.perf_counter() - t_start
+
+    if not metrics is None:
+        metrics.finish(result["status"], result["records"])
+        metrics.printSummary()
+        metrics.write(options.metrics_out)
+    return result
+
+# Each worker process has its own repository connection and AIRR Mapping, set
+# up once by initWorker when the worker starts.
+worker_options = None
+worker_repository = None
+worker_airr_map = None
+
+def initWorker(options):
+    global worker_options, worker_repository, worker_airr_map
+    worker_options = options
+    worker_repository = createRepository(options)
+    worker_airr_map = createAIRRMap(options)
+    # For a bulk load, the main process has set up the staging collection.
+    if options.bulk_load and not worker_repository is None:
+        if not worker_repository.useStagingCollection("rearrangement",
+                                                      getStagingCollection(options)):
+            worker_repository = None
+
+def loadFileWorker(filename):
+    if worker_repository is None or worker_airr_map is None:
+        print("ERROR: Worker could not connect to the repository, file %s not loaded"%
+              (filename))
+        return {"filename": filename, "status": "failed", "records": 0, "time": 0.0}
+    return loadFile(worker_options, worker_airr_map, worker_repository, filename)
+
+# Print a summary of the files loaded, given the list of load results.
+def reportResults(results, t_elapsed):
+    loaded = [result for result in results if result["status"] == "loaded"]
+    failed = [result for result in results if not result["status"] == "loaded"]
+    total_records = sum([result["records"] for result in results])
+    print("Info: Load summary - %d files, %d loaded, %d failed"%
+          (len(results), len(loaded), len(failed)))
+    for result in results:
+        rate = 0.0
+        if result["time"] > 0:
+            rate = result["records"]/result["time"]
+        print("Info:     %-7s %s, %d records, %.2f s, %.1f records/s"%
+              (result["status"], result["filename"], result["records"],
+               result["time"], rate))
+    if t_elapsed > 0:
+        print("Info: Total of %d records in %.2f s, %.1f records/s"%
+              (total_records, t_elapsed, total_records/t_elapsed))
+    for result in failed:
+        print("ERROR: File %s not loaded successfully"%(result["filename"]))
+
+if __name__ == "__main__":
+    # Get the command line arguments.
+    options = getArguments()
+
+    # Get the list of files to load.
+    file_list = getFileList(options)
+    if file_list is None or len(file_list) == 0:
+        print("ERROR: No files to load, use --filename or --manifest")
+        sys.exit(1)
+
+    # We can only update for Repertoires
+    if (options.update and not 
+           (options.type == "iReceptor Repertoire" or 
+            options.type == "AIRR Repertoire")):
+        print("Error: Update is only possible on Repertoire metadata")
+        sys.exit(1)
+
+    # Repertoire metadata is loaded one file at a time, as repertoire
+    # IDs are assigned based on the repertoires already in the repository.
+    workers = max(1, min(options.workers, len(file_list)))
+    if workers > 1 and (options.type == "iReceptor Repertoire" or
+                        options.type == "AIRR Repertoire"):
+        print("Warning: Repertoire metadata files are loaded one at a time")
+        workers = 1
+
+    # Check the concurrent write options.
+    if options.write_concurrency < 1 or options.write_batch_size < 0:
+        print("ERROR: Invalid write concurrency (%d) or write batch size (%d)"%
+              (options.write_concurrency, options.write_batch_size))
+        sys.exit(1)
+    # Unacknowledged writes don't return results, which the load needs to
+    # update the repertoire counts, stats and checkpoints.
+    if options.write_concern.isdigit() and int(options.write_concern) == 0:
+        print("ERROR: Write concern 0 (unacknowledged writes) is not supported")
+        sys.exit(1)
+
+    # Bulk loads are only for rearrangements, and can't be resumed as the
+    # staging collection is moved into place at the end of the load.
+    if options.bulk_load and not options.type in rearrangement_types:
+        print("ERROR: Bulk load is only possible for rearrangement files")
+        sys.exit(1)
+    if options.bulk_load and options.resume:
+        print("ERROR: Bulk load can not be used with --resume")
+        sys.exit(1)
+
+    # The stats can only be computed for rearrangements, and not when a load
+    # is resumed as the rearrangements loaded before the resume are not seen.
+    if options.stats and not options.type in rearrangement_types:
+        print("Warning: Stats can only be computed for rearrangement files, loading without stats")
+        options.stats = False
+    if options.stats and options.resume:
+        print("Warning: Stats can not be computed when resuming a load, loading without stats (use stats_create.py once the load is complete)")
+        options.stats = False
+
+    # Start timing the file loading
+    t_start = time.perf_counter()
+
+    # The kmer substring layout is stored in its own field, which needs its
+    # own index. This is created before a bulk load saves the index
+    # definitions, so that it is built along with the other indexes.
+    repository = None
+    if options.substring_layout == "kmer" and (options.type in rearrangement_types or
+                                               options.type in clone_types):
+        repository = createRepository(options)
+        airr_map = createAIRRMap(options)
+        if repository is None or airr_map is None:
+            sys.exit(1)
+        if not createKmerIndex(options, repository, airr_map):
+            sys.exit(1)
+
+    # For a bulk load, save the index definitions and set up the staging
+    # collection before any of the files are loaded.
+    if options.bulk_load:
+        if repository is None:
+            repository = createRepository(options)
+        if repository is None:
+            sys.exit(1)
+        if not repository.startBulkLoad("rearrangement", getStagingCollection(options)):
+            sys.exit(1)
+
+    if workers == 1:
+        # Load the files in this process, sharing the repository connection
+        # and the AIRR Mapping.
+        if repository is None:
+            repository = createRepository(options)
+        if repository is None:
+            sys.exit(1)
+        airr_map = createAIRRMap(options)
+        if airr_map is None:
+            sys.exit(1)
+        results = []
+        for filename in file_list:
+            results.append(loadFile(options, airr_map, repository, filename))
+    else:
+        # Load the files in a pool of worker processes. Each worker loads one
+        # file at a time.
+        print("Info: Loading %d files with %d workers"%(len(file_list), workers),
+              flush=True)
+        with multiprocessing.Pool(workers, initializer=initWorker,
+                                  initargs=(options,)) as pool:
+            results = pool.map(loadFileWorker, file_list, chunksize=1)
 
     # time end
     t_end = time.perf_counter()
+    if len(results) > 1:
+        reportResults(results, t_end - t_start)
+
+    # For a bulk load, build the indexes and move the staged rearrangements
+    # into the rearrangement collection. As with a normal load, records from
+    # files that failed part way through are kept.
+    bulk_load_ok = True
+    if options.bulk_load:
+        if not all([result["status"] == "loaded" for result in results]):
+            print("Warning: Not all files were loaded, finishing bulk load with the records that were written")
+        t_bulk_start = time.perf_counter()
+        bulk_load_ok = repository.finishBulkLoad("rearrangement")
+        t_bulk_end = time.perf_counter()
+        print("Info: Bulk load insert time = %.2f s, index build and merge time = %.2f s"%
+              (t_end - t_start, t_bulk_end - t_bulk_start))
+        t_end = t_bulk_end
     print("Info: Finished processing in {:.2f} mins".format((t_end - t_start) / 60))
 
-    # Return success
-    if parse_ok:
+    # Return success if all files were loaded. A parser that could not be set
+    # up is a configuration error.
+    if any([result["status"] == "invalid" for result in results]):
+        sys.exit(4)
+    elif not bulk_load_ok:
+        sys.exit(1)
+    elif all([result["status"] == "loaded" for result in results]):
         sys.exit(0)
     else:
         sys.exit(1)
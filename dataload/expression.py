@@ -25,6 +25,9 @@ class Expression(Annotation):
         # each annotation record. This overrides the Annotation class value for
         # this field.
         self.annotation_linkid_field = "ir_annotation_set_metadata_id_expression"
+        # The field in the repertoire collection that caches the number of
+        # annotations of this type that belong to the repertoire.
+        self.annotation_count_field = self.getExpressionCountField()
 
 
     #####################################################################################
@@ -36,30 +39,28 @@ class Expression(Annotation):
     # This is hiding the Mongo implementation. Probably should refactor the 
     # repository implementation completely.
     def repositoryInsertRecords(self, json_records):
-        # Insert the JSON and get a list of IDs back. If no data returned, return an error
-        record_ids = self.repository.insertExpression(json_records)
-        if record_ids is None:
-            return False
         # Get the field we want to map for the GEX ID for each record.
         gex_id_field =  self.getAIRRMap().getMapping("expression_id_expression",
                                               self.getiReceptorTag(),
                                               self.getRepositoryTag(),
                                               self.getAIRRMap().getExpressionClass())
-        ir_updated_at_gex =  self.getAIRRMap().getMapping("ir_updated_at_expression",
-                                              self.getiReceptorTag(),
-                                              self.getRepositoryTag(),
-                                              self.getAIRRMap().getIRExpressionClass())
 
-        # If we found a repository record, write a string repersentation of the ID 
-        # returned into the expression_id field.
-        # TODO: This can probably be optimized and is quite slow! If we didn't
-        # have to update this, loading would be very fast - this is doing a DB
-        # Op per record!
-        if not gex_id_field is None:
-            for record_id in record_ids:
-                self.repository.updateExpressionField("_id", record_id,
-                                                 gex_id_field, str(record_id),
-                                                 ir_updated_at_gex)
+        # Assign the repository ID for each record before we insert, storing a
+        # string repersentation of the ID in the expression_id field. This saves us
+        # from having to update each record after it is inserted.
+        t_start = self.startStage()
+        json_records = self.repository.setRecordIDs(json_records, gex_id_field)
+        self.endStage("id_backfill", t_start, len(json_records))
+
+        # Insert the JSON and get a list of IDs back. If no data returned, return an error
+        t_start = self.startStage()
+        record_ids = self.repository.insertExpression(json_records)
+        self.endStage("insert", t_start, len(json_records))
+        if record_ids is None:
+            return False
+
+        # Keep track of the records inserted for each repertoire.
+        self.countInsertedRecords(json_records)
 
         return True
 
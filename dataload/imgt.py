@@ -4,12 +4,12 @@
 
 import os
 from os.path import isfile
-from shutil import rmtree
 import time
 import re
 import zipfile
 import tarfile
-import json
+import tempfile
+import shutil
 import pandas as pd
 from Bio.Seq import translate
 
@@ -156,6 +156,14 @@ class IMGT(Rearrangement):
         # The mapping file has a boolean flag column that denotes whether a given AIRR
         # term requires computation. The column name to use for the mapping is below. 
         self.imgt_calculate_map = "vquest_calculate"
+        # The IMGT V-Quest files all have a sequence number column, which we use
+        # to check that the rows we read from each of the files line up.
+        self.imgt_sequence_number = "Sequence number"
+        # The IMGT V-Quest file with the parameters used for the annotation.
+        self.imgt_parameter_file = "11_Parameters.txt"
+        # The largest IMGT V-Quest file decompressed from a compressed archive
+        # that is kept in memory rather than in a temporary file.
+        self.imgt_spool_size = 64*1024*1024
 
 
     def process(self, filewithpath):
@@ -181,35 +189,24 @@ class IMGT(Rearrangement):
         # multiple repositories.
         repository_tag = self.getRepositoryTag()
 
-        # Get the fields to use for finding repertoire IDs, either using those IDs
-        # directly or by looking for a repertoire ID based on a rearrangement file
-        # name.
-        repertoire_link_field = self.getRepertoireLinkIDField()
-        rearrangement_link_field = self.getAnnotationLinkIDField()
-
         # Set the tag for the file mapping that we are using. Ths is essentially the
         # look up into the columns of the AIRR Mapping that we are using.
         filemap_tag = self.getFileMapping()
 
-        # Set the tag for the iReceptor ID that we use.
-        ireceptor_tag = self.getiReceptorTag()
-
         # Set the tag for the calculation flag mapping that we are using. Ths is 
         # the look up into the columns of the AIRR Mapping that we are using for this.
         calculate_tag = self.imgt_calculate_map
 
+        # Define the number of records to iterate over
+        chunk_size = self.getRepositoryChunkSize()
+
         # Get root filename from the path, should be a file if the path
         # is file, so not checking again 8-)
         fileName = os.path.basename(filewithpath)
-        # Set the scratch folder based on the file name. This computes a
-        # unique termporary folder in which we can uncompress and process
-        # data in a safe way.
-        self.setScratchFolder(filewithpath, fileName)
 
         if self.verbose():
-            print("Info: Extracting IMGT file: ", fileName)
+            print("Info: Reading IMGT file: ", fileName)
             print("Info: Path: ", filewithpath)
-            print("Info: Scratch folder: ", self.getScratchFolder())
 
         # Get the single, unique repertoire link id for the filename we are loading. If
         # we can't find one, this is an error and we return failure.
@@ -218,17 +215,8 @@ class IMGT(Rearrangement):
             print("ERROR: Could not link file %s to a valid repertoire"%(fileName))
             return False
 
-        # Open the tar file, extract the data, and close the tarfile. 
-        # This leaves us with a folder with all of the individual vQUest
-        # files extracted in this location.
-
-        try:
-            tar = tarfile.open(filewithpath)
-            tar.extractall(self.getScratchFolder())
-            tar.close()
-        except Exception as err:
-            print("ERROR: Unable to open IMGT tar file %s" % (filewithpath))
-            return False
+        # Start the stats for the repertoire, if they are computed during the load.
+        self.startLoadStats()
 
         # Get the column of values from the AIRR tag. We only want the
         # Rearrangement related fields.
@@ -246,10 +234,9 @@ class IMGT(Rearrangement):
         vquest_file_map = airr_map.getRearrangementMapColumn(self.imgt_filename_map)
         vquest_files = vquest_file_map.dropna().unique()
 
-        # Create a dictionary that stores an array of fields to process
-        # for each IMGT file that we need to process.
+        # Create a dictionary that stores the vquest fields to extract from each
+        # IMGT file that we need to process and the repository fields they map to.
         filedict = {}
-        first_dataframe = True
         # Arrays to keep track of the vquest fields we need to calculate on.
         vquest_calc_fields = []
         vquest_calc_file = []
@@ -257,9 +244,6 @@ class IMGT(Rearrangement):
         for vquest_file in vquest_files:
             if self.verbose():
                 print("Info: Processing file ", vquest_file, flush=True)
-            # Read in the data frame for the file.
-            vquest_dataframe = pd.read_csv(self.getScratchPath(vquest_file),
-                                           sep='\t', low_memory=False)
             # Extract the fields that are of interest for this file.
             imgt_file_column = airr_map.getRearrangementMapColumn(self.imgt_filename_map)
             fields_of_interest = imgt_file_column.isin([vquest_file])
@@ -310,73 +294,257 @@ class IMGT(Rearrangement):
                               "/" + str(row[filemap_tag]) + 
                               ", not inserting into repository", flush=True)
 
-            # Use the vquest column in our mapping to select the columns we want from the 
-            # possibly quite large vquest data frame.
-            mongo_dataframe = vquest_dataframe[vquest_fields]
-            # We now have a data frame that has only the vquest data we want from this
-            # file. We now replace the vquest column names with the repository column
-            # names from the map
-            mongo_dataframe.columns = mongo_fields
-            # We now have a data frame with vquest data in it with AIRR compliant column
-            # names. Store all of this in a dictionay based on the file name so we can
-            # use it later.
+            # Store the vquest fields to use and the repository names for them in a
+            # dictionary based on the file name so we can use it for each chunk.
             filedict[vquest_file] = {filemap_tag: file_fields[filemap_tag],
                                      repository_tag: file_fields[repository_tag],
-                                     'vquest_dataframe': vquest_dataframe,
-                                     'mongo_dataframe': mongo_dataframe}
-            # Manage the data frames that we extract from each file. Essentially we 
-            # just concatentate the data frames from each file into a single large
-            # data frame.
-            if first_dataframe:
-                mongo_concat = mongo_dataframe
-                vquest_concat = vquest_dataframe
-                first_dataframe = False
-            else:
-                mongo_concat = pd.concat([mongo_concat, mongo_dataframe], axis=1)
-                vquest_concat = pd.concat([vquest_concat, vquest_dataframe], axis=1)
-                
-        # We now have the data in a data frame with the correct headers mapped from the
-        # IMGT data fields to the correct repository field names. Now we have to perform
-        # any specific mappings that are specific to IMGT.
+                                     'vquest_fields': vquest_fields,
+                                     'mongo_fields': mongo_fields}
+
+        # Open the IMGT Parameters file and each of the vquest files, which are
+        # read straight from the tar file.
+        imgt_files = self.openImgtFiles(filewithpath,
+                                        [self.imgt_parameter_file] + list(vquest_files))
+        if imgt_files is None:
+            return False
+        (tar, imgt_handles) = imgt_files
+        total_records = 0
+        try:
+            # First, we want to keep track of some of the data from the IMGT Parameters file.
+            # Create a dictionary with keys the first column of the parameter file and the 
+            # values in the second column in the parameter file.
+            Parameters_11 = pd.read_csv(imgt_handles[self.imgt_parameter_file],
+                                        sep='\t', low_memory=False, header=None)
+            parameter_dictionary = dict(zip(Parameters_11[0], Parameters_11[1]))
+
+            # Need to grab some data out of the parameters dictionary. This is not really
+            # necessary as this information should be stored in the repertoire metadata,
+            #  but for completeness we err on the side of having more information.
+            # Note that this is quite redundant as it is storing the same information
+            # for each rearrangement...
+            parameter_fields = dict()
+            parameter_fields['vquest_annotation_date'] = parameter_dictionary['Date']
+            # Handle different version column names for different version of IMGT
+            if 'IMGT/V-QUEST programme version' in parameter_dictionary:
+                parameter_fields['vquest_tool_version'] = parameter_dictionary['IMGT/V-QUEST programme version']
+            elif 'IMGT/V-QUEST program version' in parameter_dictionary:
+                parameter_fields['vquest_tool_version'] = parameter_dictionary['IMGT/V-QUEST program version']
+            parameter_fields['vquest_reference_version'] = parameter_dictionary[
+                'IMGT/V-QUEST reference directory release']
+            parameter_fields['vquest_species'] = parameter_dictionary['Species']
+            parameter_fields['vquest_receptor_type'] = parameter_dictionary['Receptor type or locus']
+            parameter_fields['vquest_reference_directory_set'] = parameter_dictionary[
+                'IMGT/V-QUEST reference directory set']
+            parameter_fields['vquest_search_insert_delete'] = parameter_dictionary[
+                'Search for insertions and deletions']
+            parameter_fields['vquest_no_nucleotide_to_add'] = parameter_dictionary[
+                "Nb of nucleotides to add (or exclude) in 3' of the V-REGION for the evaluation of the alignment score"]
+            parameter_fields['vquest_no_nucleotide_to_exclude'] = parameter_dictionary[
+                "Nb of nucleotides to exclude in 5' of the V-REGION for the evaluation of the nb of mutations"]
+            if self.verbose():
+                print("Info: Done processing IMGT Parameter file", flush=True) 
+
+            # Create a reader for each of the vquest files with step size "chunk_size".
+            # Each of the files has one row per sequence, in the same order, so we
+            # read the files in lock-step, a chunk from each file at a time, so
+            # that we only need to keep one chunk of each file in memory.
+            vquest_readers = dict()
+            for vquest_file in vquest_files:
+                vquest_readers[vquest_file] = pd.read_csv(imgt_handles[vquest_file],
+                                                          sep='\t', low_memory=False,
+                                                          chunksize=chunk_size)
+
+            # Iterate over the files with data frames of size "chunk_size"
+            if self.verbose():
+                print("Info: Processing raw data frames...", flush=True)
+            t_start_load = time.perf_counter()
+            while True:
+                # Get the next chunk from each file.
+                t_stage = self.startStage()
+                vquest_chunks = dict()
+                for vquest_file, vquest_reader in vquest_readers.items():
+                    vquest_chunks[vquest_file] = next(vquest_reader, None)
+                # If we are out of data in all files we are done, if we are out of
+                # data in only some of the files the files don't match.
+                done_files = [vquest_file for vquest_file, vquest_chunk in vquest_chunks.items()
+                              if vquest_chunk is None]
+                if len(done_files) == len(vquest_chunks):
+                    break
+                elif len(done_files) > 0:
+                    print("ERROR: IMGT files %s have fewer rows than the other IMGT files"%
+                          (str(done_files)))
+                    return False
+                self.startMetricsChunk(t_stage)
+                self.endStage("read", t_stage,
+                              len(next(iter(vquest_chunks.values()))))
+
+                # Check that the sequences in each file line up with the first file.
+                first_chunk = None
+                for vquest_file, vquest_chunk in vquest_chunks.items():
+                    if not self.imgt_sequence_number in vquest_chunk:
+                        continue
+                    if first_chunk is None:
+                        first_chunk = vquest_chunk
+                    elif not vquest_chunk[self.imgt_sequence_number].equals(
+                                 first_chunk[self.imgt_sequence_number]):
+                        print("ERROR: IMGT file %s sequences do not match other IMGT files"%
+                              (vquest_file))
+                        return False
+
+                # Use the vquest column in our mapping to select the columns we want from the
+                # possibly quite large vquest data frames, and replace the vquest column names
+                # with the repository column names from the map. Concatentate the data frames
+                # from each file into a single data frame for the chunk.
+                t_stage = self.startStage()
+                mongo_dataframes = []
+                for vquest_file, vquest_chunk in vquest_chunks.items():
+                    mongo_dataframe = vquest_chunk[filedict[vquest_file]['vquest_fields']].copy()
+                    mongo_dataframe.columns = filedict[vquest_file]['mongo_fields']
+                    mongo_dataframes.append(mongo_dataframe)
+                mongo_concat = pd.concat(mongo_dataframes, axis=1)
+
+                # Add the fields from the IMGT Parameters file.
+                for parameter_field, parameter_value in parameter_fields.items():
+                    mongo_concat[parameter_field] = parameter_value
+                self.endStage("rename", t_stage, len(mongo_concat))
+
+                # Perform the IMGT specific mappings and calculations on the chunk.
+                mongo_concat = self.processImgtChunk(mongo_concat, vquest_chunks,
+                                                     repertoire_link_id, airr_fields,
+                                                     mongo_calc_fields, vquest_calc_fields,
+                                                     vquest_calc_file)
+                if mongo_concat is None:
+                    return False
+
+                # Insert the chunk of records into Mongo.
+                num_records = len(mongo_concat)
+                print("Info: Inserting", num_records, "records into Mongo...", flush=True)
+                t_start = self.startStage()
+                records = self.dataFrameToRecords(mongo_concat)
+                self.endStage("serialize", t_start, num_records)
+                if not self.repositoryInsertRecords(records):
+                    return False
+                t_end = time.perf_counter()
+                print("Info: Inserted records, time =", (t_end - t_start), "seconds",
+                      flush=True)
+
+                # Keep track of the total number of records processed.
+                total_records = total_records + num_records
+                print("Info: Total records so far =", total_records, flush=True)
+        finally:
+            self.endMetricsChunk()
+            # Close the tar file and the handles for each of the files in it.
+            self.closeImgtFiles(tar, imgt_handles)
+
+        # Increment the cached count field for the repertoire by the number of
+        # annotations inserted for it, rather than counting all of the
+        # annotations that belong to the repertoire. The cached counts can be
+        # reconciled with the annotations in the repository using recount.py.
         if self.verbose():
-            print("Info: Done building the initial data frame", flush=True) 
-
-        # First, we want to keep track of some of the data from the IMGT Parameters file.
-        # Create a dictionary with keys the first column of the parameter file and the 
-        # values in the second column in the parameter file.
-        Parameters_11 = pd.read_csv(self.getScratchPath('11_Parameters.txt'),
-                                    sep='\t', low_memory=False, header=None)
-        parameter_dictionary = dict(zip(Parameters_11[0], Parameters_11[1]))
-
-        # Need to grab some data out of the parameters dictionary. This is not really
-        # necessary as this information should be stored in the repertoire metadata,
-        #  but for completeness we err on the side of having more information.
-        # Note that this is quite redundant as it is storing the same information
-        # for each rearrangement...
-        mongo_concat['vquest_annotation_date'] = parameter_dictionary['Date']
-        # Handle different version column names for different version of IMGT
-        if 'IMGT/V-QUEST programme version' in parameter_dictionary:
-            mongo_concat['vquest_tool_version'] = parameter_dictionary['IMGT/V-QUEST programme version']
-        elif 'IMGT/V-QUEST program version' in parameter_dictionary:
-            mongo_concat['vquest_tool_version'] = parameter_dictionary['IMGT/V-QUEST program version']
-        mongo_concat['vquest_reference_version'] = parameter_dictionary[
-            'IMGT/V-QUEST reference directory release']
-        mongo_concat['vquest_species'] = parameter_dictionary['Species']
-        mongo_concat['vquest_receptor_type'] = parameter_dictionary['Receptor type or locus']
-        mongo_concat['vquest_reference_directory_set'] = parameter_dictionary[
-            'IMGT/V-QUEST reference directory set']
-        mongo_concat['vquest_search_insert_delete'] = parameter_dictionary[
-            'Search for insertions and deletions']
-        mongo_concat['vquest_no_nucleotide_to_add'] = parameter_dictionary[
-            "Nb of nucleotides to add (or exclude) in 3' of the V-REGION for the evaluation of the alignment score"]
-        mongo_concat['vquest_no_nucleotide_to_exclude'] = parameter_dictionary[
-            "Nb of nucleotides to exclude in 5' of the V-REGION for the evaluation of the nb of mutations"]
+            print("Info: Updating the number of annotations for repertoire %s"%
+                  (str(repertoire_link_id)), flush=True)
+        annotation_count = self.repositoryIncrementCount(repertoire_link_id)
+        if annotation_count == -1:
+            print("ERROR: Unable to write annotation count to repository.")
+            return False
+
+        # Write the stats for the rearrangements loaded from the file, if they
+        # were computed during the load.
+        if self.repositoryWriteStats(repertoire_link_id) == -1:
+            print("ERROR: Unable to write repertoire stats to repository.")
+            return False
+
+        t_end_load = time.perf_counter()
         if self.verbose():
-            print("Info: Done processing IMGT Parameter file", flush=True) 
+            print("Info: Total load time = %f" % (t_end_load - t_start_load))
+
+        # Inform on what we added and the total count for the this record.
+        t_end_full = time.perf_counter()
+        print("Info: Inserted %d records, annotation count = %d, %f s, %f insertions/s" %
+              (total_records, annotation_count, t_end_full - t_start_full,
+              total_records/(t_end_full - t_start_full)), flush=True)
+
+        return True
+
+    # Open the files member_names in the IMGT tar file filewithpath for
+    # reading, without extracting the archive to disk. The archive is read in
+    # a single pass that stops once all of the files have been found. The
+    # files are read in lock-step, so for an uncompressed archive each file is
+    # read directly from its offset in the archive. Seeking between the files
+    # in a compressed archive would restart the decompression each time, so
+    # each file is decompressed once, as the archive is read, into a temporary
+    # file that is kept in memory if it is small. Returns a (TarFile,
+    # dictionary of file handles keyed on member name) tuple or None on error.
+    # The caller is responsible for closing them with closeImgtFiles().
+    def openImgtFiles(self, filewithpath, member_names):
+        try:
+            # Opening the archive as uncompressed fails if it is compressed.
+            try:
+                tar = tarfile.open(filewithpath, "r:")
+                compressed = False
+            except tarfile.ReadError:
+                tar = tarfile.open(filewithpath)
+                compressed = True
+        except Exception as err:
+            print("ERROR: Unable to open IMGT tar file %s, %s" % (filewithpath, err))
+            return None
+
+        handles = dict()
+        try:
+            # Scan forward to the files rather than using getmember(), which
+            # reads the index of the entire archive first.
+            member = tar.next()
+            while not member is None and len(handles) < len(member_names):
+                member_name = os.path.normpath(member.name)
+                if member_name in member_names and member.isfile():
+                    member_handle = tar.extractfile(member)
+                    if compressed:
+                        spool_handle = tempfile.SpooledTemporaryFile(
+                                           max_size=self.imgt_spool_size)
+                        shutil.copyfileobj(member_handle, spool_handle)
+                        spool_handle.seek(0)
+                        member_handle = spool_handle
+                    handles[member_name] = member_handle
+                member = tar.next()
+            missing_files = [member_name for member_name in member_names
+                             if not member_name in handles]
+            if len(missing_files) > 0:
+                print("ERROR: Could not find %s in IMGT tar file %s"%
+                      (", ".join(missing_files), filewithpath))
+                self.closeImgtFiles(tar, handles)
+                return None
+        except Exception as err:
+            print("ERROR: Unable to read IMGT tar file %s, %s"%(filewithpath, err))
+            self.closeImgtFiles(tar, handles)
+            return None
+        return (tar, handles)
+
+    # Close the TarFile and file handles returned by openImgtFiles().
+    def closeImgtFiles(self, tar, handles):
+        for handle in handles.values():
+            handle.close()
+        tar.close()
+
+    # Process a chunk of IMGT data. mongo_concat is the data frame of the
+    # directly mapped repository fields for the chunk and vquest_chunks is a
+    # dictionary of the raw vquest data frames for the chunk, keyed on the vquest
+    # file name. The mongo_calc_fields, vquest_calc_fields, and vquest_calc_file
+    # arrays describe the repository fields that need to be calculated from the
+    # vquest data. Returns the data frame of repository records ready to insert
+    # or None on error.
+    def processImgtChunk(self, mongo_concat, vquest_chunks, repertoire_link_id,
+                         airr_fields, mongo_calc_fields, vquest_calc_fields,
+                         vquest_calc_file):
+        # Get the AIRR Map object for this class (for convenience).
+        airr_map = self.getAIRRMap()
+        # Set the tags for the repository and iReceptor fields.
+        repository_tag = self.getRepositoryTag()
+        ireceptor_tag = self.getiReceptorTag()
+        # Get the field to use for linking rearrangements to repertoires.
+        rearrangement_link_field = self.getAnnotationLinkIDField()
 
         # Get rid of columns where the column is null.
-        if self.verbose():
-            print("Info: Cleaning up NULL columns", flush=True) 
+        t_stage = self.startStage()
         mongo_concat = mongo_concat.where((pd.notnull(mongo_concat)), "")
 
         # Explicilty store a link for each rearrangement record in this repertoire to
@@ -391,12 +559,12 @@ class IMGT(Rearrangement):
         else:
             print("ERROR: Could not get a repository link field for %s"%
                   (rearrangement_link_field))
-            return False
+            return None
             
         # Set the relevant IDs for the record being inserted. If it fails, don't
         # load any data.
         if not self.checkIDFields(mongo_concat, repertoire_link_id):
-            return False
+            return None
 
         # Generate the substring field, which we use to heavily optmiize junction AA
         # searches. Technically, this should probably be an ir_ field, but because
@@ -405,9 +573,11 @@ class IMGT(Rearrangement):
         if self.verbose():
             print("Info: Computing substring from junction", flush=True) 
         junction_aa = airr_map.getMapping("junction_aa", ireceptor_tag, repository_tag)
-        ir_substring = airr_map.getMapping("ir_substring", ireceptor_tag, repository_tag)
+        ir_substring = self.getSubstringField(
+                           airr_map.getMapping("ir_substring", ireceptor_tag, repository_tag))
         if junction_aa in mongo_concat:
-            mongo_concat[ir_substring] = mongo_concat[junction_aa].apply(Rearrangement.get_substring)
+            mongo_concat[ir_substring] = self.getJunctionSubstringsColumn(
+                                             mongo_concat[junction_aa])
 
         # We want to keep the original vQuest vdj_string data, so we capture that in the
         # ir_vdjgene_string variables.
@@ -432,20 +602,19 @@ class IMGT(Rearrangement):
         mongo_concat["vquest_vgene_string"] = mongo_concat[v_call]
         mongo_concat["vquest_jgene_string"] = mongo_concat[j_call]
         mongo_concat["vquest_dgene_string"] = mongo_concat[d_call]
+        self.endStage("derive", t_stage, len(mongo_concat))
         # Process the IMGT VQuest v/d/j strings and generate the required columns the
         # repository needs, which are [vdj]_call, ir_[vdj]gene_gene, ir_[vdj]gene_family
-        self.processGene(mongo_concat, v_call, v_call, ir_vgene_gene, ir_vgene_family)
+        # If we don't already have a locus (that is the data file didn't provide
+        # one) then calculate the locus based on the v_call array.
+        locus = airr_map.getMapping("locus", ireceptor_tag, repository_tag)
+        self.processGene(mongo_concat, v_call, v_call, ir_vgene_gene, ir_vgene_family,
+                         locus)
         self.processGene(mongo_concat, j_call, j_call, ir_jgene_gene, ir_jgene_family)
         self.processGene(mongo_concat, d_call, d_call, ir_dgene_gene, ir_dgene_family)
-        # If we don't already have a locus (that is the data file didn't provide one) 
-        # then calculate the locus based on the v_call array.
-        locus = airr_map.getMapping("locus", ireceptor_tag, repository_tag)
-        if not locus in mongo_concat:
-            if self.verbose():
-                print("Info: Computing locus from v_call", flush=True) 
-            mongo_concat[locus] = mongo_concat[v_call].apply(Rearrangement.getLocus)
 
         # Generate the junction length values as required.
+        t_stage = self.startStage()
         if self.verbose():
             print("Info: Computing junction lengths", flush=True) 
         junction = airr_map.getMapping("junction", ireceptor_tag, repository_tag)
@@ -478,7 +647,7 @@ class IMGT(Rearrangement):
             repository_field = airr_map.getMapping(value, ireceptor_tag, repository_tag)
 
             # Get the vquest data frame as we use it everywhere.
-            vquest_df = filedict[vquest_calc_file[index]]["vquest_dataframe"]
+            vquest_df = vquest_chunks[vquest_calc_file[index]]
 
             # Perform the calculations required based on the ireceptor based field name.
             if value == "productive":
@@ -672,7 +841,7 @@ class IMGT(Rearrangement):
 
         # Check to make sure all AIRR required columns exist
         if not self.checkAIRRRequired(mongo_concat, airr_fields):
-            return False
+            return None
 
         # Create the created and update values for this block of records. Note that this
         # means that each block of inserts will have the same date.
@@ -681,65 +850,14 @@ class IMGT(Rearrangement):
         ir_updated_at = airr_map.getMapping("ir_updated_at_rearrangement", ireceptor_tag, repository_tag)
         mongo_concat[ir_created_at] = now_str
         mongo_concat[ir_updated_at] = now_str
+        # The rows were counted in the first derive segment.
+        self.endStage("derive", t_stage)
 
         # Transform the data frame so that it meets the repository type requirements
         if not self.mapToRepositoryType(mongo_concat,
                                         airr_map.getRearrangementClass(),
                                         airr_map.getIRRearrangementClass()):
             print("ERROR: Unable to map data to the repository")
-            return False
-
-        # Convert the mongo data frame data into JSON.
-        if self.verbose():
-            print("Info: Creating JSON from Dataframe", flush=True) 
-        t_start_load_= time.perf_counter()
-        t_start = time.perf_counter()
-        records = json.loads(mongo_concat.T.to_json()).values()
-        t_end = time.perf_counter()
-        if self.verbose():
-            print("Info: JSON created, time = %f seconds (%f records/s)" %
-                  ((t_end - t_start),len(records)/(t_end - t_start)), flush=True)
-
-        # The climax: insert the records into the MongoDb collection!
-        if self.verbose():
-            print("Info: Inserting %d records into the repository"%(len(records)), flush=True)
-        t_start = t_start_load = time.perf_counter()
-        self.repositoryInsertRecords(records)
-        t_end = time.perf_counter()
-        if self.verbose():
-            print("Info: Inserted records, time = %f seconds (%f records/s)" %
-                  ((t_end - t_start),len(records)/(t_end - t_start)), flush=True)
+            return None
 
-        # Get the number of annotations for this repertoire
-        if self.verbose():
-            print("Info: Getting the number of annotations for this repertoire", flush=True)
-        t_start = time.perf_counter()
-        annotation_count = self.repositoryCountRecords(repertoire_link_id)
-        if annotation_count == -1:
-            print("ERROR: invalid annotation count (%d), write failed." %
-                  (annotation_count))
-            return False
-
-        t_end = time.perf_counter()
-        if self.verbose():
-            print("Info: Annotation count = %d, time = %f" %
-                  (annotation_count, (t_end - t_start)), flush=True)
-
-        # Set the cached ir_sequeunce_count field for the repertoire/sample.
-        self.repositoryUpdateCount(repertoire_link_id, annotation_count)
-        t_end_load = time.perf_counter()
-        if self.verbose():
-            print("Info: Total load time = %f" % (t_end_load - t_start_load))
-
-        # Clean up annotation files and scratch folder
-        if self.verbose():
-            print("Info: Cleaning up scratch folder: ", self.getScratchFolder())
-        rmtree(self.getScratchFolder())
-
-        # Inform on what we added and the total count for the this record.
-        t_end_full = time.perf_counter()
-        print("Info: Inserted %d records, annotation count = %d, %f s, %f insertions/s" %
-              (len(records), annotation_count, t_end_full - t_start_full,
-              len(records)/(t_end_full - t_start_full)), flush=True)
-
-        return True
+        return mongo_concat
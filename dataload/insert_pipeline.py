@@ -0,0 +1,129 @@
+# Class to overlap the parsing of an annotation file with the writing of the
+# parsed records to the repository. The parser (the producer) puts chunks of
+# records on a bounded queue, and one or more writer threads (the consumers)
+# take the chunks off the queue and insert them into the repository. The depth
+# of the queue limits the number of chunks that are held in memory at any one
+# time, so a slow repository blocks the parser rather than letting the parsed
+# chunks accumulate.
+
+import queue
+import threading
+import time
+
+class InsertPipeline:
+    def __init__(self, insert_function, queue_depth, num_writers=1):
+        # The function used to write a chunk of records, typically the
+        # repositoryInsertRecords method of the parser. It is called from the
+        # writer threads and should return False on failure.
+        self.insert_function = insert_function
+        self.queue_depth = queue_depth
+        self.num_writers = num_writers
+        self.chunk_queue = queue.Queue(maxsize=queue_depth)
+        self.writers = []
+        # Set by a writer if an insert fails, after which the remaining chunks
+        # are discarded and put() returns False.
+        self.failed = False
+        # Set by abort(), after which the remaining chunks are discarded.
+        self.aborted = False
+        # Statistics on the pipeline, the stall times are the time the parser
+        # spent waiting for space on the queue and the time the writers spent
+        # waiting for chunks to write.
+        self.stats_lock = threading.Lock()
+        self.num_chunks = 0
+        self.num_records = 0
+        self.producer_stall = 0.0
+        self.writer_stall = 0.0
+        self.write_time = 0.0
+        self.t_start = 0.0
+
+    # Start the writer threads.
+    def start(self):
+        self.t_start = time.perf_counter()
+        for writer in range(self.num_writers):
+            thread = threading.Thread(target=self.writeChunks,
+                                      name="insert-writer-%d"%(writer))
+            thread.daemon = True
+            thread.start()
+            self.writers.append(thread)
+
+    # The writer thread loop. A None chunk tells the writer to stop.
+    def writeChunks(self):
+        while True:
+            t_wait = time.perf_counter()
+            records = self.chunk_queue.get()
+            t_got = time.perf_counter()
+            if records is None:
+                break
+            if self.failed or self.aborted:
+                continue
+            try:
+                success = self.insert_function(records)
+            except Exception as err:
+                print("ERROR: Unable to write records to repository, %s"%(err))
+                success = False
+            t_written = time.perf_counter()
+            if success is False:
+                self.failed = True
+            with self.stats_lock:
+                self.writer_stall = self.writer_stall + (t_got - t_wait)
+                self.write_time = self.write_time + (t_written - t_got)
+                if not self.failed:
+                    self.num_chunks = self.num_chunks + 1
+                    self.num_records = self.num_records + len(records)
+
+    # Queue a chunk of records for writing, blocking while the queue is full.
+    # Returns False if a writer has failed, in which case the caller should stop
+    # producing chunks.
+    def put(self, records):
+        t_wait = time.perf_counter()
+        while True:
+            if self.failed:
+                return False
+            try:
+                self.chunk_queue.put(records, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.producer_stall = self.producer_stall + (time.perf_counter() - t_wait)
+        return not self.failed
+
+    # Stop the writer threads, once they have written the chunks already on
+    # the queue, and wait for them to finish.
+    def stopWriters(self):
+        for writer in self.writers:
+            self.chunk_queue.put(None)
+        for writer in self.writers:
+            writer.join()
+        self.writers = []
+
+    # Wait for all of the queued chunks to be written and report on the
+    # pipeline. Returns True if all of the chunks were written successfully.
+    def finish(self):
+        self.stopWriters()
+        self.report()
+        if self.failed:
+            print("ERROR: Insert pipeline failed, not all records were written")
+            return False
+        return True
+
+    # Stop the pipeline without writing any chunks that are still queued, used
+    # when the parser gives up on a file part way through.
+    def abort(self):
+        self.aborted = True
+        self.stopWriters()
+
+    # Report the records written and the stall times. If the parser spends
+    # more time waiting for space on the queue than the writers spend waiting
+    # for chunks then the repository writes are the bottleneck, otherwise the
+    # parsing is.
+    def report(self):
+        t_total = time.perf_counter() - self.t_start
+        print("Info: Insert pipeline wrote %d records in %d chunks, %f s, queue depth = %d, writers = %d"%
+              (self.num_records, self.num_chunks, t_total, self.queue_depth,
+               self.num_writers), flush=True)
+        print("Info:     parser stall = %f s, writer stall = %f s, write time = %f s"%
+              (self.producer_stall, self.writer_stall, self.write_time), flush=True)
+        if self.producer_stall > self.writer_stall/self.num_writers:
+            print("Info:     repository writes are the bottleneck", flush=True)
+        else:
+            print("Info:     parsing is the bottleneck", flush=True)
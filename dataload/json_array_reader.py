@@ -0,0 +1,141 @@
+# Class to incrementally read the objects in a JSON array from a file
+
+import json
+import codecs
+
+class JSONArrayReader:
+    # Create a reader for the JSON in file_handle. The file can either contain
+    # a JSON array of objects (as per the AIRR spec for Cell, Expression, Clone,
+    # Receptor, and Reactivity files) or newline delimited JSON, with one object
+    # per line. The file handle can be text or binary (e.g. from gzip.open).
+    # The filename is only used for error reporting.
+    def __init__(self, file_handle, filename, block_size=1048576):
+        self.file_handle = file_handle
+        self.filename = filename
+        # Number of characters to read from the file at a time.
+        self.block_size = block_size
+        # Keep track of the number of objects read so far.
+        self.count = 0
+        # Flag whether an error occurred while reading. Errors stop the
+        # iteration and are reported here, so the caller should check this
+        # after iterating over the reader.
+        self.error = False
+
+        self.decoder = json.JSONDecoder()
+        # The incremental decoder is used for binary files, so that multi-byte
+        # characters split across blocks are decoded correctly.
+        self.byte_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.position = 0
+        # Number of characters dropped from the front of the buffer, so we can
+        # report error locations relative to the start of the file.
+        self.offset = 0
+        self.eof = False
+
+    # Return the number of objects read so far.
+    def getCount(self):
+        return self.count
+
+    # Read the next block from the file into the buffer. Returns False if there
+    # was no more data to read.
+    def readBlock(self):
+        if self.eof:
+            return False
+        block = self.file_handle.read(self.block_size)
+        if len(block) == 0:
+            self.eof = True
+            # Raises an error if the file ends part way through a character.
+            self.byte_decoder.decode(b"", final=True)
+            return False
+        if isinstance(block, bytes):
+            # A block can end part way through a multi-byte character, in
+            # which case the decoder holds on to the partial character.
+            block = self.byte_decoder.decode(block)
+        # Drop the part of the buffer we have already processed before adding
+        # the new data so the buffer doesn't grow with the file.
+        self.offset = self.offset + self.position
+        self.buffer = self.buffer[self.position:] + block
+        self.position = 0
+        return True
+
+    # Skip white space and return the next character in the buffer, or None
+    # if we have reached the end of the file.
+    def nextCharacter(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position].isspace():
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.readBlock():
+                return None
+
+    # Decode the JSON value that starts at the current buffer position, reading
+    # more of the file as required.
+    def decodeValue(self):
+        # Skip any white space before the value, raw_decode doesn't.
+        if self.nextCharacter() is None:
+            raise json.JSONDecodeError("Expecting value", self.buffer, self.position)
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # A number that ends at the end of the buffer, or that is followed
+                # by a character that could be part of it, may continue in the
+                # next block, so only accept it if we can see where it ends.
+                if self.eof or (end < len(self.buffer) and
+                                not self.buffer[end] in ".eE+-0123456789"):
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            if not self.readBlock():
+                # Try one last time at the end of the file, which will either
+                # succeed or raise the appropriate error.
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                self.position = end
+                return value
+
+    # Generate the JSON objects in the file one at a time.
+    def readObjects(self):
+        character = self.nextCharacter()
+        if character is None:
+            raise json.JSONDecodeError("Expecting value", self.buffer, self.position)
+        elif character == "[":
+            # A JSON array, values are separated by "," and the array ends with "]"
+            self.position += 1
+            if self.nextCharacter() == "]":
+                self.position += 1
+            else:
+                while True:
+                    yield self.decodeValue()
+                    character = self.nextCharacter()
+                    if character == ",":
+                        self.position += 1
+                    elif character == "]":
+                        self.position += 1
+                        break
+                    else:
+                        raise json.JSONDecodeError("Expecting ',' delimiter",
+                                                   self.buffer, self.position)
+            if not self.nextCharacter() is None:
+                raise json.JSONDecodeError("Extra data", self.buffer, self.position)
+        else:
+            # Newline delimited JSON, values are separated by white space.
+            while not character is None:
+                yield self.decodeValue()
+                character = self.nextCharacter()
+
+    # Iterate over the objects in the file. Errors are reported and stop the
+    # iteration, setting the error flag.
+    def __iter__(self):
+        try:
+            for json_object in self.readObjects():
+                self.count += 1
+                yield json_object
+        except json.JSONDecodeError as error:
+            print("ERROR: %s: char %d"%(error.msg, self.offset + error.pos))
+            print("ERROR: Invalid JSON in file %s"%(self.filename))
+            self.error = True
+        except Exception as error:
+            print("ERROR: %s"%(error))
+            self.error = True
@@ -0,0 +1,63 @@
+# Classes to validate the objects read from AIRR JSON files (Cell, Expression,
+# Clone, Receptor, and Reactivity files) before or while they are loaded.
+
+class UniqueFieldValidator:
+    # Check that the value of a field is unique across a set of JSON objects.
+    # The values seen so far are kept in a dictionary (value -> position of the
+    # first object with that value), so each check is a constant time lookup
+    # rather than a search through all of the previous values.
+    def __init__(self, field):
+        self.field = field
+        # Position of the first object seen with each value.
+        self.first_positions = dict()
+        # For the values that are duplicated, the positions of all of the
+        # objects that have that value.
+        self.duplicates = dict()
+
+    # Return the field that is being validated.
+    def getField(self):
+        return self.field
+
+    # Check the object at the given position in the file (e.g. the index in the
+    # JSON array). Objects without the field are ignored. Returns True if the
+    # value has not been seen before, False if it is a duplicate.
+    def check(self, json_object, position):
+        if not self.field in json_object:
+            return True
+        value = json_object[self.field]
+        # Values have to be hashable, fall back to the string representation of
+        # values that are not (e.g. lists).
+        try:
+            hash(value)
+        except TypeError:
+            value = str(value)
+
+        if not value in self.first_positions:
+            self.first_positions[value] = position
+            return True
+        if value in self.duplicates:
+            self.duplicates[value].append(position)
+        else:
+            self.duplicates[value] = [self.first_positions[value], position]
+        return False
+
+    # Return True if any duplicate values were found.
+    def hasDuplicates(self):
+        return len(self.duplicates) > 0
+
+    # Return a dictionary of the duplicated values, with each value mapping to
+    # the list of positions of the objects that have that value.
+    def getDuplicates(self):
+        return self.duplicates
+
+    # Print out each duplicated value and the positions at which it occurs.
+    # The message prefix is either "ERROR" or "Warning", as per the rest of the
+    # loader, depending on whether the caller considers the duplicates fatal.
+    def reportDuplicates(self, filename, prefix="ERROR"):
+        for value, positions in self.duplicates.items():
+            print("%s: Duplicate %s %s in file %s at positions %s"%
+                  (prefix, self.field, value, filename,
+                   ", ".join([str(position) for position in positions])))
+        if self.hasDuplicates():
+            print("%s: Found %d duplicated %s values in file %s"%
+                  (prefix, len(self.duplicates), self.field, filename))
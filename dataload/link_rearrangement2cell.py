@@ -256,7 +256,8 @@ def processRearrangements(rearrangement_file, cell_file, repository, airr_map,
     # provided. Note this DOES NOT look at the file, it looks in the database to find all Cells
     # that are associated with the file.
     query = {cell_link_field: {'$eq': cell_link_id}}
-    cell_cursor = repository.cell.find(query)
+    projection = {tool_cell_field: 1, airr_cell_field: 1, '_id': 0}
+    cell_cursor = repository.cell.find(query, projection)
     # For each cell
     for cell in cell_cursor:
         # For each cell (keyed by the barcode), keep track of the repository cell_id (which
@@ -265,6 +266,10 @@ def processRearrangements(rearrangement_file, cell_file, repository, airr_map,
         cell_seq_dict[cell[airr_cell_field]] = []
         #print("Info:     %s = %s"%(cell[tool_cell_field],cell[airr_cell_field]))
 
+    # Keep a set of the repository cell ids, so we can check quickly whether a
+    # rearrangement has already been linked to a cell.
+    repository_cell_ids = set(cell_id_dict.values())
+
     print("Info: Cells found = %d (%s)"%(len(cell_id_dict), cell_count), flush=True)
     print("Info: Rearrangements found = %d"%(rearrangement_count), flush=True)
 
@@ -291,10 +296,16 @@ def processRearrangements(rearrangement_file, cell_file, repository, airr_map,
     # associated with the rearrangement link ID (associated with the file). Note this DOES NOT
     # look at the file, it looks in the database to find all Rearrangements that are
     # associated with the file.
+    # We only need the sequence and cell ID fields from each rearrangement.
     query = {rearrangement_link_field: {'$eq': rearrangement_link_id}}
-    rearrangement_cursor = repository.rearrangement.find(query)
-    # Keep track of the number of updates as we iterate over the cursor.
+    projection = {airr_sequence_id_field: 1, airr_cell_id_field: 1, '_id': 0}
+    rearrangement_cursor = repository.rearrangement.find(query, projection)
+    # Keep track of the number of updates as we iterate over the cursor. Updates
+    # are collected and written to the repository in blocks of database_chunk
+    # updates, as a single bulk write per block.
     update_count = 0
+    update_array = []
+    t_update = 0.0
     for rearrangement in rearrangement_cursor:
         #print("Info:     %s,%s,%s"%(
         #        rearrangement[airr_sequence_id_field],
@@ -312,16 +323,24 @@ def processRearrangements(rearrangement_file, cell_file, repository, airr_map,
             # Get the Cell collection unique ID from the dictionary.
             repository_cell_id = cell_id_dict[this_cell_id]
             # Set the rearrangement cell_id to be the unqique cell_id from the Cell object.
-            repository.updateRearrangementField(airr_sequence_id_field, this_sequence_id,
-                                                airr_cell_id_field, repository_cell_id,
-                                                updated_at_field)
+            update_array.append((this_sequence_id, repository_cell_id))
+            if len(update_array) == options.database_chunk:
+                t_local_start = time.perf_counter()
+                if repository.updateRearrangementFields(airr_sequence_id_field, update_array,
+                                                        airr_cell_id_field,
+                                                        updated_at_field) < 0:
+                    return False
+                t_update = t_update + (time.perf_counter() - t_local_start)
+                update_array = []
+                print("Info: Updated %d rearrangements so far, update time = %f s"%
+                      (update_count + 1, t_update), flush=True)
             # Add the sequence ID to the cell list of rearrangements.
             cell_seq_dict[repository_cell_id].append(this_sequence_id)
             # Update our count.
             update_count = update_count + 1
         else:
             # In this case we can't find the rearrangement cell ID in the dictionary. Why?
-            if this_cell_id in cell_id_dict.values():
+            if this_cell_id in repository_cell_ids:
                 # Check whether the dictionary contains this_cell_id in its values. If it does,
                 # then it is likely that the rearrangement cell_id has already been set to be
                 # the repository unique cell_id.
@@ -329,6 +348,13 @@ def processRearrangements(rearrangement_file, cell_file, repository, airr_map,
             else:
                 # If nothing then we could not find a cell for a sequence, print a warning.
                 print("Warning: Could not find a Cell for sequence %s"%(this_sequence_id), flush=True)
+    # Write any updates that are left over.
+    t_local_start = time.perf_counter()
+    if repository.updateRearrangementFields(airr_sequence_id_field, update_array,
+                                            airr_cell_id_field, updated_at_field) < 0:
+        return False
+    t_update = t_update + (time.perf_counter() - t_local_start)
+
     # If we want to store rearrangement object in the Cell collection, we can do so by looping
     # over the sequence dictionary, but we need to check what is there, append, and make unique
     # so we don't have any duplicates. Not necessary so leaving out for now.
@@ -338,7 +364,7 @@ def processRearrangements(rearrangement_file, cell_file, repository, airr_map,
 
 
     # time end
-    print("Info: Update of %d rearrangements"%(update_count), flush=True)
+    print("Info: Update of %d rearrangements, update time = %f s"%(update_count, t_update), flush=True)
     t_end = time.perf_counter()
     print("Info: Finished processing in %f seconds (%f updates/s)"%(
            (t_end - t_start),(update_count/(t_end-t_start))),flush=True)
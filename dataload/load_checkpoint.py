@@ -0,0 +1,197 @@
+# Class to keep track of how much of an annotation file has been written to
+# the repository, so that a load that fails part way through a large file can
+# be resumed from the first chunk that was not written rather than from the
+# start of the file. After each chunk is written a checkpoint is stored in the
+# repository recording the identity of the file (its name, size and
+# modification time), the number of rows written, and the number of records
+# inserted. The checkpoint is stored for the file and the repertoire it is
+# loaded into, and each load of the file is given a unique load ID. Each
+# record in a chunk is tagged with a chunk tag, made up of the load ID and the
+# row the chunk starts at, so that the records of a chunk that was only
+# partially written can be deleted without touching the records of any other
+# load.
+#
+# The chunks must be committed in the order they appear in the file, so when
+# checkpointing is used with an InsertPipeline there must only be one writer.
+
+import os
+import time
+from bson.objectid import ObjectId
+from parser import Parser
+
+class LoadCheckpoint:
+    # The field in each annotation record that stores the tag of the chunk
+    # the record was written in.
+    chunk_field = "ir_load_chunk"
+
+    def __init__(self, repository, annotation_type, path, link_field, repertoire_id,
+                 verbose=False):
+        self.repository = repository
+        self.annotation_type = annotation_type
+        self.path = path
+        self.file_name = os.path.basename(path)
+        # The repertoire the file is loaded into, and the field in each
+        # annotation record that links it to the repertoire. The link field is
+        # indexed, so it is used to limit the delete of a chunk to the records
+        # of the repertoire.
+        self.link_field = link_field
+        self.repertoire_id = repertoire_id
+        self.verbose = verbose
+        # The identity of the file, used to check that a checkpoint written by
+        # an earlier load is for the same file.
+        file_stat = os.stat(path)
+        self.file_size = file_stat.st_size
+        self.file_mtime = file_stat.st_mtime
+        # The state of the load. The chunk tag of the chunk being written is
+        # stored as pending until the chunk has been written.
+        self.rows_committed = 0
+        self.chunks_committed = 0
+        self.records_inserted = 0
+        self.resumed_records = 0
+        self.pending_chunk = None
+        self.load_id = None
+        self.status = "loading"
+
+    # Get the number of rows in the file that have been written.
+    def getRowsCommitted(self):
+        return self.rows_committed
+
+    # Get the number of records that were inserted by an earlier load that is
+    # being resumed. These are not included in the annotation counts on the
+    # repertoire unless the earlier load got as far as updating the counts.
+    def getResumedRecords(self):
+        return self.resumed_records
+
+    # Check if the checkpoint is for a file that has been loaded completely.
+    def isComplete(self):
+        return self.status == "complete"
+
+    # Check if the checkpoint is for a file whose records have all been
+    # written and added to the annotation count on the repertoire.
+    def isCounted(self):
+        return self.status == "counted"
+
+    # Get the chunk tag for the chunk that starts at the given row. The row
+    # offset rather than the chunk number is used so that a load can be resumed
+    # with a different chunk size.
+    def getChunkTag(self, row_offset):
+        return "%s:%d"%(self.load_id, row_offset)
+
+    # Write the current state of the load to the repository. Returns False if
+    # the checkpoint could not be written.
+    def write(self):
+        checkpoint = {"file_size": self.file_size,
+                      "file_mtime": self.file_mtime,
+                      "rows_committed": self.rows_committed,
+                      "chunks_committed": self.chunks_committed,
+                      "records_inserted": self.records_inserted,
+                      "pending_chunk": self.pending_chunk,
+                      "load_id": self.load_id,
+                      "status": self.status,
+                      "updated_at": Parser.getDateTimeNowUTC()}
+        return self.repository.writeCheckpoint(self.file_name, self.annotation_type,
+                                               self.repertoire_id, checkpoint)
+
+    # Start a new load of the file, replacing any existing checkpoint. The
+    # load is given a new load ID, so its chunk tags can't match the chunk
+    # tags of any earlier load. Returns False on error.
+    def start(self):
+        self.load_id = str(ObjectId())
+        return self.write()
+
+    # Resume the load of the file from an existing checkpoint, if there is
+    # one. The records from a chunk that was being written when the earlier
+    # load failed are deleted. Returns False if the checkpoint could not be
+    # read, the chunk could not be cleaned up, or the checkpoint is for a
+    # different version of the file.
+    def resume(self):
+        checkpoint = self.repository.getCheckpoint(self.file_name, self.annotation_type,
+                                                   self.repertoire_id)
+        if checkpoint is None:
+            return False
+        if len(checkpoint) == 0:
+            print("Info: No checkpoint found for %s, loading from the start of the file"%
+                  (self.file_name))
+            return self.start()
+        if (checkpoint.get("file_size") != self.file_size or
+            checkpoint.get("file_mtime") != self.file_mtime):
+            print("ERROR: Checkpoint for %s is for a different version of the file"%
+                  (self.file_name))
+            return False
+
+        self.rows_committed = checkpoint.get("rows_committed", 0)
+        self.chunks_committed = checkpoint.get("chunks_committed", 0)
+        self.records_inserted = checkpoint.get("records_inserted", 0)
+        self.load_id = checkpoint.get("load_id")
+        if self.load_id is None:
+            self.load_id = str(ObjectId())
+        self.status = checkpoint.get("status", "loading")
+        if self.isComplete():
+            return True
+        # Records that were inserted before the failure need to be counted
+        # once the load finishes, unless the earlier load had already added
+        # them to the count on the repertoire.
+        if self.isCounted():
+            self.resumed_records = 0
+        else:
+            self.resumed_records = self.records_inserted
+
+        # Remove any records from the chunk that was being written when the
+        # previous load failed.
+        pending_chunk = checkpoint.get("pending_chunk")
+        if not pending_chunk is None:
+            if not self.rollbackChunk(pending_chunk):
+                return False
+        print("Info: Resuming load of %s after %d rows (%d chunks)"%
+              (self.file_name, self.rows_committed, self.chunks_committed), flush=True)
+        return True
+
+    # Record that a chunk of records is about to be written and tag the
+    # records with the chunk tag. Returns the chunk tag, or None on error.
+    def startChunk(self, json_records):
+        chunk_tag = self.getChunkTag(self.rows_committed)
+        for record in json_records:
+            record[LoadCheckpoint.chunk_field] = chunk_tag
+        self.pending_chunk = chunk_tag
+        if not self.write():
+            return None
+        return chunk_tag
+
+    # Record that a chunk of num_rows rows, containing num_records records,
+    # has been written. Returns False if the checkpoint could not be written.
+    def commitChunk(self, num_rows, num_records):
+        self.rows_committed = self.rows_committed + num_rows
+        self.chunks_committed = self.chunks_committed + 1
+        self.records_inserted = self.records_inserted + num_records
+        self.pending_chunk = None
+        return self.write()
+
+    # Delete the records that were written for a chunk that failed. Returns
+    # False if the records could not be deleted.
+    def rollbackChunk(self, chunk_tag):
+        t_start = time.perf_counter()
+        deleted = self.repository.deleteAnnotationChunk(self.annotation_type,
+                                                        self.link_field,
+                                                        self.repertoire_id,
+                                                        LoadCheckpoint.chunk_field,
+                                                        chunk_tag)
+        if deleted < 0:
+            print("ERROR: Unable to delete records from chunk %s"%(chunk_tag))
+            return False
+        print("Info: Deleted %d records from incomplete chunk %s, %f s"%
+              (deleted, chunk_tag, time.perf_counter() - t_start), flush=True)
+        self.pending_chunk = None
+        return self.write()
+
+    # Record that all of the records in the file have been written and added
+    # to the annotation count on the repertoire, so that a resumed load
+    # doesn't add them to the count again. Returns False if the checkpoint
+    # could not be written.
+    def counted(self):
+        self.status = "counted"
+        return self.write()
+
+    # Record that the file has been loaded completely.
+    def complete(self):
+        self.status = "complete"
+        return self.write()
@@ -0,0 +1,231 @@
+# Class to record where the time (and memory) goes when a file is loaded. The
+# parsers record the time spent in each of a set of named stages as they
+# process each chunk of a file (see the stage methods in Parser), and the
+# metrics for the file are summarized as a JSON document that can be written
+# to a metrics file (see --metrics-out in dataloader.py) so that loads can be
+# compared and aggregated.
+#
+# For each stage the wall time, number of calls and rows processed are
+# recorded, along with the largest RSS seen at the end of the stage and, if
+# memory tracing is turned on, the peak memory allocated by Python during the
+# stage (from tracemalloc). Tracing memory allocations slows the load down a
+# lot, so it should only be turned on when looking for memory problems.
+#
+# Stages that are run in the insert pipeline writer threads are included in
+# the stage totals but not in the per chunk metrics, as the chunk being
+# written is not the chunk being parsed.
+
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+from parser import Parser
+
+class LoadMetrics:
+    # The stages recorded by the parsers, in the order they are applied to
+    # a chunk. The stats stage is only recorded when the repertoire stats are
+    # computed during the load.
+    stages = ["read", "rename", "derive", "gene", "type_mapping", "serialize",
+              "id_backfill", "insert", "stats"]
+
+    def __init__(self, path, file_type, trace_memory=False):
+        self.path = path
+        self.file_type = file_type
+        self.trace_memory = trace_memory
+        self.parser_name = ""
+        self.status = "loading"
+        self.records = 0
+        self.date = Parser.getDateTimeNowUTC()
+        # The thread that parses the file. Stages run in other threads (the
+        # insert pipeline writers) are not added to the chunk metrics.
+        self.parse_thread = threading.get_ident()
+        self.lock = threading.Lock()
+        self.stage_metrics = dict()
+        self.chunks = []
+        self.chunk = None
+        self.parse_stage_time = 0.0
+        self.start_rss = LoadMetrics.getRSS()
+        self.t_start = time.perf_counter()
+        self.t_end = None
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    # The current resident set size of this process in MB, or None if it
+    # can't be determined.
+    @staticmethod
+    def getRSS():
+        try:
+            with open("/proc/self/statm") as file_handle:
+                pages = int(file_handle.read().split()[1])
+            return round(pages*os.sysconf("SC_PAGE_SIZE")/1e6, 3)
+        except (OSError, ValueError, IndexError):
+            return None
+
+    # The peak resident set size of this process in MB, or None if it can't
+    # be determined.
+    @staticmethod
+    def getPeakRSS():
+        try:
+            import resource
+        except ImportError:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kB, macOS bytes.
+        if sys.platform == "darwin":
+            return round(peak/1e6, 3)
+        return round(peak*1024/1e6, 3)
+
+    # Set the name of the parser that loads the file.
+    def setParserName(self, parser_name):
+        self.parser_name = parser_name
+
+    # Check if a stage is being run by the thread that parses the file.
+    def inParseThread(self):
+        return threading.get_ident() == self.parse_thread
+
+    # Start timing a stage, returning the start time to give to endStage. If
+    # memory is being traced the tracemalloc peak is reset so that the peak
+    # at the end of the stage is the peak for the stage.
+    def startStage(self):
+        if self.trace_memory and self.inParseThread():
+            tracemalloc.reset_peak()
+        return time.perf_counter()
+
+    # Record the end of a stage started at t_start that processed rows rows.
+    def endStage(self, stage, t_start, rows=0):
+        t_stage = time.perf_counter() - t_start
+        rss = LoadMetrics.getRSS()
+        tracemalloc_peak = None
+        if self.trace_memory and self.inParseThread():
+            tracemalloc_peak = round(tracemalloc.get_traced_memory()[1]/1e6, 3)
+        self.addStageTime(stage, t_stage, rows, rss, tracemalloc_peak)
+
+    # Add time spent in a stage that was timed by the caller, typically time
+    # accumulated across the records of a chunk.
+    def addStageTime(self, stage, t_stage, rows=0, rss=None, tracemalloc_peak=None):
+        in_parse_thread = self.inParseThread()
+        with self.lock:
+            if not stage in self.stage_metrics:
+                self.stage_metrics[stage] = {"time": 0.0, "calls": 0, "rows": 0,
+                                             "max_rss_mb": None,
+                                             "tracemalloc_peak_mb": None}
+            metrics = self.stage_metrics[stage]
+            metrics["time"] = metrics["time"] + t_stage
+            metrics["calls"] = metrics["calls"] + 1
+            metrics["rows"] = metrics["rows"] + rows
+            metrics["max_rss_mb"] = LoadMetrics.maxValue(metrics["max_rss_mb"], rss)
+            metrics["tracemalloc_peak_mb"] = LoadMetrics.maxValue(
+                metrics["tracemalloc_peak_mb"], tracemalloc_peak)
+            if not in_parse_thread:
+                return
+            self.parse_stage_time = self.parse_stage_time + t_stage
+            if not self.chunk is None:
+                chunk_stages = self.chunk["stages"]
+                chunk_stages[stage] = chunk_stages.get(stage, 0.0) + t_stage
+                if stage == "read":
+                    self.chunk["rows"] = self.chunk["rows"] + rows
+                self.chunk["tracemalloc_peak_mb"] = LoadMetrics.maxValue(
+                    self.chunk["tracemalloc_peak_mb"], tracemalloc_peak)
+
+    # The larger of two values, either of which may be None.
+    @staticmethod
+    def maxValue(value1, value2):
+        if value1 is None:
+            return value2
+        if value2 is None:
+            return value1
+        return max(value1, value2)
+
+    # Start a new chunk, ending the current chunk if there is one. The chunk
+    # starts at t_start if given (e.g. the time the chunk started to be read).
+    def startChunk(self, t_start=None):
+        self.endChunk()
+        if t_start is None:
+            t_start = time.perf_counter()
+        with self.lock:
+            self.chunk = {"chunk": len(self.chunks), "rows": 0, "t_start": t_start,
+                          "stages": dict(), "tracemalloc_peak_mb": None}
+
+    # End the current chunk, if there is one, recording its wall time and the
+    # RSS at the end of the chunk.
+    def endChunk(self):
+        with self.lock:
+            chunk = self.chunk
+            self.chunk = None
+        if chunk is None:
+            return
+        chunk["time"] = round(time.perf_counter() - chunk.pop("t_start"), 6)
+        chunk["stages"] = {stage: round(t_stage, 6)
+                           for stage, t_stage in chunk["stages"].items()}
+        chunk["rss_mb"] = LoadMetrics.getRSS()
+        self.chunks.append(chunk)
+
+    # Record the end of the load of the file, with its status and the number
+    # of records written.
+    def finish(self, status, records):
+        self.endChunk()
+        self.t_end = time.perf_counter()
+        self.status = status
+        self.records = records
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    # Get the metrics as a JSON serializable dictionary.
+    def getSummary(self):
+        t_end = self.t_end if not self.t_end is None else time.perf_counter()
+        total_time = t_end - self.t_start
+        stages = dict()
+        ordered_stages = ([stage for stage in LoadMetrics.stages if stage in self.stage_metrics] +
+                          [stage for stage in self.stage_metrics if not stage in LoadMetrics.stages])
+        for stage in ordered_stages:
+            metrics = dict(self.stage_metrics[stage])
+            metrics["rows_per_second"] = (round(metrics["rows"]/metrics["time"], 3)
+                                          if metrics["time"] > 0 else None)
+            metrics["time"] = round(metrics["time"], 6)
+            stages[stage] = metrics
+        return {"file": self.path,
+                "type": self.file_type,
+                "parser": self.parser_name,
+                "status": self.status,
+                "date": self.date,
+                "pid": os.getpid(),
+                "records": self.records,
+                "total_time": round(total_time, 6),
+                "records_per_second": (round(self.records/total_time, 3)
+                                       if total_time > 0 else None),
+                # The time in the parse thread that is not in any of the stages
+                # (e.g. setting up the load and updating the repertoire counts).
+                "other_time": round(max(0.0, total_time - self.parse_stage_time), 6),
+                "start_rss_mb": self.start_rss,
+                "end_rss_mb": LoadMetrics.getRSS(),
+                "peak_rss_mb": LoadMetrics.getPeakRSS(),
+                "trace_memory": self.trace_memory,
+                "stages": stages,
+                "chunks": self.chunks}
+
+    # Print a one line summary of the time spent in each stage.
+    def printSummary(self):
+        summary = self.getSummary()
+        stage_times = ", ".join(["%s %.3f s"%(stage, metrics["time"])
+                                 for stage, metrics in summary["stages"].items()])
+        print("Info: Stage times for %s: %s, other %.3f s"%
+              (os.path.basename(self.path), stage_times, summary["other_time"]),
+              flush=True)
+
+    # Append the summary to a metrics file, one JSON document per line. Each
+    # summary is written with a single write so that worker processes loading
+    # files at the same time can share a metrics file. Returns False on error.
+    def write(self, filename):
+        line = (json.dumps(self.getSummary()) + "\n").encode("utf-8")
+        try:
+            file_descriptor = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(file_descriptor, line)
+            finally:
+                os.close(file_descriptor)
+        except OSError as err:
+            print("ERROR: Unable to write load metrics to %s, %s"%(filename, err))
+            return False
+        return True
@@ -5,12 +5,10 @@ import sys
 import os.path
 import pandas as pd
 import numpy as np 
-import json
 import gzip
 import time
 
 from clone import Clone
-from annotation import Annotation
 from parser import Parser
 
 class MiXCR_Clone(Clone):
@@ -148,10 +146,11 @@ class MiXCR_Clone(Clone):
 
         # Iterate over the file a chunk at a time. Each chunk is a data frame.
         total_records = 0
-        for df_chunk in df_reader:
+        for df_chunk in self.meteredChunks(df_reader):
 
             if self.verbose():
                 print("Info: Processing raw data frame...", flush=True)
+            t_stage = self.startStage()
             # Remap the column names. We need to remap because the columns may be in 
             # a different order in the file than in the column mapping. We leave any
             # non-mapped columns in the data frame as we don't want to discard data.
@@ -173,21 +172,23 @@ class MiXCR_Clone(Clone):
                     if self.verbose():
                         print("Info: Missing data in input %s file for %s"
                               %(self.getAnnotationTool(), mixcr_column))
-            
+            self.endStage("rename", t_stage, len(df_chunk))
+
+            t_stage = self.startStage()
             # Build the substring array that allows index for fast searching of
             # Junction AA substrings. Also calculate junction AA length
             junction_aa = airr_map.getMapping("junction_aa",
                                               ireceptor_tag, repository_tag)
-            ir_substring = airr_map.getMapping("ir_substring_clone",
-                                               ireceptor_tag, repository_tag)
+            ir_substring = self.getSubstringField(airr_map.getMapping(
+                               "ir_substring_clone", ireceptor_tag, repository_tag))
             ir_junc_aa_len = airr_map.getMapping("ir_junction_aa_length_clone",
                                                ireceptor_tag, repository_tag)
             if junction_aa in df_chunk:
                 if self.verbose():
                     print("Info: Computing junction amino acids substrings...",
                           flush=True)
-                df_chunk[ir_substring] = df_chunk[junction_aa].apply(
-                                                 Annotation.get_substring)
+                df_chunk[ir_substring] = self.getJunctionSubstringsColumn(
+                                                 df_chunk[junction_aa])
                 if self.verbose():
                     print("Info: Computing junction amino acids length...", flush=True)
                 df_chunk[ir_junc_aa_len] = df_chunk[junction_aa].apply(
@@ -221,18 +222,19 @@ class MiXCR_Clone(Clone):
                                                 ireceptor_tag, repository_tag)
             ir_jgene_family = airr_map.getMapping("ir_jgene_family_clone", 
                                                 ireceptor_tag, repository_tag)
+            self.endStage("derive", t_stage, len(df_chunk))
 
             # Build the v_call field, as an array if there is more than one gene
             # assignment made by the annotator.
-            self.processGene(df_chunk, v_call, v_call, ir_vgene_gene, ir_vgene_family)
-            self.processGene(df_chunk, j_call, j_call, ir_jgene_gene, ir_jgene_family)
-            self.processGene(df_chunk, d_call, d_call, ir_dgene_gene, ir_dgene_family)
             # If we don't already have a locus (that is the data file didn't provide
             # one) then calculate the locus based on the v_call array.
             locus = airr_map.getMapping("locus", ireceptor_tag, repository_tag)
-            if not locus in df_chunk:
-                df_chunk[locus] = df_chunk[v_call].apply(Annotation.getLocus)
+            self.processGene(df_chunk, v_call, v_call, ir_vgene_gene, ir_vgene_family,
+                             locus)
+            self.processGene(df_chunk, j_call, j_call, ir_jgene_gene, ir_jgene_family)
+            self.processGene(df_chunk, d_call, d_call, ir_dgene_gene, ir_dgene_family)
 
+            t_stage = self.startStage()
             # Assign each record the constant fields for all records in the chunk
             productive = airr_map.getMapping("productive",
                                              ireceptor_tag, repository_tag)
@@ -277,6 +279,8 @@ class MiXCR_Clone(Clone):
                                                 ireceptor_tag, repository_tag)
             df_chunk[ir_created_at] = now_str
             df_chunk[ir_updated_at] = now_str
+            # The rows were counted in the first derive segment.
+            self.endStage("derive", t_stage)
 
             # Transform the data frame so that it meets the repository type requirements
             if not self.mapToRepositoryType(df_chunk,
@@ -288,8 +292,9 @@ class MiXCR_Clone(Clone):
             # Insert the chunk of records into Mongo.
             num_records = len(df_chunk)
             print("Info: Inserting", num_records, "records into Mongo...", flush=True)
-            t_start = time.perf_counter()
-            records = json.loads(df_chunk.T.to_json()).values()
+            t_start = self.startStage()
+            records = self.dataFrameToRecords(df_chunk)
+            self.endStage("serialize", t_start, num_records)
             self.repositoryInsertRecords(records)
             t_end = time.perf_counter()
             print("Info: Inserted records, time =", (t_end - t_start),
@@ -299,18 +304,16 @@ class MiXCR_Clone(Clone):
             total_records = total_records + num_records
             print("Info: Total records so far =", total_records, flush=True)
 
-        # Get the number of annotations for this repertoire 
+        # Increment the cached count field for the repertoire by the number of
+        # annotations inserted for it, rather than counting all of the
+        # annotations that belong to the repertoire. The cached counts can be
+        # reconciled with the annotations in the repository using recount.py.
         if self.verbose():
-            print("Info: Getting the number of annotations for this repertoire")
-        annotation_count = self.repositoryCountRecords(repertoire_link_id)
+            print("Info: Updating the number of annotations for repertoire %s"%
+                  (str(repertoire_link_id)), flush=True)
+        annotation_count = self.repositoryIncrementCount(repertoire_link_id)
         if annotation_count == -1:
-            print("ERROR: invalid annotation count (%d), write failed." %
-                  (annotation_count))
-            return False
-
-        # Set the cached ir_sequeunce_count field for the repertoire/sample.
-        if not self.repositoryUpdateCount(repertoire_link_id, annotation_count):
-            print("ERROR: Unable to write clone count to repository.")
+            print("ERROR: Unable to write annotation count to repository.")
             return False
 
         # Inform on what we added and the total count for the this record.
@@ -6,6 +6,7 @@ from datetime import datetime
 from datetime import timezone
 import re
 import os
+import time
 import pandas as pd
 import numpy as np
 
@@ -91,6 +92,10 @@ class Parser:
         # set by the subclass (Rearrangement, Clone, Cell, or Expression).
         self.annotation_linkid_field = ""
 
+        # The LoadMetrics object that records the time spent in each stage of
+        # the load of a file, or None if the metrics are not being recorded.
+        self.metrics = None
+
     # Sanity check for validity for the parser...
     def checkValidity(self):
         if not self.airr_map.hasColumn(self.ireceptor_tag):
@@ -299,6 +304,119 @@ class Parser:
         # If we get here we failed...
         raise TypeError("Can't convert value %s (%s) to boolean"%(str(value), type(value)))
 
+    # Column (pandas Series) versions of to_string, to_number, to_integer and
+    # to_boolean. These convert a whole column at once using pandas vectorized
+    # operations rather than calling the scalar converter on every value. They
+    # give the same values as the scalar converters, with integer and boolean
+    # columns using the pandas nullable Int64 and boolean types so that nulls
+    # don't force a column to float or object. If a column can't be converted
+    # this way (mixed types, lists, or invalid values) None is returned and the
+    # caller should use the scalar converter, which will also generate the
+    # appropriate error for any values that are not valid.
+    @staticmethod
+    def column_to_string(column):
+        value_type = pd.api.types.infer_dtype(column, skipna=True)
+        # Strings and columns of nulls need no conversion.
+        if value_type in ["string", "empty"]:
+            return column
+        # Simple (non object) numeric and boolean columns, converted with str()
+        # semantics, keeping nulls as nulls.
+        elif column.dtype != object and value_type in ["integer", "floating", "boolean"]:
+            return column.astype(str).where(column.notnull(), np.nan)
+        return None
+
+    @staticmethod
+    def column_to_number(column):
+        value_type = pd.api.types.infer_dtype(column, skipna=True)
+        if value_type == "empty":
+            return column.astype("float64")
+        elif column.dtype != object and value_type in ["integer", "floating", "boolean"]:
+            return column.astype("float64")
+        elif value_type == "string":
+            # Empty strings are nulls, everything else must convert.
+            values = column.where(column != "", np.nan)
+            number_column = pd.to_numeric(values, errors="coerce")
+            if (number_column.isnull() & values.notnull()).any():
+                return None
+            return number_column.astype("float64")
+        return None
+
+    @staticmethod
+    def column_to_integer(column):
+        value_type = pd.api.types.infer_dtype(column, skipna=True)
+        if value_type == "empty":
+            return column
+        # Integer (and boolean, which Python treats as integer) columns are OK.
+        elif column.dtype != object and value_type in ["integer", "boolean"]:
+            return column
+        # Floats must all be integer values.
+        elif column.dtype != object and value_type == "floating":
+            values = column.dropna()
+            if not (np.isfinite(values) & (values == np.floor(values))).all():
+                return None
+            return column.astype("Int64")
+        elif value_type == "string":
+            # Empty strings are nulls, everything else must be an integer string.
+            values = column.where(column != "", np.nan)
+            if not values.dropna().str.fullmatch(r"\s*[+-]?\d+\s*").all():
+                return None
+            try:
+                return pd.to_numeric(values).astype("Int64")
+            except (ValueError, TypeError, OverflowError):
+                return None
+        return None
+
+    @staticmethod
+    def column_to_boolean(column):
+        value_type = pd.api.types.infer_dtype(column, skipna=True)
+        if value_type == "empty":
+            return column
+        elif value_type == "boolean":
+            if column.dtype == bool:
+                return column
+            return column.astype("boolean")
+        # Integer columns must only contain 0 and 1.
+        elif column.dtype != object and value_type == "integer":
+            if not column.isin([0, 1]).all():
+                return None
+            return column.astype(bool)
+        elif value_type == "string":
+            true_values = column.isin(["T","t","True","TRUE","true","1"])
+            false_values = column.isin(["F","f","False","FALSE","false","0"])
+            if not (true_values | false_values | column.isnull()).all():
+                return None
+            bool_column = pd.Series(pd.NA, index=column.index, dtype="boolean")
+            bool_column[true_values] = True
+            bool_column[false_values] = False
+            return bool_column
+        return None
+
+    # Convert a data frame into a list of records (dictionaries), one per row,
+    # that can be written directly to the repository. Null values (NaN, NA) are
+    # mapped to None and numpy scalars to the equivalent python values, giving
+    # the same records as converting the data frame to JSON and back but
+    # without the transpose and the JSON string, both of which are copies of
+    # the full data frame.
+    @staticmethod
+    def dataFrameToRecords(df):
+        column_values = []
+        for (column, column_data) in df.items():
+            not_null = column_data.notnull().to_numpy()
+            # Object columns can contain anything (lists, strings, numpy scalars)
+            # so check each value. Other columns convert to python values
+            # with tolist().
+            if column_data.dtype == object:
+                values = [value.item() if isinstance(value, np.generic) else value
+                          for value in column_data.tolist()]
+            else:
+                values = column_data.tolist()
+            if not not_null.all():
+                values = [value if valid else None
+                          for (value, valid) in zip(values, not_null)]
+            column_values.append(values)
+        columns = list(df.columns)
+        return [dict(zip(columns, row)) for row in zip(*column_values)]
+
     @staticmethod
     def str_to_bool(string_value):
         # Null values are OK, as are string variations of various types...
@@ -790,6 +908,90 @@ class Parser:
     # Hide the internal implementation of performing timing functions.
     #####################################################################################
 
+    # Set the LoadMetrics object used to record the stages of the load of a
+    # file, or None to stop recording them.
+    def setMetrics(self, metrics):
+        self.metrics = metrics
+        if not metrics is None:
+            metrics.setParserName(type(self).__name__)
+
+    def getMetrics(self):
+        return self.metrics
+
+    # Start timing a stage of the load (one of LoadMetrics.stages), returning
+    # the start time to pass to endStage.
+    def startStage(self):
+        if self.metrics is None:
+            return time.perf_counter()
+        return self.metrics.startStage()
+
+    # Record the end of a stage started at t_start that processed rows rows.
+    def endStage(self, stage, t_start, rows=0):
+        if not self.metrics is None:
+            self.metrics.endStage(stage, t_start, rows)
+
+    # Record time spent in a stage that was timed by the parser, for stages
+    # that are timed a record at a time and accumulated over a chunk.
+    def addStageTime(self, stage, t_stage, rows=0):
+        if not self.metrics is None:
+            self.metrics.addStageTime(stage, t_stage, rows)
+
+    # Start a new chunk of the file (ending the current chunk), starting at
+    # t_start if given.
+    def startMetricsChunk(self, t_start=None):
+        if not self.metrics is None:
+            self.metrics.startChunk(t_start)
+
+    # End the current chunk of the file.
+    def endMetricsChunk(self):
+        if not self.metrics is None:
+            self.metrics.endChunk()
+
+    # Iterate over the chunks (e.g. data frames) from a reader, recording the
+    # time taken to read each chunk as the read stage of a new chunk.
+    def meteredChunks(self, reader):
+        iterator = iter(reader)
+        while True:
+            t_start = self.startStage()
+            chunk = next(iterator, None)
+            if chunk is None:
+                self.endMetricsChunk()
+                return
+            self.startMetricsChunk(t_start)
+            self.endStage("read", t_start, len(chunk))
+            yield chunk
+
+    # Iterate over the records from a reader (e.g. a JSONArrayReader), where
+    # the records are written in chunks of chunk_size records. The time taken
+    # to read the records of each chunk is recorded as the read stage of the
+    # chunk. The last chunk is left open so that the parser can write it, and
+    # should be ended with endMetricsChunk.
+    def meteredRecords(self, reader, chunk_size):
+        if self.metrics is None:
+            yield from reader
+            return
+        iterator = iter(reader)
+        end = object()
+        rows = 0
+        t_read = 0.0
+        while True:
+            t_start = time.perf_counter()
+            record = next(iterator, end)
+            t_end = time.perf_counter()
+            if record is end:
+                break
+            if rows == 0:
+                self.startMetricsChunk(t_start)
+            t_read = t_read + (t_end - t_start)
+            rows = rows + 1
+            if rows == chunk_size:
+                self.addStageTime("read", t_read, rows)
+                rows = 0
+                t_read = 0.0
+            yield record
+        if rows > 0:
+            self.addStageTime("read", t_read, rows)
+
     @staticmethod
     def getDateTimeNowUTC():
         # Use AIRR Standard/YAML data-time ISO standard.
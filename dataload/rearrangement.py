@@ -7,9 +7,13 @@ from datetime import timezone
 import re
 import os
 import time
+import threading
 import pandas as pd
 import numpy as np
 from annotation import Annotation
+from insert_pipeline import InsertPipeline
+from load_checkpoint import LoadCheckpoint
+from repertoire_stats import RepertoireStats
 
 
 class Rearrangement(Annotation):
@@ -25,7 +29,211 @@ class Rearrangement(Annotation):
         # each rearrangemnt record. This overrides the Annotation class value for
         # this field.
         self.annotation_linkid_field = "ir_annotation_set_metadata_id_rearrangement"
+        # The field in the repertoire collection that caches the number of
+        # annotations of this type that belong to the repertoire.
+        self.annotation_count_field = self.getRearrangementCountField()
+        # Parsers can overlap the parsing of a file with the writing of the
+        # rearrangements to the repository using an InsertPipeline. A queue
+        # depth of 0 means that each chunk is written as soon as it is parsed.
+        self.pipeline_depth = 0
+        self.pipeline_writers = 1
+        self.insert_pipeline = None
+        # Parsers that support it can write a LoadCheckpoint after each chunk
+        # so that a failed load can be resumed. The checkpoint mode is None
+        # (no checkpoints), "start" (start a new load) or "resume" (resume an
+        # earlier load from its checkpoint).
+        self.checkpoint_mode = None
+        self.load_checkpoint = None
+        # Parsers can compute the repertoire stats (as generated by
+        # stats_create.py) as the rearrangements are written, rather than
+        # reading them back from the repository after the load. The stats are
+        # kept for each repertoire, and as the insert pipeline writers add to
+        # them they are protected by a lock.
+        self.load_stats = False
+        self.repertoire_stats = dict()
+        self.repertoire_stats_lock = threading.Lock()
 
+    # Set the number of parsed chunks that can be queued waiting to be written
+    # and the number of writer threads that write them. A queue depth of 0
+    # turns the pipeline off. Returns False if the values are not valid.
+    def setInsertPipeline(self, queue_depth, writers=1):
+        if queue_depth < 0:
+            print("ERROR: Invalid insert pipeline queue depth %d"%(queue_depth))
+            return False
+        if writers < 1:
+            print("ERROR: Invalid number of insert pipeline writers %d"%(writers))
+            return False
+        self.pipeline_depth = queue_depth
+        self.pipeline_writers = writers
+        return True
+
+    def getInsertPipelineDepth(self):
+        return self.pipeline_depth
+
+    def getInsertPipelineWriters(self):
+        return self.pipeline_writers
+
+    # Start the insert pipeline for a file, if the pipeline is turned on.
+    def startInsertPipeline(self):
+        self.stopInsertPipeline()
+        if self.pipeline_depth > 0:
+            # Checkpointed chunks have to be written in order, so only one
+            # writer is used.
+            writers = self.pipeline_writers
+            if not self.load_checkpoint is None and writers > 1:
+                print("Warning: Using a single insert pipeline writer for checkpoints")
+                writers = 1
+            self.insert_pipeline = InsertPipeline(self.getChunkInsertFunction(),
+                                                  self.pipeline_depth,
+                                                  writers)
+            self.insert_pipeline.start()
+
+    # Insert a chunk of records. If the insert pipeline is running the chunk is
+    # queued for the writer threads, blocking while the queue is full, otherwise
+    # the records are inserted directly. Returns False if the pipeline failed.
+    def insertRecordChunk(self, json_records):
+        if self.insert_pipeline is None:
+            if not self.load_checkpoint is None:
+                return self.repositoryInsertCheckpointChunk(json_records)
+            return self.repositoryInsertRecords(json_records)
+        return self.insert_pipeline.put(json_records)
+
+    # Get the word describing what insertRecordChunk did with a chunk, for the
+    # progress messages. When the insert pipeline is running the chunk is only
+    # queued, and the time taken to write it is reported by the pipeline.
+    def getChunkInsertAction(self):
+        if self.insert_pipeline is None:
+            return "Inserted"
+        return "Queued"
+
+    # Get the function used to write each chunk of records.
+    def getChunkInsertFunction(self):
+        if self.load_checkpoint is None:
+            return self.repositoryInsertRecords
+        return self.repositoryInsertCheckpointChunk
+
+    # Wait for the insert pipeline to write all of the queued chunks. This must
+    # be called before the records in the repository are counted. Returns False
+    # if any of the chunks could not be written.
+    def finishInsertPipeline(self):
+        if self.insert_pipeline is None:
+            return True
+        pipeline = self.insert_pipeline
+        self.insert_pipeline = None
+        return pipeline.finish()
+
+    # Stop an insert pipeline that is still running, discarding any queued
+    # chunks. This cleans up after a file that failed part way through.
+    def stopInsertPipeline(self):
+        if not self.insert_pipeline is None:
+            self.insert_pipeline.abort()
+            self.insert_pipeline = None
+
+    # Turn on checkpoints for the files loaded by this parser. If resume is
+    # True the load of each file continues from its checkpoint, otherwise the
+    # load starts from the beginning of the file.
+    def setCheckpoint(self, resume):
+        if resume:
+            self.checkpoint_mode = "resume"
+        else:
+            self.checkpoint_mode = "start"
+
+    def getCheckpointMode(self):
+        return self.checkpoint_mode
+
+    # Set up the checkpoint for a file, if checkpoints are turned on. When
+    # resuming, the records written by the earlier load are added to the
+    # number of records inserted for the repertoire. Returns the number of rows
+    # at the start of the file that have already been written, or -1 on error.
+    def startCheckpoint(self, path, repertoire_id):
+        self.load_checkpoint = None
+        if self.checkpoint_mode is None:
+            return 0
+        link_field = self.airr_map.getMapping(self.getAnnotationLinkIDField(),
+                                              self.ireceptor_tag,
+                                              self.repository_tag)
+        load_checkpoint = LoadCheckpoint(self.repository, "rearrangement", path,
+                                         link_field, repertoire_id, self.verbose())
+        if self.checkpoint_mode == "resume":
+            if not load_checkpoint.resume():
+                return -1
+            self.addInsertedCount(repertoire_id, load_checkpoint.getResumedRecords())
+        elif not load_checkpoint.start():
+            return -1
+        self.load_checkpoint = load_checkpoint
+        return load_checkpoint.getRowsCommitted()
+
+    # Check if the checkpoint for the current file says it is already loaded.
+    def checkpointComplete(self):
+        return not self.load_checkpoint is None and self.load_checkpoint.isComplete()
+
+    # Record that the records in the current file have been added to the
+    # annotation count on the repertoire. Returns False on error.
+    def countCheckpoint(self):
+        if self.load_checkpoint is None:
+            return True
+        return self.load_checkpoint.counted()
+
+    # Record that the current file has been loaded completely.
+    def finishCheckpoint(self):
+        if self.load_checkpoint is None:
+            return True
+        load_checkpoint = self.load_checkpoint
+        self.load_checkpoint = None
+        return load_checkpoint.complete()
+
+
+    # Turn on the computation of the repertoire stats as records are loaded.
+    def setLoadStats(self, load_stats):
+        self.load_stats = load_stats
+
+    def getLoadStats(self):
+        return self.load_stats
+
+    # Clear the stats computed so far, at the start of the load of a file.
+    def startLoadStats(self):
+        with self.repertoire_stats_lock:
+            self.repertoire_stats = dict()
+
+    # Add a set of records that have been written to the repository to the
+    # stats for their repertoires. The repertoire is given by the annotation
+    # link field of each record.
+    def accumulateStats(self, json_records):
+        link_field = self.airr_map.getMapping(self.getAnnotationLinkIDField(),
+                                              self.ireceptor_tag,
+                                              self.repository_tag)
+        repertoire_records = dict()
+        for record in json_records:
+            repertoire_records.setdefault(record.get(link_field), []).append(record)
+        with self.repertoire_stats_lock:
+            for repertoire_id, records in repertoire_records.items():
+                if not repertoire_id in self.repertoire_stats:
+                    self.repertoire_stats[repertoire_id] = RepertoireStats(repertoire_id)
+                self.repertoire_stats[repertoire_id].addRecordBatch(records)
+
+    # Write the stats computed for the given repertoire during this load to
+    # the stat collection. The counts are added to any existing stats for the
+    # repertoire, as the rearrangements for a repertoire can be loaded from
+    # more than one file. Returns the number of stats written, or -1 on error.
+    def repositoryWriteStats(self, repertoire_id):
+        if not self.load_stats:
+            return 0
+        repertoire_field = self.airr_map.getMapping(self.getRepertoireLinkIDField(),
+                                                    self.ireceptor_tag,
+                                                    self.repository_tag)
+        with self.repertoire_stats_lock:
+            stats = self.repertoire_stats.pop(repertoire_id, None)
+        if stats is None:
+            return 0
+        t_start = time.perf_counter()
+        stat_documents = stats.getStatDocuments(repertoire_field)
+        if self.repository.incrementStats(stat_documents,
+                                          [repertoire_field, "name", "value"]) < 0:
+            return -1
+        print("Info: Wrote %d stats for repertoire %s, %f s"%
+              (len(stat_documents), str(repertoire_id), time.perf_counter() - t_start),
+              flush=True)
+        return len(stat_documents)
 
     # Method to map a dataframe to the repository type mapping.
     # TODO: Deprecated - remove
@@ -120,29 +328,49 @@ class Rearrangement(Annotation):
     # This is hiding the Mongo implementation. Probably should refactor the 
     # repository implementation completely.
     def repositoryInsertRecords(self, json_records):
-        # Insert the JSON and get a list of IDs back. If no data returned, return an error
-        record_ids = self.repository.insertRearrangements(json_records)
-        if record_ids is None:
-            return False
         # Get the field we want to map for the rearrangement ID for each record.
         rearrange_id_field =  self.getAIRRMap().getMapping("rearrangement_id",
                                               self.getiReceptorTag(),
                                               self.getRepositoryTag(),
                                               self.getAIRRMap().getRearrangementClass())
-        # Get the field in the repository that is used to store data update time
-        updated_at_field = self.getAIRRMap().getMapping("ir_updated_at_rearrangement",
-                                              self.getiReceptorTag(),
-                                              self.getRepositoryTag())
 
-        # If we found a repository record, write a string repersentation of the ID 
-        # returned into the rearrangement_id field.
-        if not rearrange_id_field is None:
-            for record_id in record_ids:
-                self.repository.updateRearrangementField("_id", record_id,
-                                      rearrange_id_field, str(record_id), updated_at_field)
+        # Assign the repository ID for each record before we insert, storing a
+        # string repersentation of the ID in the rearrangement_id field. This
+        # saves us from having to update each record after it is inserted.
+        t_start = self.startStage()
+        json_records = self.repository.setRecordIDs(json_records, rearrange_id_field)
+        self.endStage("id_backfill", t_start, len(json_records))
+
+        # Insert the JSON and get a list of IDs back. If no data returned, return an error
+        t_start = self.startStage()
+        record_ids = self.repository.insertRearrangements(json_records)
+        self.endStage("insert", t_start, len(json_records))
+        if record_ids is None:
+            return False
+
+        # Keep track of the records inserted for each repertoire, and their
+        # stats if requested.
+        self.countInsertedRecords(json_records)
+        if self.load_stats:
+            t_start = self.startStage()
+            self.accumulateStats(json_records)
+            self.endStage("stats", t_start, len(json_records))
 
         return True
 
+    # Write a chunk of records as in repositoryInsertRecords, updating the load
+    # checkpoint before and after the write. Each record is tagged with the
+    # chunk tag so that if the write fails the records that were written can
+    # be deleted. Returns False if the chunk was not written.
+    def repositoryInsertCheckpointChunk(self, json_records):
+        chunk_tag = self.load_checkpoint.startChunk(json_records)
+        if chunk_tag is None:
+            return False
+        if not self.repositoryInsertRecords(json_records):
+            self.load_checkpoint.rollbackChunk(chunk_tag)
+            return False
+        return self.load_checkpoint.commitChunk(len(json_records), len(json_records))
+
     # Count the number of rearrangements that belong to a specific repertoire. Note: In our
     # early implementations, we had an internal field name called ir_project_sample_id. We
     # want to hide this and just talk about reperotire IDs, so this is hidden in the 
@@ -25,6 +25,9 @@ class Receptor(Annotation):
         # each annotation record. This overrides the Annotation class value for
         # this field.
         self.annotation_linkid_field = "ir_annotation_set_metadata_id_receptor"
+        # The field in the repertoire collection that caches the number of
+        # annotations of this type that belong to the repertoire.
+        self.annotation_count_field = self.getReceptorCountField()
 
 
     #####################################################################################
@@ -36,25 +39,28 @@ class Receptor(Annotation):
     # This is hiding the Mongo implementation. Probably should refactor the 
     # repository implementation completely.
     def repositoryInsertRecords(self, json_records):
-        # Insert the JSON and get a list of IDs back. If no data returned, return an error
-        record_ids = self.repository.insertReceptors(json_records)
-        if record_ids is None:
-            return False
         # Get the field we want to map for the receptor ID for each record.
         receptor_id_field =  self.getAIRRMap().getMapping("receptor_id_receptor",
                                               self.getiReceptorTag(),
                                               self.getRepositoryTag(),
                                               self.getAIRRMap().getReceptorClass())
-        # If we found a repository record, write a string repersentation of the ID 
-        # returned into the receptor_id field.
-        if not receptor_id_field is None:
-            # Check to make sure we have a list if a single instance is returned.
-            if not isinstance(record_ids, list):
-                record_ids = [ record_ids ]
-            # Over write the field.
-            for record_id in record_ids:
-                self.repository.updateReceptorField("_id", record_id,
-                                                    receptor_id_field, str(record_id))
+
+        # Assign the repository ID for each record before we insert, storing a
+        # string repersentation of the ID in the receptor_id field. This saves us
+        # from having to update each record after it is inserted.
+        t_start = self.startStage()
+        json_records = self.repository.setRecordIDs(json_records, receptor_id_field)
+        self.endStage("id_backfill", t_start, len(json_records))
+
+        # Insert the JSON and get a list of IDs back. If no data returned, return an error
+        t_start = self.startStage()
+        record_ids = self.repository.insertReceptors(json_records)
+        self.endStage("insert", t_start, len(json_records))
+        if record_ids is None:
+            return False
+
+        # Keep track of the records inserted for each repertoire.
+        self.countInsertedRecords(json_records)
 
         return True
 
@@ -0,0 +1,283 @@
+#! /opt/ireceptor/data/bin/python
+"""
+ recount.py is a script to reconcile the cached annotation counts stored on
+ each repertoire (e.g. ir_sequence_count for rearrangements) with the number
+ of annotations in the repository that belong to that repertoire. The data
+ loader maintains these counts incrementally as data is loaded, so they only
+ need to be reconciled if a load failed part way through or data was removed
+ from the repository. The repertoires are counted in parallel, using an index
+ on the repertoire link field of each annotation collection as a hint.
+"""
+import os
+import argparse
+import time
+import sys
+import concurrent.futures
+
+# AIRR Mapping class.
+from airr_map import AIRRMap
+# Repository class - hides the DB implementation
+from repository import Repository
+# Annotation classes, used to get the link and count fields for each type.
+from rearrangement import Rearrangement
+from clone import Clone
+from cell import Cell
+from expression import Expression
+from receptor import Receptor
+from reactivity import Reactivity
+
+# The annotation types that can be recounted, and the parser class for each.
+annotation_classes = {"rearrangement": Rearrangement,
+                      "clone": Clone,
+                      "cell": Cell,
+                      "expression": Expression,
+                      "receptor": Receptor,
+                      "reactivity": Reactivity}
+
+# Get the command line arguments...
+def getArguments():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="Reconcile the cached annotation counts on each repertoire with the annotations in the repository."
+    )
+
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Run the program in verbose mode, reporting the counts for every repertoire.")
+    parser.add_argument(
+        "--skipload",
+        action="store_true",
+        help="Report the counts that are out of date without changing the repository.")
+    parser.add_argument(
+        "--types",
+        dest="types",
+        nargs="+",
+        choices=list(annotation_classes.keys()),
+        default=["rearrangement", "clone", "cell", "expression"],
+        help="The annotation types to recount. Defaults to rearrangement, clone, cell and expression.")
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        default=4,
+        type=int,
+        help="Number of repertoire counts to run in parallel. Defaults to 4.")
+
+    # Add configuration options 
+    config_group = parser.add_argument_group("Configuration file options", "")
+    config_group.add_argument(
+        "--mapfile",
+        dest="mapfile",
+        default="ireceptor.cfg",
+        help="the iReceptor configuration file. Defaults to 'ireceptor.cfg' in the local directory where the command is run. This file contains the mappings between the AIRR Community field definitions, the annotation tool field definitions, and the fields and their names that are stored in the repository."
+    )
+
+    # Database options
+    db_group = parser.add_argument_group("database options")
+    db_group.add_argument(
+        "--host",
+        dest="host",
+        default="localhost",
+        help="MongoDb server hostname. Defaults to 'localhost'."
+    )
+    db_group.add_argument(
+        "--port",
+        dest="port",
+        default=27017,
+        type=int,
+        help="MongoDb server port number. Defaults to 27017."
+    )
+    db_group.add_argument(
+        "-u",
+        "--user",
+        dest="user",
+        default=os.environ.get("MONGODB_SERVICE_USER", ""),
+        help="MongoDb user name. Defaults to the MONGODB_SERVICE_USER environment variable if set. Defaults to empty string (no user name) otherwise."
+    )
+    db_group.add_argument(
+        "-p",
+        "--password",
+        dest="password",
+        default=os.environ.get("MONGODB_SERVICE_SECRET", ""),
+        help="MongoDb service user account password. Defaults to the MONGODB_SERVICE_SECRET environment variable if set. Defaults to empty string (no password) otherwise."
+    )
+    db_group.add_argument(
+        "-d",
+        "--database",
+        dest="database",
+        default=os.environ.get("MONGODB_DB", "ireceptor"),
+        help="Target MongoDb database. Defaults to the MONGODB_DB environment variable if set. Defaults to 'ireceptor' otherwise."
+    )
+    db_group.add_argument(
+        "--database_map",
+        dest="database_map",
+        default="ir_repository",
+        help="Mapping to use to map data terms into repository terms. Defaults to ir_repository, which is the mapping for the iReceptor Turnkey repository. This mapping keyword MUST be in the term mapping file as specified by --mapfile"
+    )
+    db_group.add_argument(
+        "--repertoire_collection",
+        dest="repertoire_collection",
+        default="sample",
+        help="The collection to use for storing and searching repertoires (sample metadata). This is the collection that sample metadata is inserted into when the --sample option is specified. Defaults to 'sample', which is the collection in the iReceptor Turnkey repository."
+    )
+    db_group.add_argument(
+        "--rearrangement_collection",
+        dest="rearrangement_collection",
+        default="sequence",
+        help="The collection to use for storing and searching rearrangements (sequence annotations). This is the collection that data is inserted into when the --mixcr, --imgt, and --airr options are used to load files. Defaults to 'sequence', which is the collection in the iReceptor Turnkey repository."
+    )
+    db_group.add_argument(
+        "--clone_collection",
+        dest="clone_collection",
+        default="clone",
+        help="The collection to use for storing and searching clones. This is the collection that data is inserted into when the --mixcr-clone option is used to load files. Defaults to 'clone', which is the collection in the iReceptor Turnkey repository."
+    )
+    db_group.add_argument(
+        "--cell_collection",
+        dest="cell_collection",
+        default="cell",
+        help="The collection to use for storing and searching cells. This is the collection that data is inserted into when the --airr-cell option is used to load files. Defaults to 'cell', which is the collection in the iReceptor Turnkey repository."
+    )
+    db_group.add_argument(
+        "--expression_collection",
+        dest="expression_collection",
+        default="expression",
+        help="The collection to use for storing and searching gene expression. This is the collection that data is inserted into when the --airr-expression option is used to load files. Defaults to 'expression', which is the collection in the iReceptor Turnkey repository."
+    )
+    db_group.add_argument(
+        "--receptor_collection",
+        dest="receptor_collection",
+        default="receptor",
+        help="The collection to use for storing and searching receptor. This is the collection that data is inserted into when the --airr-receptor option is used to load files. Defaults to 'receptor', which is the collection in the iReceptor Turnkey repository."
+    )
+    db_group.add_argument(
+        "--reactivity_collection",
+        dest="reactivity_collection",
+        default="reactivity",
+        help="The collection to use for storing and searching reactivity data. This is the collection that data is inserted into when the --airr-reactivity option is used to load files. Defaults to 'reactivity', which is the collection in the iReceptor Turnkey repository."
+    )
+
+    options = parser.parse_args()
+
+    if options.verbose:
+        print('HOST               :', options.host)
+        print('PORT               :', options.port)
+        print('USER               :', options.user[0] + (len(options.user) - 2) * "*" + options.user[-1] if options.user else "")
+        print('PASSWORD           :', options.password[0] + (len(options.password) - 2) * "*" + options.password[-1] if options.password else "")
+        print('DATABASE           :', options.database)
+        print('DATABASE_MAP       :', options.database_map)
+        print('MAPFILE            :', options.mapfile)
+        print('TYPES              :', options.types)
+        print('WORKERS            :', options.workers)
+
+    return options
+
+# Recount the annotations of one type for each repertoire, updating the cached
+# count on the repertoires where it is out of date. Returns True on success.
+def recountAnnotations(annotation_type, repository, airr_map, options):
+    t_start = time.perf_counter()
+    parser = annotation_classes[annotation_type](options.verbose, options.database_map,
+                                                 0, airr_map, repository)
+    repository_tag = parser.getRepositoryTag()
+    ireceptor_tag = parser.getiReceptorTag()
+
+    # Get the repository fields that link the annotations to the repertoire,
+    # and the repertoire field that caches the count.
+    repertoire_field = airr_map.getMapping(parser.getRepertoireLinkIDField(),
+                                           ireceptor_tag, repository_tag)
+    annotation_field = airr_map.getMapping(parser.getAnnotationLinkIDField(),
+                                           ireceptor_tag, repository_tag)
+    count_field = airr_map.getMapping(parser.getAnnotationCountField(),
+                                      ireceptor_tag, repository_tag)
+    updated_at_field = airr_map.getMapping("ir_updated_at_repertoire",
+                                           ireceptor_tag, repository_tag,
+                                           airr_map.getIRRepertoireClass())
+    if repertoire_field is None or annotation_field is None or count_field is None:
+        print("ERROR: Could not find %s link or count fields in AIRR Mappings"%
+              (annotation_type))
+        return False
+
+    # Count using the index on the annotation link field if there is one.
+    hint = repository.getFieldIndex(annotation_type, annotation_field)
+    if hint is None:
+        print("Warning: No index on %s for %s, counts may be slow"%
+              (annotation_field, annotation_type))
+
+    repertoires = repository.getAllRepertoires([repertoire_field, count_field])
+    if repertoires is None:
+        return False
+    repertoire_ids = [repertoire.get(repertoire_field) for repertoire in repertoires]
+    cached_counts = [repertoire.get(count_field) for repertoire in repertoires]
+
+    # Count the annotations for each repertoire in parallel.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.workers) as executor:
+        counts = list(executor.map(
+                          lambda repertoire_id: repository.countAnnotations(
+                              annotation_type, annotation_field, repertoire_id, hint),
+                          repertoire_ids))
+
+    success = True
+    updated = 0
+    for repertoire_id, cached_count, count in zip(repertoire_ids, cached_counts, counts):
+        if count == -1:
+            success = False
+            continue
+        if options.verbose:
+            print("Info: %s %s, %s = %s, count = %d"%
+                  (repertoire_field, repertoire_id, count_field, cached_count, count))
+        # Repertoires with no annotations of this type that don't have the
+        # count field are left as is.
+        if cached_count == count or (cached_count is None and count == 0):
+            continue
+        print("Info: Updating %s for %s %s from %s to %d"%
+              (count_field, repertoire_field, repertoire_id, cached_count, count))
+        repository.updateField(repertoire_field, repertoire_id,
+                               count_field, count, updated_at_field)
+        updated = updated + 1
+
+    t_end = time.perf_counter()
+    print("Info: Recounted %s for %d repertoires, %d out of date, %f s"%
+          (annotation_type, len(repertoire_ids), updated, t_end - t_start), flush=True)
+    return success
+
+if __name__ == "__main__":
+    # Get the command line arguments.
+    options = getArguments()
+
+    # Create the repository object, which establishes the repository connection.
+    repository = Repository(options.user, options.password,
+                            options.host, options.port,
+                            options.database,
+                            options.repertoire_collection,
+                            options.rearrangement_collection,
+                            options.clone_collection,
+                            options.cell_collection,
+                            options.expression_collection,
+                            options.receptor_collection,
+                            options.reactivity_collection,
+                            options.skipload, False,
+                            options.verbose)
+    # Check on the successful creation of the repository
+    if repository is None or not repository:
+        sys.exit(1)
+
+    # Create the AIRR mapping object, which has the mapping of fields between
+    # the various components.
+    airr_map = AIRRMap(options.verbose)
+    airr_map.readMapFile(options.mapfile)
+    if airr_map.getRearrangementMapColumn(options.database_map) is None:
+        print("ERROR: Could not find repository mapping %s in AIRR Mappings"%
+              (options.database_map))
+        sys.exit(1)
+
+    t_total_start = time.perf_counter()
+    result_list = [recountAnnotations(annotation_type, repository, airr_map, options)
+                   for annotation_type in options.types]
+    t_total_end = time.perf_counter()
+    print("Info: Finished total processing in {:.2f} mins".format((t_total_end - t_total_start) / 60))
+    if all(result_list):
+        sys.exit(0)
+    else:
+        print('ERROR: one or more recounts failed.')
+        sys.exit(1)
@@ -0,0 +1,295 @@
+# Class to compute the per repertoire rearrangement statistics (gene usage and
+# junction length) used by the iReceptor Plus stats API. This generates the
+# same stats as stats/stats_files_create.php: for each gene field a _unique and
+# an _exists stat (and a _productive version of each), for each count field a
+# stat (and a _productive version), and the rearrangement_count and
+# duplicate_count stats.
+#
+# The stats can be accumulated either from rearrangement records (e.g. from a
+# projected cursor over the repository, or from records as they are loaded) or
+# from the result of a server side aggregation pipeline built by
+# getAggregationPipeline().
+#
+# Each stat is a dictionary (in insertion order) of values to counts. As in the
+# PHP code the values are used as keys in the same way that PHP uses values
+# as array keys, so for example a junction length of 45.0 or "45" is counted
+# as 45.
+
+import collections
+import itertools
+import json
+import math
+import re
+
+class RepertoireStats:
+    # The gene stats, the key is the stat name, the value is the field in the
+    # repository. A unique count for a gene is incremented if the gene is the
+    # only gene annotated for the rearrangement. An exists count for a gene is
+    # incremented if the gene is a member of the list of genes annotated for
+    # the rearrangement.
+    gene_stats = {
+        "v_call": "v_call",
+        "v_family": "ir_vgene_family",
+        "v_gene": "ir_vgene_gene",
+
+        "d_call": "d_call",
+        "d_family": "ir_dgene_family",
+        "d_gene": "ir_dgene_gene",
+
+        "j_call": "j_call",
+        "j_family": "ir_jgene_family",
+        "j_gene": "ir_jgene_gene",
+
+        "c_call": "c_call",
+        "c_family": "ir_cgene_family",
+        "c_gene": "ir_cgene_gene"
+    }
+    # The count stats, which count the number of rearrangements with each value
+    # of the field.
+    count_stats = {
+        "junction_length": "junction_length",
+        "junction_aa_length": "junction_aa_length"
+    }
+    # The fields used to determine productive rearrangements and the number of
+    # duplicates of each rearrangement.
+    productive_field = "productive"
+    duplicate_count_field = "duplicate_count"
+
+    def __init__(self, repertoire_id):
+        self.repertoire_id = repertoire_id
+        self.stats = {stat:collections.Counter()
+                      for stat in RepertoireStats.getStatNames()}
+
+    # Get the names of the stats, in the order they are written by the PHP code.
+    @staticmethod
+    def getStatNames():
+        stat_names = []
+        for stat in RepertoireStats.count_stats:
+            stat_names.append(stat)
+            stat_names.append(stat + "_productive")
+        for stat in RepertoireStats.gene_stats:
+            stat_names.append(stat + "_unique")
+            stat_names.append(stat + "_exists")
+            stat_names.append(stat + "_unique_productive")
+            stat_names.append(stat + "_exists_productive")
+        stat_names = stat_names + ["rearrangement_count", "rearrangement_count_productive",
+                                   "duplicate_count", "duplicate_count_productive"]
+        return stat_names
+
+    # Get the repository fields that are needed to compute the stats.
+    @staticmethod
+    def getFields():
+        return (list(RepertoireStats.gene_stats.values()) +
+                list(RepertoireStats.count_stats.values()) +
+                [RepertoireStats.productive_field,
+                 RepertoireStats.duplicate_count_field])
+
+    # Strings that PHP stores as integer array keys, decimal integers with no
+    # leading zeros or sign.
+    php_integer_key = re.compile("0|-?[1-9][0-9]*")
+
+    # Convert a value to the key PHP would use for it in an array. Null is the
+    # empty string, booleans are 0/1, floats are truncated to integers and
+    # strings that are decimal integers are integers.
+    @staticmethod
+    def php_key(value):
+        if value is None:
+            return ""
+        if isinstance(value, bool):
+            return int(value)
+        if isinstance(value, float):
+            if math.isnan(value) or math.isinf(value):
+                return 0
+            return int(value)
+        if isinstance(value, str):
+            if (RepertoireStats.php_integer_key.fullmatch(value) and
+                -2**63 <= int(value) < 2**63):
+                return int(value)
+            return value
+        if isinstance(value, int):
+            return value
+        return str(value)
+
+    # Check if a value is true in the way that PHP tests for truth.
+    @staticmethod
+    def php_true(value):
+        if isinstance(value, str):
+            return not value in ["", "0"]
+        if isinstance(value, float) and math.isnan(value):
+            return True
+        return bool(value)
+
+    # Add the counts of a set of values to the stats. The values are counted
+    # once and converted to PHP keys once for each distinct value rather than
+    # once per record.
+    @staticmethod
+    def add_counts(stat_list, values):
+        for value, count in collections.Counter(values).items():
+            key = RepertoireStats.php_key(value)
+            for stat in stat_list:
+                stat[key] += count
+
+    # Get the genes for each record from the values of a gene field. A list of
+    # one gene is replaced by the gene (or None for an empty list) so that
+    # every value is either a single gene or a list of more than one gene.
+    @staticmethod
+    def get_genes(values):
+        return [value if not type(value) is list or len(value) > 1
+                else (value[0] if value else None) for value in values]
+
+    # Count the genes of a set of records in the unique and exists stats. A
+    # list of more than one gene is counted in the exists stat only, a single
+    # gene is counted in both.
+    @staticmethod
+    def count_genes(genes, exists_stat, unique_stat):
+        single_genes = [gene for gene in genes if not type(gene) is list]
+        RepertoireStats.add_counts([unique_stat, exists_stat], single_genes)
+        if len(single_genes) < len(genes):
+            RepertoireStats.add_counts([exists_stat], itertools.chain.from_iterable(
+                gene for gene in genes if type(gene) is list))
+
+    # Add a single rearrangement record to the stats.
+    def addRecord(self, record):
+        self.addRecordBatch([record])
+
+    # Add a list of rearrangement records to the stats. The records are
+    # processed a field at a time, which is much faster than processing them
+    # a record at a time as each value only needs to be examined once.
+    def addRecordBatch(self, records):
+        stats = self.stats
+        php_true = RepertoireStats.php_true
+        productive_values = [record.get(RepertoireStats.productive_field)
+                             for record in records]
+        productive = [value is True or
+                      (not value is False and not value is None and php_true(value))
+                      for value in productive_values]
+        num_productive = sum(productive)
+        duplicate_counts = [record.get(RepertoireStats.duplicate_count_field)
+                            for record in records]
+        duplicate_counts = [1 if value is None else value for value in duplicate_counts]
+
+        # Each stat is counted for all records and for the productive records.
+        subsets = [("", lambda values: values)]
+        if num_productive > 0:
+            subsets.append(("_productive",
+                            lambda values: list(itertools.compress(values, productive))))
+
+        for stat, field in RepertoireStats.count_stats.items():
+            values = [record.get(field) for record in records]
+            for suffix, subset in subsets:
+                RepertoireStats.add_counts([stats[stat + suffix]], subset(values))
+        for stat, field in RepertoireStats.gene_stats.items():
+            genes = RepertoireStats.get_genes([record.get(field) for record in records])
+            for suffix, subset in subsets:
+                RepertoireStats.count_genes(subset(genes), stats[stat + "_exists" + suffix],
+                                            stats[stat + "_unique" + suffix])
+        for suffix, subset in subsets:
+            stats["rearrangement_count" + suffix]["rearrangement_count" + suffix] += \
+                len(records) if suffix == "" else num_productive
+            stats["duplicate_count" + suffix]["duplicate_count" + suffix] += \
+                sum(subset(duplicate_counts))
+
+    # Add a set of rearrangement records (e.g. a cursor) to the stats, in
+    # batches of batch_size records.
+    def addRecords(self, records, batch_size=10000):
+        records = iter(records)
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if len(batch) == 0:
+                break
+            self.addRecordBatch(batch)
+
+    # Get an aggregation pipeline that computes the stats for a repertoire on
+    # the server. The pipeline produces a single document with a field for
+    # each stat, containing a list of {_id: value, count: count} documents,
+    # that can be added to the stats with addAggregationResult(). Some stats
+    # are made up of more than one field, named <stat>__<part>.
+    @staticmethod
+    def getAggregationPipeline(repertoire_field, repertoire_id):
+        # For each rearrangement and gene field, compute the key to count if the
+        # field has a single gene (a single gene, a list of one gene, or the
+        # empty string for no genes) and the list of genes to count if it has
+        # more than one.
+        projection = {"_id": 0}
+        for stat, field in RepertoireStats.gene_stats.items():
+            field_ref = "$" + field
+            is_array = {"$isArray": field_ref}
+            is_multiple = {"$gt": [{"$size": {"$cond": [is_array, field_ref, []]}}, 1]}
+            projection["g_" + stat] = {
+                "$cond": [is_array,
+                          {"$ifNull": [{"$arrayElemAt": [field_ref, 0]}, ""]},
+                          {"$ifNull": [field_ref, ""]}]}
+            projection["m_" + stat] = {"$cond": [is_multiple, field_ref, []]}
+        for stat, field in RepertoireStats.count_stats.items():
+            projection["c_" + stat] = {"$ifNull": ["$" + field, ""]}
+        # Productive is true in the PHP sense, and the duplicate count
+        # defaults to 1.
+        productive_ref = "$" + RepertoireStats.productive_field
+        projection["p"] = {"$cond": [{"$eq": [{"$type": productive_ref}, "string"]},
+                                     {"$not": [{"$in": [productive_ref, ["", "0"]]}]},
+                                     {"$and": [{"$ifNull": [productive_ref, False]}]}]}
+        projection["d"] = {"$ifNull": ["$" + RepertoireStats.duplicate_count_field, 1]}
+
+        # Group each stat, with and without the productive filter.
+        facets = dict()
+        for suffix, prefix in [("", []), ("_productive", [{"$match": {"p": True}}])]:
+            for stat in RepertoireStats.count_stats:
+                facets[stat + suffix] = prefix + [
+                    {"$group": {"_id": "$c_" + stat, "count": {"$sum": 1}}}]
+            for stat in RepertoireStats.gene_stats:
+                # Single genes count in both the unique and exists stats, each
+                # of the genes in a list of more than one in the exists stat.
+                single_gene = prefix + [
+                    {"$match": {"m_" + stat: {"$size": 0}}},
+                    {"$group": {"_id": "$g_" + stat, "count": {"$sum": 1}}}]
+                facets[stat + "_unique" + suffix] = single_gene
+                facets[stat + "_exists" + suffix] = single_gene
+                facets[stat + "_exists" + suffix + "__multiple"] = prefix + [
+                    {"$unwind": "$m_" + stat},
+                    {"$group": {"_id": "$m_" + stat, "count": {"$sum": 1}}}]
+            facets["rearrangement_count" + suffix] = prefix + [
+                {"$group": {"_id": "rearrangement_count" + suffix, "count": {"$sum": 1}}}]
+            facets["duplicate_count" + suffix] = prefix + [
+                {"$group": {"_id": "duplicate_count" + suffix, "count": {"$sum": "$d"}}}]
+
+        return [{"$match": {repertoire_field: {"$eq": repertoire_id}}},
+                {"$project": projection},
+                {"$facet": facets}]
+
+    # Add the result document of the pipeline from getAggregationPipeline()
+    # to the stats.
+    def addAggregationResult(self, result):
+        for facet, groups in result.items():
+            stat = facet.split("__")[0]
+            if not stat in self.stats:
+                continue
+            for group in groups:
+                self.stats[stat][RepertoireStats.php_key(group["_id"])] += group["count"]
+
+    # Get the counts for a stat.
+    def getStat(self, stat):
+        return self.stats[stat]
+
+    # Get the number of rearrangements added to the stats.
+    def getRearrangementCount(self):
+        return self.stats["rearrangement_count"]["rearrangement_count"]
+
+    # Get the stats as a list of documents, one for each value of each stat,
+    # in the form stored in the repository stat collection.
+    def getStatDocuments(self, repertoire_id_field):
+        documents = []
+        for stat, counts in self.stats.items():
+            for value, count in counts.items():
+                if isinstance(count, float) and count.is_integer():
+                    count = int(count)
+                documents.append({repertoire_id_field: str(self.repertoire_id),
+                                  "name": stat, "value": str(value),
+                                  "count": count})
+        return documents
+
+    # Write the stats to a file in the format written by the PHP code, one
+    # JSON document per line.
+    def writeStatsFile(self, filename, repertoire_id_field):
+        with open(filename, "w") as file_handle:
+            for document in self.getStatDocuments(repertoire_id_field):
+                file_handle.write(json.dumps(document) + "\n")
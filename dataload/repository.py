@@ -1,6 +1,11 @@
 import os
 import urllib.parse
 import pymongo
+import threading
+import time
+import math
+import concurrent.futures
+from bson.objectid import ObjectId
 from parser import Parser
 
 class Repository:
@@ -8,7 +13,10 @@ class Repository:
                  repertoire_collection, rearrangement_collection, clone_collection,
                  cell_collection, expression_collection,
                  receptor_collection, reactivity_collection,
-                 skipload, update, verbose=False):
+                 skipload, update, verbose=False,
+                 checkpoint_collection="load_checkpoint",
+                 write_concurrency=1, write_batch_size=0, write_concern="",
+                 stat_collection="stat", mongo_client=None):
         """Create an interface to the Mongo repository
 
         Keyword arguments:
@@ -27,6 +35,21 @@ class Repository:
           - skipload: flag to determine if we skip the data load operation.
           - update: flag to determine if we are updating rather than inserting
             (repertoire only).
+          - checkpoint_collection: name of the collection used to store the
+            checkpoints for resumable loads of annotation files.
+          - write_concurrency: number of unordered insert batches to keep in
+            flight when writing annotation records. 1 writes each chunk of
+            records with a single insert.
+          - write_batch_size: number of records in each concurrent insert
+            batch. 0 splits each chunk evenly across write_concurrency batches.
+          - write_concern: the write concern (w) for the database, either a
+            number of nodes or a tag such as "majority". An empty string uses
+            the server default.
+          - stat_collection: name of the collection used to store the
+            repertoire statistics.
+          - mongo_client: an existing MongoClient (or an object with the same
+            interface, e.g. the in-process sink used by the loader benchmark)
+            to use rather than connecting to host:port.
         """
 
         self.username = user
@@ -41,6 +64,15 @@ class Repository:
         self.expression_collection = expression_collection
         self.receptor_collection = receptor_collection
         self.reactivity_collection = reactivity_collection
+        self.checkpoint_collection = checkpoint_collection
+        self.stat_collection = stat_collection
+        self.write_concurrency = write_concurrency
+        self.write_batch_size = write_batch_size
+        self.write_concern = write_concern
+        # The threads used to keep concurrent insert batches in flight, created
+        # when they are first needed.
+        self.write_executor = None
+        self.write_executor_lock = threading.Lock()
         self.skipload = skipload
         self.update = update
         self.verbose = verbose
@@ -52,11 +84,28 @@ class Repository:
         self.expression = None
         self.receptor = None
         self.reactivity = None
+        self.checkpoint = None
+        self.stat = None
+        # For a bulk load, the annotations of a type are written to a staging
+        # collection without secondary indexes. This keeps track of the target
+        # collection for each annotation type being staged, and the index
+        # definitions to build once the load is done.
+        self.staging_targets = dict()
+        self.staging_indexes = dict()
+        # Keep track of the number of annotation records (rearrangements, clones,
+        # cells, expression, receptors, reactivity) written by this repository.
+        self.insert_count = 0
+        # Records may be inserted from more than one thread (e.g. by the writer
+        # threads of an InsertPipeline), so the count is updated under a lock.
+        self.count_lock = threading.Lock()
 
-        # Connect with Mongo db
+        # Connect with Mongo db, unless we have been given a client to use.
         self.username = urllib.parse.quote_plus(self.username)
         self.password = urllib.parse.quote_plus(self.password)
-        if len(self.username) == 0 and len(self.password) == 0:
+        if not mongo_client is None:
+            uri = None
+            print("Info: Using the Mongo client provided")
+        elif len(self.username) == 0 and len(self.password) == 0:
             uri = 'mongodb://%s:%s' % (self.host, self.port)
             print("Info: Connecting to Mongo with no username/password on '%s:%s'" %
                 (self.host, self.port))
@@ -68,7 +117,10 @@ class Repository:
 
         # Connect to the Mongo server and return if not able to connect.
         try:
-            self.mongo_client = pymongo.MongoClient(uri)
+            if mongo_client is None:
+                self.mongo_client = pymongo.MongoClient(uri)
+            else:
+                self.mongo_client = mongo_client
         except pymongo.errors.ConfigurationError as err:
             print("ERROR: Unable to connect to %s:%s - %s"
                     % (self.host, self.port, err))
@@ -101,7 +153,15 @@ class Repository:
             pass
 
         # Set Mongo db name and keep track of the mongo entry points to make queries.
-        self.mongo_db = self.mongo_client[self.database]
+        # All of the collections use the write concern given for the database.
+        if self.write_concern == "":
+            self.mongo_db = self.mongo_client[self.database]
+        else:
+            write_w = self.write_concern
+            if write_w.isdigit():
+                write_w = int(write_w)
+            self.mongo_db = self.mongo_client.get_database(self.database,
+                                write_concern=pymongo.WriteConcern(w=write_w))
         self.repertoire = self.mongo_db[self.repertoire_collection]
         self.rearrangement = self.mongo_db[self.rearrangement_collection]
         self.clone = self.mongo_db[self.clone_collection]
@@ -109,8 +169,19 @@ class Repository:
         self.expression = self.mongo_db[self.expression_collection]
         self.receptor = self.mongo_db[self.receptor_collection]
         self.reactivity = self.mongo_db[self.reactivity_collection]
+        self.checkpoint = self.mongo_db[self.checkpoint_collection]
+        self.stat = self.mongo_db[self.stat_collection]
 
 
+    # Return the number of annotation records written by this repository.
+    def getInsertCount(self):
+        return self.insert_count
+
+    # Add to the number of annotation records written by this repository.
+    def addInsertCount(self, count):
+        with self.count_lock:
+            self.insert_count = self.insert_count + count
+
     # Return the update flag so clients can determine if we are in update mode or not.
     def updateOnly(self):
         return self.update
@@ -162,16 +233,104 @@ class Repository:
             
         return rep_array
 
+    # Get the given fields for all of the repertoires in the repository.
+    # Returns a list of repertoire documents, or None on error.
+    def getAllRepertoires(self, fields):
+        projection = {field:True for field in fields}
+        try:
+            return list(self.repertoire.find({}, projection))
+        except Exception as err:
+            print("ERROR: Search for repertoires failed, %s"%(str(err)))
+            return None
+
+    # Assign the repository IDs for a set of records before they are written.
+    # Each record gets a newly generated internal _id, and if an id_field is
+    # provided the string representation of that _id is stored in id_field as
+    # well. Generating the IDs on the client side means we don't need a second
+    # update operation per record after the insert to store the string ID.
+    # Accepts a single record or an iterable of records and always returns a
+    # list of records.
+    def setRecordIDs(self, json_records, id_field):
+        if isinstance(json_records, dict):
+            json_records = [json_records]
+        else:
+            json_records = list(json_records)
+        for record in json_records:
+            record_id = ObjectId()
+            record["_id"] = record_id
+            if not id_field is None:
+                record[id_field] = str(record_id)
+        return json_records
+
+    # Get the thread pool used to keep concurrent insert batches in flight.
+    def getWriteExecutor(self):
+        with self.write_executor_lock:
+            if self.write_executor is None:
+                self.write_executor = concurrent.futures.ThreadPoolExecutor(
+                                          max_workers=self.write_concurrency,
+                                          thread_name_prefix="repository-writer")
+            return self.write_executor
+
+    # Write one batch of records with an unordered insert_many. Returns the
+    # number of records inserted and a list of the write errors.
+    @staticmethod
+    def insertBatch(collection, json_records):
+        try:
+            collection.insert_many(json_records, ordered=False)
+        except pymongo.errors.BulkWriteError as err:
+            write_errors = [error.get("errmsg", str(error))
+                            for error in err.details.get("writeErrors", [])]
+            if len(write_errors) == 0:
+                write_errors = [str(err)]
+            return err.details.get("nInserted", 0), write_errors
+        except Exception as err:
+            return 0, [str(err)]
+        return len(json_records), []
+
+    # Write a chunk of records to the given collection by splitting it into
+    # batches and keeping up to write_concurrency unordered inserts in flight
+    # on the connection pool. The write errors from all of the batches are
+    # reported together for the chunk. Returns a list of the ids on success,
+    # None if any of the records were not written.
+    def insertRecordsConcurrent(self, collection, json_records, record_type):
+        batch_size = self.write_batch_size
+        if batch_size <= 0:
+            batch_size = max(1, math.ceil(len(json_records)/self.write_concurrency))
+        executor = self.getWriteExecutor()
+        futures = [executor.submit(Repository.insertBatch, collection,
+                                   json_records[start:start + batch_size])
+                   for start in range(0, len(json_records), batch_size)]
+        inserted = 0
+        write_errors = []
+        for future in futures:
+            batch_inserted, batch_errors = future.result()
+            inserted = inserted + batch_inserted
+            write_errors = write_errors + batch_errors
+        self.addInsertCount(inserted)
+        if len(write_errors) > 0:
+            print("ERROR: Unable to write %d of %d %s records to repository in %d batches, %d errors"%
+                  (len(json_records) - inserted, len(json_records), record_type,
+                   len(futures), len(write_errors)))
+            for error in write_errors[:5]:
+                print("ERROR:     %s"%(error))
+            return None
+        return [record.get("_id") for record in json_records]
+
     # Write the set of JSON records provided to the "rearrangements" collection.
     # This is hiding the repository implementation.
     # Return a list of the ids on success None on failure.
     def insertRearrangements(self, json_records):
+        if not self.skipload and self.write_concurrency > 1:
+            return self.insertRecordsConcurrent(self.rearrangement, json_records,
+                                                "rearrangement")
+        record_ids = [record.get("_id") for record in json_records]
         if not self.skipload:
             try:
                 record_ids = self.rearrangement.insert(json_records)
             except Exception as err:
                 print("ERROR: Unable to write rearrangement records to repository, %s"%(err))
                 return None
+        self.addInsertCount(len(record_ids))
         return record_ids
 
     # Update the update_field to update_value wherever search_field is equal to
@@ -184,6 +343,28 @@ class Repository:
             update = {"$set": {update_field:update_value, update_time_field:now_str}}
             self.rearrangement.update( {search_field:search_value}, update)
 
+    # Perform a set of updates like updateRearrangementField in a single
+    # unordered bulk write. The updates are a list of (search_value, update_value)
+    # pairs, and for each pair the update_field is set to update_value in the
+    # rearrangement where search_field is equal to search_value. Returns the
+    # number of rearrangements modified, or -1 on error.
+    def updateRearrangementFields(self, search_field, updates,
+                                  update_field, update_time_field):
+        if self.skipload or len(updates) == 0:
+            return 0
+        # All of the updates in the batch get the same update time.
+        now_str = Parser.getDateTimeNowUTC()
+        operations = [pymongo.UpdateOne({search_field:search_value},
+                                        {"$set": {update_field:update_value,
+                                                  update_time_field:now_str}})
+                      for search_value, update_value in updates]
+        try:
+            result = self.rearrangement.bulk_write(operations, ordered=False)
+        except Exception as err:
+            print("ERROR: Unable to update rearrangement records in repository, %s"%(err))
+            return -1
+        return result.modified_count
+
     # Count the number of rearrangements that belong to a specific repertoire. 
     # Return -1 on error. Note: In our early implementations, we had an
     # internal field name called ir_project_sample_id. We want to hide
@@ -207,16 +388,47 @@ class Repository:
         # If sucessful return the count.
         return rearrangement_count
 
+    # Get a cursor over the rearrangements that belong to a specific
+    # repertoire, returning only the given fields. Returns None on error.
+    def getRearrangementCursor(self, repertoire_field, repertoire_id, fields,
+                               batch_size=10000):
+        projection = {field:1 for field in fields}
+        projection["_id"] = 0
+        try:
+            return self.rearrangement.find({repertoire_field:{'$eq':repertoire_id}},
+                                           projection, batch_size=batch_size)
+        except Exception as err:
+            print("ERROR: Query failed for repertoire field (%s) or repertoire_id (%s), %s"%
+                  (repertoire_field, repertoire_id, err))
+            return None
+
+    # Run an aggregation pipeline on the rearrangement collection. Returns a
+    # list of the result documents, or None on error.
+    def aggregateRearrangements(self, pipeline):
+        try:
+            return list(self.rearrangement.aggregate(pipeline, allowDiskUse=True))
+        except Exception as err:
+            print("ERROR: Rearrangement aggregation failed, %s"%(err))
+            return None
+
     # Write the set of JSON records provided to the "clones" collection.
     # This is hiding the repository implementation.
     # Return a list of the ids on success None on failure.
+    # The records are written with a single unordered bulk insert, which lets
+    # the server apply the writes without waiting on each one in turn.
     def insertClones(self, json_records):
+        if not self.skipload and self.write_concurrency > 1:
+            return self.insertRecordsConcurrent(self.clone, json_records,
+                                                "clone")
+        record_ids = [record.get("_id") for record in json_records]
         if not self.skipload:
             try:
-                record_ids = self.clone.insert(json_records)
+                results = self.clone.insert_many(json_records, ordered=False)
+                record_ids = results.inserted_ids
             except Exception as err:
                 print("ERROR: Unable to write clone records to repository, %s"%(err))
                 return None
+        self.addInsertCount(len(record_ids))
         return record_ids
 
     # Update the update_field to update_value wherever search_field is equal to
@@ -252,13 +464,21 @@ class Repository:
     # Write the set of JSON records provided to the "cell" collection.
     # This is hiding the repository implementation.
     # Return a list of the ids on success None on failure.
+    # The records are written with a single unordered bulk insert, which lets
+    # the server apply the writes without waiting on each one in turn.
     def insertCells(self, json_records):
+        if not self.skipload and self.write_concurrency > 1:
+            return self.insertRecordsConcurrent(self.cell, json_records,
+                                                "cell")
+        record_ids = [record.get("_id") for record in json_records]
         if not self.skipload:
             try:
-                record_ids = self.cell.insert(json_records)
+                results = self.cell.insert_many(json_records, ordered=False)
+                record_ids = results.inserted_ids
             except Exception as err:
                 print("ERROR: Unable to write cell records to repository, %s"%(err))
                 return None
+        self.addInsertCount(len(record_ids))
         return record_ids
 
     # Update the update_field to update_value wherever search_field is equal to
@@ -296,12 +516,17 @@ class Repository:
     # This is hiding the repository implementation.
     # Return a list of the ids on success None on failure.
     def insertExpression(self, json_records):
+        if not self.skipload and self.write_concurrency > 1:
+            return self.insertRecordsConcurrent(self.expression, json_records,
+                                                "expression")
+        record_ids = [record.get("_id") for record in json_records]
         if not self.skipload:
             try:
                 record_ids = self.expression.insert(json_records)
             except Exception as err:
                 print("ERROR: Unable to write expression records to repository, %s"%(err))
                 return None
+        self.addInsertCount(len(record_ids))
         return record_ids
 
     # Update the update_field to update_value wherever search_field is equal to
@@ -337,13 +562,21 @@ class Repository:
     # Write the set of JSON records provided to the "receptor" collection.
     # This is hiding the repository implementation.
     # Return a list of the ids on success None on failure.
+    # The records are written with a single unordered bulk insert, which lets
+    # the server apply the writes without waiting on each one in turn.
     def insertReceptors(self, json_records):
+        if not self.skipload and self.write_concurrency > 1:
+            return self.insertRecordsConcurrent(self.receptor, json_records,
+                                                "receptor")
+        record_ids = [record.get("_id") for record in json_records]
         if not self.skipload:
             try:
-                record_ids = self.receptor.insert(json_records)
+                results = self.receptor.insert_many(json_records, ordered=False)
+                record_ids = results.inserted_ids
             except Exception as err:
                 print("ERROR: Unable to write receptor records to repository, %s"%(err))
                 return None
+        self.addInsertCount(len(record_ids))
         return record_ids
 
     # Update the update_field to update_value wherever search_field is equal to
@@ -376,13 +609,21 @@ class Repository:
     # Write the set of JSON records provided to the "reactivity" collection.
     # This is hiding the repository implementation.
     # Return a list of the ids on success None on failure.
+    # The records are written with a single unordered bulk insert, which lets
+    # the server apply the writes without waiting on each one in turn.
     def insertReactivity(self, json_records):
+        if not self.skipload and self.write_concurrency > 1:
+            return self.insertRecordsConcurrent(self.reactivity, json_records,
+                                                "reactivity")
+        record_ids = [record.get("_id") for record in json_records]
         if not self.skipload:
             try:
-                record_ids = self.reactivity.insert(json_records)
+                results = self.reactivity.insert_many(json_records, ordered=False)
+                record_ids = results.inserted_ids
             except Exception as err:
                 print("ERROR: Unable to write reactivity records to repository, %s"%(err))
                 return None
+        self.addInsertCount(len(record_ids))
         return record_ids
 
     # Update the update_field to update_value wherever search_field is equal to
@@ -412,6 +653,298 @@ class Repository:
         # If sucessful return the count.
         return reactivity_count
 
+    # Get the collection used to store the given type of annotation, one of
+    # rearrangement, clone, cell, expression, receptor, or reactivity.
+    def getAnnotationCollection(self, annotation_type):
+        annotation_collections = {"rearrangement": self.rearrangement,
+                                  "clone": self.clone,
+                                  "cell": self.cell,
+                                  "expression": self.expression,
+                                  "receptor": self.receptor,
+                                  "reactivity": self.reactivity}
+        return annotation_collections.get(annotation_type)
+
+    # Get the name of an index on the collection for the given type of
+    # annotation that starts with the given field, so it can be used as a hint
+    # when counting. Returns None if there is no such index.
+    def getFieldIndex(self, annotation_type, field):
+        collection = self.getAnnotationCollection(annotation_type)
+        try:
+            indexes = collection.index_information()
+        except Exception as err:
+            print("ERROR: Unable to get indexes for %s, %s"%(annotation_type, err))
+            return None
+        for index_name, index_info in indexes.items():
+            if index_info["key"][0][0] == field:
+                return index_name
+        return None
+
+    # Create an index on the given field of the collection for the given type
+    # of annotation, if there isn't one already. Returns False on error.
+    def createFieldIndex(self, annotation_type, field):
+        if self.skipload:
+            return True
+        collection = self.getAnnotationCollection(annotation_type)
+        if collection is None or field is None:
+            print("ERROR: Invalid annotation type (%s) or field (%s)"%
+                  (annotation_type, field))
+            return False
+        if not self.getFieldIndex(annotation_type, field) is None:
+            return True
+        try:
+            index_name = collection.create_index(field)
+        except Exception as err:
+            print("ERROR: Unable to create index on %s for %s, %s"%
+                  (field, annotation_type, err))
+            return False
+        print("Info: Created index %s on %s"%(index_name, collection.name))
+        return True
+
+    # Count the annotations of the given type that belong to a repertoire,
+    # using count_documents with the index given by hint (if not None) rather
+    # than the deprecated find().count(). Returns -1 on error.
+    def countAnnotations(self, annotation_type, repertoire_field, repertoire_id,
+                         hint=None):
+        collection = self.getAnnotationCollection(annotation_type)
+        if collection is None or repertoire_field is None or repertoire_id is None:
+            print("ERROR: Invalid annotation type (%s), repertoire field (%s) or repertoire_id (%s)"%
+                  (annotation_type, repertoire_field, repertoire_id))
+            return -1
+        query = {repertoire_field:{'$eq':repertoire_id}}
+        try:
+            if hint is None:
+                return collection.count_documents(query)
+            return collection.count_documents(query, hint=hint)
+        except Exception as err:
+            print("ERROR: Query failed for repertoire field (%s) or repertoire_id (%s), %s"%
+                  (repertoire_field, repertoire_id, err))
+            return -1
+
+    # Get the definitions of the secondary indexes on a collection, as a list
+    # of IndexModels that can be used to create the same indexes on another
+    # collection. Returns None on error.
+    def getIndexDefinitions(self, collection):
+        try:
+            indexes = collection.index_information()
+        except Exception as err:
+            print("ERROR: Unable to get indexes for %s, %s"%(collection.name, err))
+            return None
+        index_models = []
+        for index_name, index_info in indexes.items():
+            if index_name == "_id_":
+                continue
+            index_options = {option:value for option, value in index_info.items()
+                             if not option in ["key", "v", "ns"]}
+            index_models.append(pymongo.IndexModel(index_info["key"], name=index_name,
+                                                   **index_options))
+        return index_models
+
+    # Write the annotations of the given type to the staging collection with
+    # the given name rather than to the annotation collection. This is used by
+    # each process taking part in a bulk load.
+    def useStagingCollection(self, annotation_type, staging_collection):
+        target = self.getAnnotationCollection(annotation_type)
+        if target is None:
+            print("ERROR: Invalid annotation type (%s)"%(annotation_type))
+            return False
+        self.staging_targets[annotation_type] = target
+        # The annotation collections are attributes named after their type.
+        setattr(self, annotation_type, self.mongo_db[staging_collection])
+        print("Info: Writing %s records to staging collection %s"%
+              (annotation_type, staging_collection))
+        return True
+
+    # Start a bulk load of the given type of annotation. The definitions of the
+    # secondary indexes on the annotation collection are saved so they can be
+    # built once at the end of the load, and the annotations are written to a
+    # staging collection that has no secondary indexes. The staging collection
+    # must be empty. Returns False on error.
+    def startBulkLoad(self, annotation_type, staging_collection):
+        if self.skipload:
+            return True
+        target = self.getAnnotationCollection(annotation_type)
+        if target is None:
+            print("ERROR: Invalid annotation type (%s)"%(annotation_type))
+            return False
+        staging = self.mongo_db[staging_collection]
+        try:
+            staging_record = staging.find_one({}, {"_id":1})
+        except Exception as err:
+            print("ERROR: Unable to check staging collection %s, %s"%
+                  (staging_collection, err))
+            return False
+        if not staging_record is None:
+            print("ERROR: Staging collection %s is not empty, it may be from an earlier bulk load that did not finish"%
+                  (staging_collection))
+            return False
+        index_models = self.getIndexDefinitions(target)
+        if index_models is None:
+            return False
+        self.staging_indexes[annotation_type] = index_models
+        print("Info: Deferring %d %s indexes until the end of the bulk load"%
+              (len(index_models), target.name))
+        return self.useStagingCollection(annotation_type, staging_collection)
+
+    # Check if the server supports the $merge aggregation stage, which was
+    # added in MongoDB 4.2.
+    def serverHasMerge(self):
+        return self.mongo_client.server_info()["versionArray"][:2] >= [4, 2]
+
+    # Copy all of the records in the source collection to the target
+    # collection, in unordered batches of batch_size records.
+    def copyCollection(self, source, target, batch_size=10000):
+        batch = []
+        for record in source.find({}):
+            batch.append(record)
+            if len(batch) == batch_size:
+                target.insert_many(batch, ordered=False)
+                batch = []
+        if len(batch) > 0:
+            target.insert_many(batch, ordered=False)
+
+    # Finish a bulk load of the given type of annotation. If the annotation
+    # collection is empty the saved indexes are built on the staging
+    # collection, which is then renamed to replace the annotation collection.
+    # Otherwise the staged annotations are merged into the annotation
+    # collection by the server, which maintains the existing indexes, and the
+    # staging collection is dropped. Returns False on error.
+    def finishBulkLoad(self, annotation_type):
+        if self.skipload:
+            return True
+        if not annotation_type in self.staging_targets:
+            print("ERROR: No bulk load in progress for %s"%(annotation_type))
+            return False
+        target = self.staging_targets.pop(annotation_type)
+        staging = self.getAnnotationCollection(annotation_type)
+        index_models = self.staging_indexes.pop(annotation_type, [])
+        setattr(self, annotation_type, target)
+        try:
+            target_record = target.find_one({}, {"_id":1})
+            if target_record is None:
+                # Build the indexes once, on all of the staged records.
+                t_start = time.perf_counter()
+                if len(index_models) > 0:
+                    staging.create_indexes(index_models)
+                t_index = time.perf_counter() - t_start
+                print("Info: Built %d indexes on %s in %f s"%
+                      (len(index_models), staging.name, t_index), flush=True)
+                t_start = time.perf_counter()
+                staging.rename(target.name, dropTarget=True)
+                print("Info: Renamed %s to %s in %f s"%
+                      (staging.name, target.name, time.perf_counter() - t_start),
+                      flush=True)
+            else:
+                # The target has data, so merge the staged records into it.
+                # Servers before MongoDB 4.2 don't have $merge, so the staged
+                # records are copied across in batches instead. Any other
+                # failure of the merge is an error, as the merge may have
+                # written some of the staged records.
+                t_start = time.perf_counter()
+                if self.serverHasMerge():
+                    staging.aggregate([{"$merge": {"into": target.name,
+                                                   "whenMatched": "fail",
+                                                   "whenNotMatched": "insert"}}])
+                else:
+                    print("Warning: Server does not support $merge, copying records")
+                    self.copyCollection(staging, target)
+                print("Info: Merged %s into %s (with index maintenance) in %f s"%
+                      (staging.name, target.name, time.perf_counter() - t_start),
+                      flush=True)
+                staging.drop()
+        except Exception as err:
+            print("ERROR: Unable to move staged %s records from %s to %s, %s"%
+                  (annotation_type, staging.name, target.name, err))
+            return False
+        return True
+
+    # Delete the annotations of the given type for the given repertoire that
+    # were written in the chunk with the given chunk tag. The repertoire link
+    # field is indexed, so the delete only has to examine the annotations of
+    # the repertoire. Returns the number of annotations deleted, or -1 on
+    # error.
+    def deleteAnnotationChunk(self, annotation_type, link_field, repertoire_id,
+                              chunk_field, chunk_tag):
+        if self.skipload:
+            return 0
+        collection = self.getAnnotationCollection(annotation_type)
+        if collection is None:
+            print("ERROR: Invalid annotation type (%s)"%(annotation_type))
+            return -1
+        try:
+            result = collection.delete_many({link_field:{'$eq':repertoire_id},
+                                             chunk_field:{'$eq':chunk_tag}})
+        except Exception as err:
+            print("ERROR: Unable to delete %s records for chunk %s, %s"%
+                  (annotation_type, chunk_tag, err))
+            return -1
+        return result.deleted_count
+
+    # Get the load checkpoint for the given file, annotation type and
+    # repertoire. Returns None on error, and an empty dictionary if there is
+    # no checkpoint.
+    def getCheckpoint(self, file_name, annotation_type, repertoire_id):
+        try:
+            checkpoint = self.checkpoint.find_one({"file_name":file_name,
+                                                   "annotation_type":annotation_type,
+                                                   "repertoire_id":repertoire_id})
+        except Exception as err:
+            print("ERROR: Unable to read checkpoint for %s, %s"%(file_name, err))
+            return None
+        if checkpoint is None:
+            return dict()
+        return checkpoint
+
+    # Write the load checkpoint for the given file, annotation type and
+    # repertoire, replacing the fields of any existing checkpoint. Returns
+    # False on error.
+    def writeCheckpoint(self, file_name, annotation_type, repertoire_id, checkpoint):
+        if self.skipload:
+            return True
+        try:
+            self.checkpoint.update_one({"file_name":file_name,
+                                        "annotation_type":annotation_type,
+                                        "repertoire_id":repertoire_id},
+                                       {"$set":checkpoint}, upsert=True)
+        except Exception as err:
+            print("ERROR: Unable to write checkpoint for %s, %s"%(file_name, err))
+            return False
+        return True
+
+    # Write a set of stat documents to the stat collection in a single
+    # unordered bulk write. Each document replaces the count of the stat with
+    # the same values in key_fields, or is inserted if there isn't one.
+    # Returns the number of stats written, or -1 on error.
+    def upsertStats(self, stat_documents, key_fields):
+        if self.skipload or len(stat_documents) == 0:
+            return 0
+        operations = [pymongo.UpdateOne({field:document[field] for field in key_fields},
+                                        {"$set": document}, upsert=True)
+                      for document in stat_documents]
+        try:
+            result = self.stat.bulk_write(operations, ordered=False)
+        except Exception as err:
+            print("ERROR: Unable to write stats to repository, %s"%(err))
+            return -1
+        return result.upserted_count + result.matched_count
+
+    # Add the counts of a set of stat documents to the stats in the stat
+    # collection, identified by the key_fields of each document, with a single
+    # bulk $inc upsert. Stats that don't exist are created. Returns the number
+    # of stats written, or -1 on error.
+    def incrementStats(self, stat_documents, key_fields):
+        if self.skipload or len(stat_documents) == 0:
+            return 0
+        operations = [pymongo.UpdateOne({field:document[field] for field in key_fields},
+                                        {"$inc": {"count": document["count"]}},
+                                        upsert=True)
+                      for document in stat_documents]
+        try:
+            result = self.stat.bulk_write(operations, ordered=False)
+        except Exception as err:
+            print("ERROR: Unable to write stats to repository, %s"%(err))
+            return -1
+        return result.upserted_count + result.matched_count
+
     # Update the update_field to update_value wherever search_field is equal to
     # search value.
     def updateField(self, search_field, search_value,
@@ -422,6 +955,32 @@ class Repository:
             update = {"$set": {update_field:update_value, update_time_field:now_str}}
             return self.repertoire.update( {search_field:search_value}, update)
 
+    # Increment the inc_field by inc_value wherever search_field is equal to
+    # search value, in a single $inc. This is used to maintain the cached
+    # annotation counts on a repertoire without counting the annotations.
+    # Returns the value of the field after the update, or -1 on error.
+    def incrementField(self, search_field, search_value,
+                       inc_field, inc_value, update_time_field):
+        if self.skipload:
+            return 0
+        # Get the current time, and add it to the update information.
+        now_str = Parser.getDateTimeNowUTC()
+        update = {"$inc": {inc_field:inc_value}, "$set": {update_time_field:now_str}}
+        try:
+            document = self.repertoire.find_one_and_update(
+                           {search_field:search_value}, update,
+                           projection={inc_field:True},
+                           return_document=pymongo.ReturnDocument.AFTER)
+        except Exception as err:
+            print("ERROR: Unable to increment %s for %s = %s, %s"%
+                  (inc_field, search_field, search_value, err))
+            return -1
+        if document is None:
+            print("ERROR: Could not find repertoire with %s = %s"%
+                  (search_field, search_value))
+            return -1
+        return document[inc_field]
+
     # Update a repertoire document in the repertoire collection. Takes a single 
     # field and a value for that field, searches for it, and if it finds one
     # record it updates that record with the document provided. This is a non
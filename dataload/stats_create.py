@@ -0,0 +1,346 @@
+#! /opt/ireceptor/data/bin/python
+"""
+ stats_create.py is a script to generate the per repertoire rearrangement
+ statistics (gene usage and junction lengths) used by the iReceptor Plus stats
+ API, and to write them to the stat collection in the repository. It computes
+ the same stats as stats/stats_files_create.php. The stats for a repertoire
+ are computed either on the server with an aggregation pipeline, or by
+ streaming a projected cursor over the rearrangements of the repertoire. The
+ repertoires are processed in parallel by a pool of worker processes, and the
+ stats for each repertoire are written with a single bulk upsert.
+"""
+import os
+import argparse
+import time
+import sys
+import multiprocessing
+
+# AIRR Mapping class.
+from airr_map import AIRRMap
+# Repository class - hides the DB implementation
+from repository import Repository
+# Rearrangement class, used to get the repertoire link fields.
+from rearrangement import Rearrangement
+# The stats computation.
+from repertoire_stats import RepertoireStats
+
+# Get the command line arguments...
+def getArguments():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="Generate the rearrangement stats for a set of repertoires."
+    )
+
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Run the program in verbose mode.")
+    parser.add_argument(
+        "--skipload",
+        action="store_true",
+        help="Compute the stats without writing them to the repository.")
+    parser.add_argument(
+        "--mode",
+        dest="mode",
+        default="aggregate",
+        choices=["aggregate", "cursor"],
+        help="How the stats are computed, either on the server using an aggregation pipeline (aggregate) or by streaming the rearrangements of each repertoire (cursor). Defaults to aggregate.")
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        default=4,
+        type=int,
+        help="Number of repertoires to process in parallel. Defaults to 4.")
+    parser.add_argument(
+        "--outdir",
+        dest="outdir",
+        default="",
+        help="If provided, also write the stats for each repertoire to a file <repertoire_id>_stats.json in this directory, in the format written by stats_files_create.php.")
+
+    # The repertoires to process.
+    repertoire_group = parser.add_argument_group("repertoire options")
+    repertoire_group = repertoire_group.add_mutually_exclusive_group(required=True)
+    repertoire_group.add_argument(
+        "--study_id",
+        dest="study_id",
+        help="Generate the stats for all of the repertoires in the study with this study_id.")
+    repertoire_group.add_argument(
+        "--repertoire_id",
+        dest="repertoire_id",
+        nargs="+",
+        help="Generate the stats for the repertoires with these repertoire link IDs.")
+
+    # Add configuration options 
+    config_group = parser.add_argument_group("Configuration file options", "")
+    config_group.add_argument(
+        "--mapfile",
+        dest="mapfile",
+        default="ireceptor.cfg",
+        help="the iReceptor configuration file. Defaults to 'ireceptor.cfg' in the local directory where the command is run. This file contains the mappings between the AIRR Community field definitions, the annotation tool field definitions, and the fields and their names that are stored in the repository."
+    )
+
+    # Database options
+    db_group = parser.add_argument_group("database options")
+    db_group.add_argument(
+        "--host",
+        dest="host",
+        default="localhost",
+        help="MongoDb server hostname. Defaults to 'localhost'."
+    )
+    db_group.add_argument(
+        "--port",
+        dest="port",
+        default=27017,
+        type=int,
+        help="MongoDb server port number. Defaults to 27017."
+    )
+    db_group.add_argument(
+        "-u",
+        "--user",
+        dest="user",
+        default=os.environ.get("MONGODB_SERVICE_USER", ""),
+        help="MongoDb user name. Defaults to the MONGODB_SERVICE_USER environment variable if set. Defaults to empty string (no user name) otherwise."
+    )
+    db_group.add_argument(
+        "-p",
+        "--password",
+        dest="password",
+        default=os.environ.get("MONGODB_SERVICE_SECRET", ""),
+        help="MongoDb service user account password. Defaults to the MONGODB_SERVICE_SECRET environment variable if set. Defaults to empty string (no password) otherwise."
+    )
+    db_group.add_argument(
+        "-d",
+        "--database",
+        dest="database",
+        default=os.environ.get("MONGODB_DB", "ireceptor"),
+        help="Target MongoDb database. Defaults to the MONGODB_DB environment variable if set. Defaults to 'ireceptor' otherwise."
+    )
+    db_group.add_argument(
+        "--database_map",
+        dest="database_map",
+        default="ir_repository",
+        help="Mapping to use to map data terms into repository terms. Defaults to ir_repository, which is the mapping for the iReceptor Turnkey repository. This mapping keyword MUST be in the term mapping file as specified by --mapfile"
+    )
+    db_group.add_argument(
+        "--repertoire_collection",
+        dest="repertoire_collection",
+        default="sample",
+        help="The collection to use for storing and searching repertoires (sample metadata). This is the collection that sample metadata is inserted into when the --sample option is specified. Defaults to 'sample', which is the collection in the iReceptor Turnkey repository."
+    )
+    db_group.add_argument(
+        "--rearrangement_collection",
+        dest="rearrangement_collection",
+        default="sequence",
+        help="The collection to use for storing and searching rearrangements (sequence annotations). This is the collection that data is inserted into when the --mixcr, --imgt, and --airr options are used to load files. Defaults to 'sequence', which is the collection in the iReceptor Turnkey repository."
+    )
+    db_group.add_argument(
+        "--clone_collection",
+        dest="clone_collection",
+        default="clone",
+        help="The collection to use for storing and searching clones. This is the collection that data is inserted into when the --mixcr-clone option is used to load files. Defaults to 'clone', which is the collection in the iReceptor Turnkey repository."
+    )
+    db_group.add_argument(
+        "--cell_collection",
+        dest="cell_collection",
+        default="cell",
+        help="The collection to use for storing and searching cells. This is the collection that data is inserted into when the --airr-cell option is used to load files. Defaults to 'cell', which is the collection in the iReceptor Turnkey repository."
+    )
+    db_group.add_argument(
+        "--expression_collection",
+        dest="expression_collection",
+        default="expression",
+        help="The collection to use for storing and searching gene expression. This is the collection that data is inserted into when the --airr-expression option is used to load files. Defaults to 'expression', which is the collection in the iReceptor Turnkey repository."
+    )
+    db_group.add_argument(
+        "--receptor_collection",
+        dest="receptor_collection",
+        default="receptor",
+        help="The collection to use for storing and searching receptor. This is the collection that data is inserted into when the --airr-receptor option is used to load files. Defaults to 'receptor', which is the collection in the iReceptor Turnkey repository."
+    )
+    db_group.add_argument(
+        "--reactivity_collection",
+        dest="reactivity_collection",
+        default="reactivity",
+        help="The collection to use for storing and searching reactivity data. This is the collection that data is inserted into when the --airr-reactivity option is used to load files. Defaults to 'reactivity', which is the collection in the iReceptor Turnkey repository."
+    )
+    db_group.add_argument(
+        "--stat_collection",
+        dest="stat_collection",
+        default="stat",
+        help="The collection the repertoire stats are written to. Defaults to 'stat', which is the collection in the iReceptor Turnkey repository."
+    )
+
+    options = parser.parse_args()
+
+    if options.verbose:
+        print('HOST               :', options.host)
+        print('PORT               :', options.port)
+        print('USER               :', options.user[0] + (len(options.user) - 2) * "*" + options.user[-1] if options.user else "")
+        print('PASSWORD           :', options.password[0] + (len(options.password) - 2) * "*" + options.password[-1] if options.password else "")
+        print('DATABASE           :', options.database)
+        print('DATABASE_MAP       :', options.database_map)
+        print('MAPFILE            :', options.mapfile)
+        print('MODE               :', options.mode)
+        print('WORKERS            :', options.workers)
+
+    return options
+
+# Create the repository object, which establishes the repository connection.
+# Returns None on error.
+def createRepository(options):
+    repository = Repository(options.user, options.password,
+                            options.host, options.port,
+                            options.database,
+                            options.repertoire_collection,
+                            options.rearrangement_collection,
+                            options.clone_collection,
+                            options.cell_collection,
+                            options.expression_collection,
+                            options.receptor_collection,
+                            options.reactivity_collection,
+                            options.skipload, False,
+                            options.verbose,
+                            stat_collection=options.stat_collection)
+    # Check on the successful creation of the repository
+    if repository is None or not repository:
+        return None
+    return repository
+
+# Get the repository fields that link rearrangements to repertoires, given
+# the AIRR Mapping. Returns the repertoire field in the repertoire collection
+# and the repertoire field in the rearrangement collection, or None on error.
+def getLinkFields(options, airr_map):
+    parser = Rearrangement(options.verbose, options.database_map, 0, airr_map, None)
+    repertoire_field = airr_map.getMapping(parser.getRepertoireLinkIDField(),
+                                           parser.getiReceptorTag(),
+                                           parser.getRepositoryTag())
+    rearrangement_field = airr_map.getMapping(parser.getAnnotationLinkIDField(),
+                                              parser.getiReceptorTag(),
+                                              parser.getRepositoryTag())
+    if repertoire_field is None or rearrangement_field is None:
+        print("ERROR: Could not find repertoire link fields in AIRR Mappings")
+        return None
+    return repertoire_field, rearrangement_field
+
+# Compute the stats for a single repertoire and write them to the repository,
+# returning a dictionary with the repertoire_id, the status of the stats
+# ("generated" or "failed"), the number of rearrangements, the number of stats
+# and the time taken.
+def generateStats(options, repository, link_fields, repertoire_id):
+    t_start = time.perf_counter()
+    repertoire_field, rearrangement_field = link_fields
+    result = {"repertoire_id": repertoire_id, "status": "failed",
+              "rearrangements": 0, "stats": 0, "time": 0.0}
+    stats = RepertoireStats(repertoire_id)
+    if options.mode == "aggregate":
+        pipeline = RepertoireStats.getAggregationPipeline(rearrangement_field,
+                                                          repertoire_id)
+        aggregation = repository.aggregateRearrangements(pipeline)
+        if aggregation is None:
+            return result
+        for document in aggregation:
+            stats.addAggregationResult(document)
+    else:
+        cursor = repository.getRearrangementCursor(rearrangement_field, repertoire_id,
+                                                   RepertoireStats.getFields())
+        if cursor is None:
+            return result
+        try:
+            stats.addRecords(cursor)
+        except Exception as err:
+            print("ERROR: Unable to read rearrangements for %s, %s"%(repertoire_id, err))
+            return result
+    t_computed = time.perf_counter()
+
+    # Write the stats, to a file if requested and to the repository.
+    stat_documents = stats.getStatDocuments(repertoire_field)
+    if not options.outdir == "":
+        stats.writeStatsFile(os.path.join(options.outdir, str(repertoire_id) + "_stats.json"),
+                             repertoire_field)
+    if repository.upsertStats(stat_documents, [repertoire_field, "name", "value"]) < 0:
+        return result
+    t_end = time.perf_counter()
+
+    result["status"] = "generated"
+    result["rearrangements"] = stats.getRearrangementCount()
+    result["stats"] = len(stat_documents)
+    result["time"] = t_end - t_start
+    print("Info: Repertoire %s, %d rearrangements, %d stats, compute = %f s, write = %f s"%
+          (repertoire_id, result["rearrangements"], result["stats"],
+           t_computed - t_start, t_end - t_computed), flush=True)
+    return result
+
+# Each worker process has its own repository connection, set up once by
+# initWorker when the worker starts.
+worker_options = None
+worker_repository = None
+worker_link_fields = None
+
+def initWorker(options, link_fields):
+    global worker_options, worker_repository, worker_link_fields
+    worker_options = options
+    worker_repository = createRepository(options)
+    worker_link_fields = link_fields
+
+def generateStatsWorker(repertoire_id):
+    if worker_repository is None:
+        print("ERROR: Worker could not connect to the repository, no stats for %s"%
+              (repertoire_id))
+        return {"repertoire_id": repertoire_id, "status": "failed",
+                "rearrangements": 0, "stats": 0, "time": 0.0}
+    return generateStats(worker_options, worker_repository, worker_link_fields,
+                         repertoire_id)
+
+if __name__ == "__main__":
+    # Get the command line arguments.
+    options = getArguments()
+
+    repository = createRepository(options)
+    if repository is None:
+        sys.exit(1)
+
+    # Create the AIRR mapping object, which has the mapping of fields between
+    # the various components.
+    airr_map = AIRRMap(options.verbose)
+    airr_map.readMapFile(options.mapfile)
+    if airr_map.getRearrangementMapColumn(options.database_map) is None:
+        print("ERROR: Could not find repository mapping %s in AIRR Mappings"%
+              (options.database_map))
+        sys.exit(1)
+    link_fields = getLinkFields(options, airr_map)
+    if link_fields is None:
+        sys.exit(1)
+
+    # Get the repertoires to process.
+    if options.study_id is None:
+        repertoire_ids = options.repertoire_id
+    else:
+        repertoire_ids = repository.getRepertoireIDs(link_fields[0], "study_id",
+                                                     options.study_id)
+        if repertoire_ids is None:
+            sys.exit(1)
+    print("Info: Generating stats for %d repertoires"%(len(repertoire_ids)), flush=True)
+    if not options.outdir == "" and not os.path.isdir(options.outdir):
+        os.makedirs(options.outdir)
+
+    t_start = time.perf_counter()
+    workers = max(1, min(options.workers, len(repertoire_ids)))
+    if workers == 1:
+        results = [generateStats(options, repository, link_fields, repertoire_id)
+                   for repertoire_id in repertoire_ids]
+    else:
+        with multiprocessing.Pool(workers, initializer=initWorker,
+                                  initargs=(options, link_fields)) as pool:
+            results = pool.map(generateStatsWorker, repertoire_ids, chunksize=1)
+    t_end = time.perf_counter()
+
+    failed = [result for result in results if not result["status"] == "generated"]
+    total_rearrangements = sum([result["rearrangements"] for result in results])
+    print("Info: Generated stats for %d repertoires (%d failed), %d rearrangements in %.2f s"%
+          (len(results) - len(failed), len(failed), total_rearrangements, t_end - t_start))
+    for result in failed:
+        print("ERROR: Stats for repertoire %s not generated"%(result["repertoire_id"]))
+    if len(failed) > 0:
+        sys.exit(1)
+    sys.exit(0)
@@ -0,0 +1,194 @@
+#! /opt/ireceptor/data/bin/python
+"""
+ stats_fixture_check.py checks the stats computed by dataload/repertoire_stats.py
+ against the output of stats_files_create.php for a small fixture study. The
+ fixture (fixture/rearrangements.json) has one rearrangement document per line
+ and covers the edge cases in the PHP code: gene lists of zero, one and more
+ than one gene, missing and null genes, string, integer and NaN productive
+ values, float and string junction lengths, and missing or null duplicate
+ counts. The expected stats files (fixture/expected/<repertoire_id>_stats.json)
+ are in the format written by stats_files_create.php.
+
+ The stats are checked in both of the modes used by dataload/stats_create.py.
+ The cursor mode stats are computed from the fixture records directly. The
+ aggregate mode stats are computed with the aggregation pipeline, which needs
+ a MongoDb server: the fixture is loaded into a scratch collection, which is
+ dropped at the end of the check.
+
+ Usage: python3 stats_fixture_check.py --host localhost
+        python3 stats_fixture_check.py --mode cursor
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import urllib.parse
+import pymongo
+
+# The data loader modules use flat imports from the dataload directory.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "dataload"))
+from repertoire_stats import RepertoireStats
+# Reading and comparing stats files.
+from stats_parity import readStats, compareStats
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixture")
+
+# Read the fixture rearrangements, one JSON document per line. NaN values are
+# allowed, as in the JSON written by mongoexport. Returns None on error.
+def readFixture(filename):
+    records = []
+    try:
+        with open(filename, "r") as file_handle:
+            for line in file_handle:
+                if line.strip() != "":
+                    records.append(json.loads(line))
+    except (IOError, ValueError) as err:
+        print("ERROR: Unable to read fixture %s, %s"%(filename, err))
+        return None
+    return records
+
+# Get the repertoire IDs of the records, in the order they first appear.
+def getRepertoireIDs(records, link_field):
+    return list(dict.fromkeys(record[link_field] for record in records))
+
+# Compute the stats for each repertoire from the records, as done by
+# stats_create.py --mode cursor.
+def computeCursorStats(records, link_field):
+    stats_list = []
+    for repertoire_id in getRepertoireIDs(records, link_field):
+        stats = RepertoireStats(repertoire_id)
+        stats.addRecords(record for record in records
+                         if record[link_field] == repertoire_id)
+        stats_list.append(stats)
+    return stats_list
+
+# Compute the stats for each repertoire with the aggregation pipeline, as done
+# by stats_create.py --mode aggregate. The records are loaded into the scratch
+# collection, which is dropped afterwards.
+def computeAggregateStats(collection, records, link_field):
+    collection.drop()
+    # insert_many adds an _id to each record, so insert copies.
+    collection.insert_many([dict(record) for record in records])
+    try:
+        stats_list = []
+        for repertoire_id in getRepertoireIDs(records, link_field):
+            stats = RepertoireStats(repertoire_id)
+            pipeline = RepertoireStats.getAggregationPipeline(link_field, repertoire_id)
+            for document in collection.aggregate(pipeline, allowDiskUse=True):
+                stats.addAggregationResult(document)
+            stats_list.append(stats)
+    finally:
+        collection.drop()
+    return stats_list
+
+# Compare the stats with the expected stats, by writing them to stats files
+# and reading them back in the same way as the expected files. Returns the
+# number of differences, or -1 on error.
+def checkStats(stats_list, expected, repertoire_id_field, max_report):
+    with tempfile.TemporaryDirectory() as outdir:
+        for stats in stats_list:
+            stats.writeStatsFile(os.path.join(outdir, str(stats.repertoire_id) + "_stats.json"),
+                                 repertoire_id_field)
+        actual = readStats(outdir, repertoire_id_field)
+    if actual is None:
+        return -1
+    return compareStats(expected, actual, max_report)
+
+def getArguments():
+    parser = argparse.ArgumentParser(
+        description="Check the Python repertoire stats against the PHP stats for a fixture study."
+    )
+    parser.add_argument(
+        "--mode",
+        dest="mode",
+        nargs="+",
+        default=["cursor", "aggregate"],
+        choices=["cursor", "aggregate"],
+        help="The stats_create.py modes to check. Defaults to both. The aggregate mode needs a MongoDb server.")
+    parser.add_argument(
+        "--fixture",
+        dest="fixture",
+        default=os.path.join(FIXTURE_DIR, "rearrangements.json"),
+        help="The fixture rearrangements, one JSON document per line. Defaults to fixture/rearrangements.json.")
+    parser.add_argument(
+        "--expected_dir",
+        dest="expected_dir",
+        default=os.path.join(FIXTURE_DIR, "expected"),
+        help="Directory of the expected stats files for the fixture. Defaults to fixture/expected.")
+    parser.add_argument(
+        "--repertoire_id_field",
+        dest="repertoire_id_field",
+        default="ir_annotation_set_metadata_id",
+        help="The repertoire ID field in the stats. Defaults to ir_annotation_set_metadata_id.")
+    parser.add_argument(
+        "--link_field",
+        dest="link_field",
+        default="ir_annotation_set_metadata_id_rearrangement",
+        help="The field in the rearrangements that links them to the repertoire. Defaults to ir_annotation_set_metadata_id_rearrangement.")
+    parser.add_argument(
+        "--max_report",
+        dest="max_report",
+        type=int,
+        default=20,
+        help="The maximum number of differences to report. Defaults to 20.")
+
+    # Database options, used by the aggregate mode.
+    db_group = parser.add_argument_group("database options")
+    db_group.add_argument("--host", dest="host", default="localhost",
+                          help="MongoDb server hostname. Defaults to 'localhost'.")
+    db_group.add_argument("--port", dest="port", default=27017, type=int,
+                          help="MongoDb server port number. Defaults to 27017.")
+    db_group.add_argument("-u", "--user", dest="user",
+                          default=os.environ.get("MONGODB_SERVICE_USER", ""),
+                          help="MongoDb user name. Defaults to the MONGODB_SERVICE_USER environment variable.")
+    db_group.add_argument("-p", "--password", dest="password",
+                          default=os.environ.get("MONGODB_SERVICE_SECRET", ""),
+                          help="MongoDb password. Defaults to the MONGODB_SERVICE_SECRET environment variable.")
+    db_group.add_argument("-d", "--database", dest="database",
+                          default="stats_fixture",
+                          help="Scratch database to use. Defaults to 'stats_fixture'.")
+    db_group.add_argument("--collection", dest="collection",
+                          default="sequence_fixture",
+                          help="Scratch collection to load the fixture into. Defaults to 'sequence_fixture'.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    options = getArguments()
+
+    records = readFixture(options.fixture)
+    expected = readStats(options.expected_dir, options.repertoire_id_field)
+    if records is None or expected is None:
+        sys.exit(1)
+
+    failed = False
+    for mode in options.mode:
+        if mode == "cursor":
+            stats_list = computeCursorStats(records, options.link_field)
+        else:
+            user = urllib.parse.quote_plus(options.user)
+            password = urllib.parse.quote_plus(options.password)
+            if len(user) == 0 and len(password) == 0:
+                uri = 'mongodb://%s:%s' % (options.host, options.port)
+            else:
+                uri = 'mongodb://%s:%s@%s:%s' % (user, password, options.host, options.port)
+            try:
+                mongo_client = pymongo.MongoClient(uri)
+                collection = mongo_client[options.database][options.collection]
+                stats_list = computeAggregateStats(collection, records, options.link_field)
+            except pymongo.errors.PyMongoError as err:
+                print("ERROR: Unable to compute the %s stats on %s:%d, %s"%
+                      (mode, options.host, options.port, err))
+                failed = True
+                continue
+
+        differences = checkStats(stats_list, expected, options.repertoire_id_field,
+                                 options.max_report)
+        if differences != 0:
+            print("ERROR: The %s mode stats do not match the expected stats"%(mode))
+            failed = True
+        else:
+            print("Info: The %s mode stats match, %d stats compared"%(mode, len(expected)))
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,105 @@
+#! /opt/ireceptor/data/bin/python
+"""
+ stats_parity.py checks that two sets of repertoire stats files are the same,
+ typically the files written by stats_files_create.php and the files written
+ by dataload/stats_create.py (with --outdir) for the same study. Each file has
+ one JSON stat document per line, and the stats are compared by repertoire,
+ stat name and value regardless of the order they appear in.
+
+ Usage: python3 stats_parity.py php_outdir python_outdir
+"""
+import os
+import sys
+import json
+import glob
+import argparse
+
+# Read all of the stats files in a directory into a dictionary keyed on the
+# repertoire ID, stat name and value. Returns None on error.
+def readStats(directory, repertoire_id_field):
+    stats = dict()
+    filenames = sorted(glob.glob(os.path.join(directory, "*_stats.json")))
+    if len(filenames) == 0:
+        print("ERROR: No stats files found in %s"%(directory))
+        return None
+    for filename in filenames:
+        with open(filename, "r") as file_handle:
+            for line_number, line in enumerate(file_handle):
+                if line.strip() == "":
+                    continue
+                try:
+                    document = json.loads(line)
+                except ValueError as err:
+                    print("ERROR: Invalid stat in %s line %d, %s"%
+                          (filename, line_number + 1, err))
+                    return None
+                key = (str(document[repertoire_id_field]), document["name"],
+                       str(document["value"]))
+                # PHP writes each value of a stat once, as an array key.
+                if key in stats:
+                    print("ERROR: Duplicate stat %s %s = %s in %s line %d"%
+                          (key[0], key[1], key[2], filename, line_number + 1))
+                    return None
+                stats[key] = document["count"]
+    print("Info: Read %d stats from %d files in %s"%
+          (len(stats), len(filenames), directory))
+    return stats
+
+# Compare two sets of stats read by readStats(), reporting up to max_report of
+# each kind of difference. Returns the number of differences.
+def compareStats(expected, actual, max_report):
+    missing = [key for key in expected if not key in actual]
+    extra = [key for key in actual if not key in expected]
+    different = [key for key in expected
+                 if key in actual and not expected[key] == actual[key]]
+
+    for key in missing[:max_report]:
+        print("ERROR: Missing stat %s %s = %s, expected count %s"%
+              (key[0], key[1], key[2], expected[key]))
+    for key in extra[:max_report]:
+        print("ERROR: Extra stat %s %s = %s, count %s"%
+              (key[0], key[1], key[2], actual[key]))
+    for key in different[:max_report]:
+        print("ERROR: Stat %s %s = %s has count %s, expected %s"%
+              (key[0], key[1], key[2], actual[key], expected[key]))
+
+    if len(missing) + len(extra) + len(different) > 0:
+        print("ERROR: Stats differ - %d missing, %d extra, %d different counts"%
+              (len(missing), len(extra), len(different)))
+    return len(missing) + len(extra) + len(different)
+
+def getArguments():
+    parser = argparse.ArgumentParser(
+        description="Compare two directories of repertoire stats files."
+    )
+    parser.add_argument("expected_dir",
+                        help="Directory of the reference stats files (e.g. from stats_files_create.php).")
+    parser.add_argument("actual_dir",
+                        help="Directory of the stats files to check (e.g. from stats_create.py).")
+    parser.add_argument(
+        "--repertoire_id_field",
+        dest="repertoire_id_field",
+        default="ir_annotation_set_metadata_id",
+        help="The repertoire ID field in the stats. Defaults to ir_annotation_set_metadata_id."
+    )
+    parser.add_argument(
+        "--max_report",
+        dest="max_report",
+        type=int,
+        default=20,
+        help="The maximum number of differences to report. Defaults to 20."
+    )
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    options = getArguments()
+
+    expected = readStats(options.expected_dir, options.repertoire_id_field)
+    actual = readStats(options.actual_dir, options.repertoire_id_field)
+    if expected is None or actual is None:
+        sys.exit(1)
+
+    if compareStats(expected, actual, options.max_report) > 0:
+        sys.exit(1)
+    print("Info: Stats match, %d stats compared"%(len(expected)))
+    sys.exit(0)